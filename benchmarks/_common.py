@@ -0,0 +1,39 @@
+"""Scaffolding shared by the benchmarks: the cli module and generated databases.
+
+Benchmarks run as scripts, `import _common` first puts the repository on the
+path so `cli` and `constants` can be imported.
+"""
+import sqlite3
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import cli  # noqa: E402
+
+
+def setup_database(db_path: Path) -> Path:
+    "Create the database at 'db_path' and make it the one the cli commands use"
+    cli.command_setup(cli.CommandSetup(database_path=db_path))
+    cli.DB_PATH = db_path
+    return db_path
+
+
+def generate(db_path: Path, entries) -> Path:
+    """Set up the database at 'db_path' filled with 'entries'
+
+    'entries' yields (start, end, message, category) tuples, with category
+    names or None.
+    """
+    setup_database(db_path)
+    connection = sqlite3.connect(db_path)
+    # Categories are inserted while executemany still runs on its own cursor
+    categories_cursor = connection.cursor()
+    categories = cli.category_cache()
+    connection.executemany(
+        'INSERT INTO timetrack (start, end, message, category_id) VALUES (?, ?, ?, ?)',
+        ((start, end, message, categories.get_id(categories_cursor, category))
+         for start, end, message, category in entries))
+    connection.commit()
+    connection.close()
+    return db_path
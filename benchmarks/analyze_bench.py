@@ -0,0 +1,58 @@
+"""Compare the SQLite and DuckDB engines of `analyze` on a generated database.
+
+Usage: python benchmarks/analyze_bench.py [rows]
+
+DuckDB is skipped when the duckdb package is not installed or its sqlite
+extension can not be loaded.
+"""
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from _common import cli, setup_database
+
+
+def generate(db_path: Path, rows: int):
+    setup_database(db_path)
+    connection = sqlite3.connect(db_path)
+    connection.executemany('INSERT INTO categories (name) VALUES (?)',
+                           [('dev',), ('meeting',), ('ops',), ('review',)])
+    # One entry every 5 minutes from 1990 on, 1 to 60 minutes long
+    connection.execute(
+        "WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i + 1 < ?) "
+        "INSERT INTO timetrack (start, end, message, category_id) "
+        "SELECT strftime('%Y-%m-%dT%H:%M:%SZ', '1990-01-01', (i * 5) || ' minutes'),"
+        "  strftime('%Y-%m-%dT%H:%M:%SZ', '1990-01-01', (i * 5 + 1 + abs(random() % 60)) || ' minutes'),"
+        "  'task ' || i, nullif(abs(random() % 5), 0) "
+        "FROM n",
+        (rows,)
+    )
+    connection.commit()
+    connection.close()
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    engines = ['sqlite'] if cli.analyze_engine('auto') == 'sqlite' else ['sqlite', 'duckdb']
+    with tempfile.TemporaryDirectory() as tmp:
+        began = time.perf_counter()
+        generate(Path(tmp) / 'data.db', rows)
+        print(f'{rows} rows generated in {time.perf_counter() - began:.1f}s')
+        if engines == ['sqlite']:
+            print('DuckDB can not read SQLite here, only SQLite is measured')
+        for analysis in cli.ANALYSES:
+            timings = []
+            results = []
+            for engine in engines:
+                began = time.perf_counter()
+                results.append(cli.run_analysis(engine, analysis, '', '9999-12-31T23:59:59Z')[1])
+                timings.append(f'{engine} {time.perf_counter() - began:8.2f}s')
+            same = '' if len(results) == 1 else (
+                '  same rows' if results[0] == [tuple(row) for row in results[1]] else '  DIFFERENT ROWS')
+            print(f'{analysis:<10} ' + '  '.join(timings) + same)
+
+
+if __name__ == '__main__':
+    main()
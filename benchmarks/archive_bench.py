@@ -0,0 +1,67 @@
+"""Compare plain and compressed archives: on disk size and scan throughput.
+
+Usage: python benchmarks/archive_bench.py [rows]
+"""
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from _common import cli, generate
+from constants import DB_DATE_FORMAT
+
+MESSAGES = ['standup', 'code review', 'JIRA-{} fix tests', 'JIRA-{} implement',
+            'meeting with team', 'deploy', 'PROJ-{} investigate bug']
+CATEGORIES = ['dev', 'meeting', 'ops', None]
+
+
+def entries(rows: int):
+    random.seed(0)
+    start = datetime(2000, 1, 1)
+    for i in range(rows):
+        entry_start = start + timedelta(minutes=5 * i)
+        entry_end = entry_start + timedelta(minutes=random.randint(1, 5))
+        message = random.choice(MESSAGES).format(random.randint(1, 500))
+        yield (entry_start.strftime(DB_DATE_FORMAT), entry_end.strftime(DB_DATE_FORMAT),
+               f'{message} #{i}', random.choice(CATEGORIES))
+
+
+def scan(db_path: Path) -> tuple:
+    def read(cursor, source):
+        cursor.execute(
+            'SELECT rowid, start, end, category, message '
+            f'FROM {source} '
+            'ORDER BY start'
+        )
+        return cursor
+
+    connection = sqlite3.connect(db_path)
+    began = time.perf_counter()
+    count = sum(1 for _ in cli.iter_federated(connection.cursor(), read, start_column=1))
+    elapsed = time.perf_counter() - began
+    connection.close()
+    return count, elapsed
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    with tempfile.TemporaryDirectory() as tmp:
+        for compress in (False, True):
+            db_path = Path(tmp) / ('compressed.db' if compress else 'plain.db')
+            generate(db_path, entries(rows))
+            began = time.perf_counter()
+            cli.command_archive(cli.CommandArchive(before='9999-01-01', compress=compress))
+            archive_time = time.perf_counter() - began
+
+            size = sum(path.stat().st_size for path in cli.archive_directory().iterdir())
+            count, elapsed = scan(db_path)
+            label = 'compressed' if compress else 'plain'
+            print(f'{label:<10} archive {archive_time:6.2f}s  size {size / 2**20:8.2f} MiB  '
+                  f'scan {count} rows in {elapsed:6.2f}s ({count / elapsed:10.0f} rows/s)')
+
+
+if __name__ == '__main__':
+    main()
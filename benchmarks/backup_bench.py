@@ -0,0 +1,88 @@
+"""Measure `start`/`end` latency while `backup` copies the database.
+
+Usage: python benchmarks/backup_bench.py [rows] [pages] [sleep]
+"""
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from _common import cli, generate
+from constants import DB_DATE_FORMAT
+
+
+def entries(rows: int):
+    start = datetime(2000, 1, 1)
+    for i in range(rows):
+        yield ((start + timedelta(minutes=5 * i)).strftime(DB_DATE_FORMAT),
+               (start + timedelta(minutes=5 * i + 4)).strftime(DB_DATE_FORMAT),
+               f'task {i} ' + 'x' * 100, None)
+
+
+def writer(stop: threading.Event, latencies: list):
+    "Start and end entries like the cli does, one command per transaction"
+    connection = sqlite3.connect(cli.DB_PATH, timeout=30)
+    cursor = cli.get_cursor(connection)
+    while not stop.is_set():
+        began = time.perf_counter()
+        message = f'bench {len(latencies)} {began}'
+        entry = cli.insert_entry(cursor, message, datetime.now().strftime(DB_DATE_FORMAT), None, None)
+        connection.commit()
+        cli.end_entry(cursor, entry.rowid, datetime.now().strftime(DB_DATE_FORMAT))
+        connection.commit()
+        latencies.append(time.perf_counter() - began)
+    connection.close()
+
+
+def measure(duration: float, action=None) -> tuple:
+    stop = threading.Event()
+    latencies = []
+    thread = threading.Thread(target=writer, args=(stop, latencies))
+    thread.start()
+    began = time.perf_counter()
+    if action:
+        action()
+    else:
+        time.sleep(duration)
+    elapsed = time.perf_counter() - began
+    stop.set()
+    thread.join()
+    latencies.sort()
+    return elapsed, latencies
+
+
+def report(label: str, elapsed: float, latencies: list):
+    if not latencies:
+        print(f'{label:<28} {elapsed:6.2f}s       0 writes')
+        return
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    print(f'{label:<28} {elapsed:6.2f}s {len(latencies):7} writes '
+          f'p50 {p50:7.2f}ms p99 {p99:7.2f}ms max {latencies[-1] * 1000:8.2f}ms')
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    pages = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    sleep = float(sys.argv[3]) if len(sys.argv) > 3 else 0.005
+    with tempfile.TemporaryDirectory() as tmp:
+        generate(Path(tmp) / 'data.db', entries(rows))
+        backup = Path(tmp) / 'backup.db'
+
+        def run(step_pages, compress=False):
+            return lambda: cli.command_backup(cli.CommandBackup(
+                path=str(backup), pages=step_pages, sleep=sleep, compress=compress))
+
+        elapsed, latencies = measure(2)
+        report('no backup', elapsed, latencies)
+        report('backup in one step', *measure(0, run(-1)))
+        report(f'backup {pages} pages/step', *measure(0, run(pages)))
+        report(f'compressed {pages} pages/step', *measure(0, run(pages, compress=True)))
+
+
+if __name__ == '__main__':
+    main()
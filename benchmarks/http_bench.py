@@ -0,0 +1,91 @@
+"""Load test `serve-http`: requests per second with keep-alive clients.
+
+Runs the server in process on a generated database and measures plain
+cached reads, ETag revalidations (304) and reads mixed with writes, which
+invalidate the cache.
+
+Usage: python benchmarks/http_bench.py [rows] [clients] [seconds]
+"""
+import http.client
+import json
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from _common import cli, generate
+from constants import DB_DATE_FORMAT
+
+
+def entries(rows: int):
+    start = datetime.now() - timedelta(minutes=rows)
+    for i in range(rows):
+        yield ((start + timedelta(minutes=i)).strftime(DB_DATE_FORMAT),
+               (start + timedelta(minutes=i, seconds=50)).strftime(DB_DATE_FORMAT),
+               f'task {i}', None)
+
+
+def client(address: tuple, path: str, seconds: float, revalidate: bool, write_every: int,
+           latencies: list):
+    connection = http.client.HTTPConnection(*address)
+    etag = None
+    deadline = time.perf_counter() + seconds
+    i = 0
+    while time.perf_counter() < deadline:
+        i += 1
+        began = time.perf_counter()
+        if write_every and i % write_every == 0:
+            body = json.dumps({'message': f'bench {threading.get_ident()} {i}'})
+            connection.request('POST', '/start', body=body)
+        else:
+            headers = {'If-None-Match': etag} if revalidate and etag else {}
+            connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        etag = response.getheader('ETag') or etag
+        latencies.append(time.perf_counter() - began)
+    connection.close()
+
+
+def run(server, label: str, path: str, clients: int, seconds: float,
+        revalidate: bool = False, write_every: int = 0):
+    latencies = []
+    threads = [threading.Thread(target=client, args=(
+        server.server_address[:2], path, seconds, revalidate, write_every, latencies))
+        for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    print(f'{label:<28} {len(latencies) / seconds:8.0f} req/s  '
+          f'p50 {statistics.median(latencies) * 1000:6.2f}ms  '
+          f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:6.2f}ms')
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 3
+    with tempfile.TemporaryDirectory() as tmp:
+        generate(Path(tmp) / 'data.db', entries(rows))
+        server = cli.ApiServer(('127.0.0.1', 0), clients)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        print(f'{rows} rows, {clients} keep-alive clients, {seconds}s per run')
+        try:
+            run(server, 'GET /entries cached', '/entries', clients, seconds)
+            run(server, 'GET /entries revalidated', '/entries', clients, seconds, revalidate=True)
+            run(server, 'GET /entries, 1 write in 10', '/entries', clients, seconds, write_every=10)
+            run(server, 'GET /metrics cached', '/metrics?start=2000-01-01', clients, seconds)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Compare single process and parallel `import --jobs N` on a generated CSV file.
+
+Usage: python benchmarks/import_bench.py [rows] [max_jobs]
+"""
+import hashlib
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from _common import cli, setup_database
+from constants import CLI_PRINT_DATE_FORMAT, DB_DATE_FORMAT
+
+
+def generate_csv(path: Path, rows: int):
+    start = datetime(2000, 1, 1)
+    with open(path, 'w') as f:
+        print('start,end,category,message', file=f)
+        for i in range(rows):
+            entry_start = start + timedelta(minutes=30 * i)
+            entry_end = entry_start + timedelta(minutes=25)
+            print(f'{entry_start.strftime(CLI_PRINT_DATE_FORMAT)},'
+                  f'{entry_end.strftime(DB_DATE_FORMAT)},'
+                  f'cat{i % 10},task {i}', file=f)
+
+
+def table_digest(db_path: Path) -> str:
+    digest = hashlib.sha256()
+    connection = sqlite3.connect(db_path)
+    for row in connection.execute('SELECT rowid, * FROM timetrack ORDER BY rowid'):
+        digest.update(repr(row).encode())
+    connection.close()
+    return digest.hexdigest()
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    max_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = Path(tmp) / 'import.csv'
+        generate_csv(csv_path, rows)
+
+        jobs = 1
+        baseline = None
+        print(f'{rows} rows, {os.cpu_count()} cpus')
+        while jobs <= max_jobs:
+            db_path = Path(tmp) / f'jobs{jobs}.db'
+            setup_database(db_path)
+            args = cli.CommandImport(path=str(csv_path), format='csv', jobs=jobs)
+            began = time.perf_counter()
+            cli.command_import(args)
+            elapsed = time.perf_counter() - began
+
+            digest = table_digest(db_path)
+            baseline = baseline or (elapsed, digest)
+            same = 'same rows' if digest == baseline[1] else 'DIFFERENT ROWS'
+            print(f'jobs={jobs:<3} {elapsed:8.2f}s {rows / elapsed:10.0f} rows/s '
+                  f'x{baseline[0] / elapsed:.2f} {same}')
+            jobs *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Time cross user `metrics --all-users` over many user databases by number of jobs.
+
+Usage: python benchmarks/users_bench.py [users] [rows_per_user] [max_jobs]
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from _common import cli, generate
+from constants import DB_DATE_FORMAT
+
+
+def entries(rows: int):
+    start = datetime(2000, 1, 1)
+    for i in range(rows):
+        yield ((start + timedelta(minutes=30 * i)).strftime(DB_DATE_FORMAT),
+               (start + timedelta(minutes=30 * i + 25)).strftime(DB_DATE_FORMAT),
+               f'task {i}', f'cat{i % 5}')
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    max_jobs = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    with tempfile.TemporaryDirectory() as tmp:
+        cli.USERS_DIR = Path(tmp) / 'users'
+        for user in range(users):
+            generate(cli.user_db_path(f'user{user:04d}'), entries(rows))
+        print(f'{users} users x {rows} rows, {os.cpu_count()} cpus')
+        start = datetime(2000, 1, 1)
+        jobs = 1
+        while jobs <= max_jobs:
+            began = time.perf_counter()
+            totals = cli.map_users(cli.collect_metrics, start, None, False, jobs=jobs)
+            elapsed = time.perf_counter() - began
+            total = sum(metrics.rows for metrics in totals.values())
+            print(f'jobs={jobs:<3} {elapsed:6.2f}s {total / elapsed:10.0f} rows/s')
+            jobs *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Compare reads of the last 48 hours and start/end writes through the database and the working set.
+
+Usage: python benchmarks/working_set_bench.py [rows] [operations]
+"""
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from _common import cli, generate
+from constants import DB_DATE_FORMAT
+
+
+def entries(rows: int):
+    now = datetime.now()
+    for i in range(1, rows + 1):
+        yield ((now - timedelta(minutes=5 * i)).strftime(DB_DATE_FORMAT),
+               (now - timedelta(minutes=5 * i - 3)).strftime(DB_DATE_FORMAT),
+               f'task {i}', None)
+
+
+def timed(label: str, operations: int, func):
+    began = time.perf_counter()
+    for i in range(operations):
+        func(i)
+    elapsed = time.perf_counter() - began
+    print(f'{label:<32} {elapsed:8.3f}s {operations / elapsed:10.0f} ops/s')
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    operations = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    with tempfile.TemporaryDirectory() as tmp:
+        generate(Path(tmp) / 'data.db', entries(rows))
+        base = datetime(2100, 1, 1)
+
+        def start_and_end(i):
+            start = (base + timedelta(minutes=i)).strftime(DB_DATE_FORMAT)
+            entry = cli.run_write(lambda cursor: cli.insert_entry(cursor, f'direct {i}', start, None, None))
+            cli.run_write(lambda cursor: cli.end_entry(cursor, entry.rowid, start))
+
+        timed('database: list last 48h', operations, lambda i: cli.read_entries(cli.list_start(None)))
+        timed('database: start and end', operations, start_and_end)
+
+        for sync_journal in (True, False):
+            working_set = cli.WorkingSet(sync_journal=sync_journal)
+
+            def start_and_end_behind(i):
+                start = (base + timedelta(days=1, minutes=i)).strftime(DB_DATE_FORMAT)
+                entry = working_set.insert(f'behind {sync_journal} {i}', start, None, None)
+                working_set.end(entry.rowid, start)
+
+            label = 'fsync' if sync_journal else 'no fsync'
+            timed('working set: list last 48h', operations, lambda i: working_set.entries())
+            timed(f'working set: start/end {label}', operations, start_and_end_behind)
+            began = time.perf_counter()
+            working_set.close()
+            print(f'{"working set: final flush":<32} {time.perf_counter() - began:8.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Run start/end from many processes at once and check that no write is lost.
+
+Every worker starts and ends its own entries through `run_write`, the path
+used by the `start` and `end` commands, and records each command latency.
+
+Usage: python benchmarks/write_stress.py [processes] [operations] [busy_timeout]
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from _common import cli, setup_database
+from constants import DB_DATE_FORMAT
+
+
+def worker(db_path: Path, worker_id: int, operations: int, busy_timeout: float) -> tuple:
+    cli.DB_PATH = db_path
+    cli.BUSY_TIMEOUT = busy_timeout
+    start = datetime(2000, 1, 1) + timedelta(days=worker_id)
+    latencies = []
+    failed_starts = failed_ends = 0
+    for i in range(operations):
+        entry_start = (start + timedelta(minutes=i)).strftime(DB_DATE_FORMAT)
+        try:
+            began = time.perf_counter()
+            entry = cli.run_write(lambda cursor: cli.insert_entry(
+                cursor, f'worker {worker_id} task {i}', entry_start, None, None))
+            latencies.append(time.perf_counter() - began)
+        except cli.CommandError:
+            failed_starts += 1
+            continue
+        try:
+            began = time.perf_counter()
+            cli.run_write(lambda cursor: cli.end_entry(cursor, entry.rowid, entry_start))
+            latencies.append(time.perf_counter() - began)
+        except cli.CommandError:
+            failed_ends += 1
+    return latencies, failed_starts, failed_ends
+
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    operations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    busy_timeout = float(sys.argv[3]) if len(sys.argv) > 3 else cli.BUSY_TIMEOUT
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / 'data.db'
+        setup_database(db_path)
+
+        began = time.perf_counter()
+        with ProcessPoolExecutor(processes) as executor:
+            results = list(executor.map(
+                worker, [db_path] * processes, range(processes),
+                [operations] * processes, [busy_timeout] * processes))
+        elapsed = time.perf_counter() - began
+
+        latencies = sorted(latency for result, _, _ in results for latency in result)
+        failed_starts = sum(result[1] for result in results)
+        failed_ends = sum(result[2] for result in results)
+        connection = sqlite3.connect(db_path)
+        stored, running = connection.execute(
+            'SELECT count(*), count(*) - count(end) FROM timetrack').fetchone()
+        connection.close()
+
+        expected = processes * operations - failed_starts
+        print(f'{processes} processes x {operations} start/end pairs in {elapsed:.2f}s, '
+              f'{len(latencies) / elapsed:.0f} commands/s')
+        print(f'p50 {statistics.median(latencies) * 1000:.2f}ms '
+              f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f}ms '
+              f'max {latencies[-1] * 1000:.2f}ms')
+        print(f'{stored} entries stored, {expected} expected, {running} left running, '
+              f'{failed_starts} starts and {failed_ends} ends gave up')
+        if stored != expected or running != failed_ends:
+            sys.exit('LOST WRITES')
+
+
+if __name__ == '__main__':
+    main()
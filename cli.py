@@ -1,16 +1,50 @@
 import argparse
-from dataclasses import dataclass
-from datetime import datetime, timedelta
-from itertools import groupby
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+import csv
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+import hashlib
+import heapq
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+from itertools import chain, groupby, islice
+import os
 from pathlib import Path
+import queue
+import random
+import re
+import shlex
 import sqlite3
+import sys
+import threading
+import time
 from typing import Optional
-from constants import CLI_DATE_FORMAT, CLI_HOUR_FORMAT, CLI_PRINT_DATE_FORMAT, DB_DATE_FORMAT, DB_PATH
+from urllib.parse import parse_qs, urlsplit
+import zlib
+from constants import (CLI_DATE_FORMAT, CLI_HOUR_FORMAT, CLI_PRINT_DATE_FORMAT, DATA_ENCODING, DB_BUSY_TIMEOUT,
+                       DB_DATE_FORMAT, DB_PATH, DB_WRITE_ATTEMPTS, USERS_DIR)
 import json
 
 from date_extensions import DATE_FORMATS, parse_date_db, try_parse_date
 
+try:
+    # Optional, 'analyze' falls back to SQLite without it
+    import duckdb
+except ImportError:
+    duckdb = None
+
+try:
+    # Unix only, the write-behind working set needs it
+    import fcntl
+except ImportError:
+    fcntl = None
+
 UNSET = object()
+BUSY_TIMEOUT = DB_BUSY_TIMEOUT
+WRITE_ATTEMPTS = DB_WRITE_ATTEMPTS
 
 
 def format_duration(duration: timedelta):
@@ -53,10 +87,22 @@ class Timetracker:
             print(
                 f'{rowid}: {start_day} | {start} .. {end} | {duration} | {self.message}')
 
+    def to_dict(self) -> dict:
+        return {
+            'id': self.rowid,
+            'message': self.message,
+            'start': self.start.strftime(DB_DATE_FORMAT),
+            'end': self.end and self.end.strftime(DB_DATE_FORMAT),
+            'category': self.category,
+        }
+
 
 def batched(values, batch_size):
-    for batch_ix in range(0, len(values), batch_size):
-        yield values[batch_ix:batch_ix + batch_size]
+    iterator = iter(values)
+    batch = list(islice(iterator, batch_size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, batch_size))
 
 
 class CommandError(Exception):
@@ -76,6 +122,99 @@ def get_cursor(connection: sqlite3.Connection) -> sqlite3.Cursor:
     return cursor
 
 
+def connect(path=None, **kwargs) -> sqlite3.Connection:
+    "Open the database, waiting up to BUSY_TIMEOUT seconds for other writers"
+    return sqlite3.connect(DB_PATH if path is None else path, timeout=BUSY_TIMEOUT, **kwargs)
+
+
+# SQLITE_BUSY and SQLITE_LOCKED, sqlite3 only exports them from Python 3.11
+BUSY_CODES = (5, 6)
+
+
+def is_busy(error: sqlite3.OperationalError) -> bool:
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is None:
+        # Before Python 3.11 only the message tells
+        message = str(error)
+        return 'database is locked' in message or 'database table is locked' in message
+    # Extended codes such as SQLITE_BUSY_RECOVERY keep the primary code in the low byte
+    return code & 0xff in BUSY_CODES
+
+
+# Databases whose only writer is a working set of this process, see WorkingSet
+EXCLUSIVE_WRITERS = set()
+
+
+def writer_lock_path() -> Path:
+    return Path(f'{DB_PATH}.lock')
+
+
+@contextmanager
+def shared_write_lock():
+    "Refuse to write while a write-behind working set of another process owns the database"
+    # Without a database there is nothing to share, and no lock file is left
+    # next to a path that was never written
+    if fcntl is None or str(DB_PATH) in EXCLUSIVE_WRITERS or not Path(DB_PATH).exists():
+        yield
+        return
+    fd = os.open(writer_lock_path(), os.O_RDWR | os.O_CREAT)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise CommandError('The database is written by a write-behind server, send the write to it')
+        yield
+    finally:
+        os.close(fd)
+
+
+def run_write(write):
+    "Run write(cursor) in its own BEGIN IMMEDIATE transaction and return its result"
+    # IMMEDIATE takes the write lock up front, so a transaction never has to
+    # be abandoned half way because a reader upgraded first.
+    def attempt():
+        connection = connect()
+        committed = False
+        try:
+            # The pragmas of get_cursor are ignored inside a transaction
+            cursor = get_cursor(connection)
+            connection.execute('BEGIN IMMEDIATE')
+            result = write(cursor)
+            connection.commit()
+            committed = True
+            return result
+        finally:
+            if not committed:
+                # Categories inserted by the rolled back transaction are gone
+                category_cache().clear()
+            connection.close()
+
+    with shared_write_lock():
+        return retry_busy(attempt)
+
+
+def begin_immediate(cursor: sqlite3.Cursor):
+    "Start a BEGIN IMMEDIATE transaction on an autocommit connection"
+    retry_busy(lambda: cursor.execute('BEGIN IMMEDIATE'))
+
+
+def retry_busy(func):
+    "Return func(), calling it again while it fails because the database is locked"
+    # When the lock is still held after the busy timeout, back off with full
+    # jitter and retry.
+    delay = 0.05
+    for attempt in range(1, WRITE_ATTEMPTS + 1):
+        try:
+            return func()
+        except sqlite3.OperationalError as e:
+            if not is_busy(e):
+                raise
+            if attempt == WRITE_ATTEMPTS:
+                raise CommandError(f'Database is still locked after {attempt} attempts') from e
+        time.sleep(random.uniform(0, delay))
+        delay *= 2
+
+
 def parse_date_or_throw(field, date):
     date = try_parse_date(date)
     if date is None:
@@ -83,16 +222,110 @@ def parse_date_or_throw(field, date):
     return date
 
 
-class CommandSetup(argparse.Namespace):
-    database_path: str = DB_PATH
+def format_date_or_throw(field, date):
+    return parse_date_or_throw(field, date).strftime(DB_DATE_FORMAT)
 
 
-def command_setup(args: CommandSetup):
-    "Setup the database"
-    connection = sqlite3.connect(args.database_path)
-    cursor = get_cursor(connection)
-    cursor.execute('PRAGMA foreign_keys=ON')
-    cursor.execute('PRAGMA encoding=utf8')
+class CategoryCache:
+    "In process map of category names to their ids in the categories table"
+
+    def __init__(self):
+        self.ids = {}
+        self.names = {}
+
+    def get_id(self, cursor: sqlite3.Cursor, name: Optional[str]) -> Optional[int]:
+        "Id of the 'name' category, inserted on first use"
+        if name is None:
+            return None
+        if name not in self.ids:
+            cursor.execute('SELECT id FROM categories WHERE name = ?', (name,))
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute(
+                    'INSERT INTO categories (name) VALUES (?) RETURNING id', (name,))
+                row = cursor.fetchone()
+            self.ids[name] = row[0]
+            self.names[row[0]] = name
+        return self.ids[name]
+
+    def get_name(self, cursor: sqlite3.Cursor, category_id: Optional[int]) -> Optional[str]:
+        if category_id is None:
+            return None
+        if category_id not in self.names:
+            cursor.execute('SELECT name FROM categories WHERE id = ?', (category_id,))
+            name = cursor.fetchone()[0]
+            self.ids[name] = category_id
+            self.names[category_id] = name
+        return self.names[category_id]
+
+    def clear(self):
+        "Forget the ids, a rolled back transaction may have discarded some"
+        self.ids.clear()
+        self.names.clear()
+
+
+CATEGORY_CACHES = {}
+
+
+def category_cache() -> CategoryCache:
+    return CATEGORY_CACHES.setdefault(str(DB_PATH), CategoryCache())
+
+
+# Entry columns returned by the timetrack writes, categories are stored as ids
+RETURNING_ENTRY = (
+    'RETURNING rowid, message, start, end, '
+    '(SELECT name FROM categories WHERE id = category_id)'
+)
+
+
+def insert_entry(cursor: sqlite3.Cursor, message: str, start: str, end: Optional[str], category: Optional[str]) -> Timetracker:
+    category_id = category_cache().get_id(cursor, category)
+    cursor.execute(
+        'INSERT INTO timetrack (message, start, end, category_id) '
+        'VALUES (?, ?, ?, ?) '
+        f'{RETURNING_ENTRY}',
+        (message, start, end, category_id)
+    )
+    row = cursor.fetchone()
+    return Timetracker.from_row(row)
+
+
+def end_entry(cursor: sqlite3.Cursor, rowid: int, end: str) -> Timetracker:
+    cursor.execute(
+        'UPDATE timetrack SET end = ? WHERE rowid = ? '
+        f'{RETURNING_ENTRY}',
+        (end, rowid)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        raise CommandError(f'No row with id {rowid} found')
+    return Timetracker.from_row(row)
+
+
+def update_entry(cursor: sqlite3.Cursor, rowid: int, fields: dict) -> Timetracker:
+    if 'category' in fields:
+        fields = dict(fields)
+        fields['category_id'] = category_cache().get_id(cursor, fields.pop('category'))
+    update = ', '.join(f'{k} = ?' for k in fields)
+    values = [v for v in fields.values()]
+    values.append(rowid)
+    cursor.execute(
+        f'UPDATE timetrack SET {update} WHERE rowid = ? '
+        f'{RETURNING_ENTRY}',
+        values
+    )
+    row = cursor.fetchone()
+    if row is None:
+        raise CommandError(f'No row with id {rowid} found')
+    return Timetracker.from_row(row)
+
+
+def delete_entry(cursor: sqlite3.Cursor, rowid: int) -> int:
+    cursor.execute('DELETE FROM timetrack WHERE rowid = ?', (rowid,))
+    return cursor.rowcount
+
+
+def migrate_initial(cursor: sqlite3.Cursor):
     cursor.execute(
         "CREATE TABLE IF NOT EXISTS timetrack ("
         "  start DATETIME NOT NULL,"
@@ -107,269 +340,2007 @@ def command_setup(args: CommandSetup):
     cursor.execute(
         "CREATE UNIQUE INDEX IF NOT EXISTS timetrack_start_message ON timetrack (start, message)"
     )
-    cursor.execute('pragma encoding')
 
 
-class CommandStart(argparse.Namespace):
-    message: str
-    category: Optional[str]
-    start: Optional[str]
-    end: Optional[str]
+def migrate_search_index(cursor: sqlite3.Cursor):
+    # External content FTS5 table: only the index is stored, the text is read
+    # back from timetrack. The triggers keep it in sync on every write.
+    cursor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS timetrack_fts USING fts5("
+        "  message, content='timetrack', content_rowid='rowid'"
+        ")"
+    )
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS timetrack_fts_insert AFTER INSERT ON timetrack BEGIN"
+        "  INSERT INTO timetrack_fts (rowid, message) VALUES (new.rowid, new.message);"
+        " END"
+    )
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS timetrack_fts_delete AFTER DELETE ON timetrack BEGIN"
+        "  INSERT INTO timetrack_fts (timetrack_fts, rowid, message) VALUES ('delete', old.rowid, old.message);"
+        " END"
+    )
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS timetrack_fts_update AFTER UPDATE OF message ON timetrack BEGIN"
+        "  INSERT INTO timetrack_fts (timetrack_fts, rowid, message) VALUES ('delete', old.rowid, old.message);"
+        "  INSERT INTO timetrack_fts (rowid, message) VALUES (new.rowid, new.message);"
+        " END"
+    )
+    cursor.execute("INSERT INTO timetrack_fts (timetrack_fts) VALUES ('rebuild')")
 
 
-def command_start(args: CommandStart):
-    "Start a new time tracking entry"
-    start = datetime.now().strftime(DB_DATE_FORMAT)
-    end = None
-    if args.start is not None:
-        start = parse_date_or_throw('start', args.start)
-        start = start.strftime(DB_DATE_FORMAT)
+# Upper bound of the interval index for entries that are still running
+OPEN_INTERVAL_END = 253402300799  # 9999-12-31T23:59:59Z
 
-    if end is not None:
-        end = parse_date_or_throw('end', args.end)
-        end = end.strftime(DB_DATE_FORMAT)
 
-    connection = sqlite3.connect(DB_PATH)
-    cursor = get_cursor(connection)
+def migrate_interval_index(cursor: sqlite3.Cursor):
+    # One dimensional R*Tree over (start, end) as unix seconds. The R*Tree
+    # stores 32 bit floats rounded outwards, so it returns a superset of the
+    # matches that queries refine with the exact dates.
     cursor.execute(
-        'INSERT INTO timetrack (message, start, end, category) '
-        'VALUES (?, ?, ?, ?) '
-        'RETURNING rowid, message, start, end, category',
-        (args.message, start, end, args.category)
+        "CREATE VIRTUAL TABLE IF NOT EXISTS timetrack_intervals USING rtree("
+        "  id, start_at, end_at"
+        ")"
+    )
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS timetrack_intervals_insert AFTER INSERT ON timetrack BEGIN"
+        "  INSERT INTO timetrack_intervals (id, start_at, end_at) VALUES ("
+        "    new.rowid, strftime('%s', new.start),"
+        f"    coalesce(strftime('%s', new.end), {OPEN_INTERVAL_END})"
+        "  );"
+        " END"
+    )
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS timetrack_intervals_update AFTER UPDATE OF start, end ON timetrack BEGIN"
+        "  UPDATE timetrack_intervals SET"
+        "    start_at = strftime('%s', new.start),"
+        f"    end_at = coalesce(strftime('%s', new.end), {OPEN_INTERVAL_END})"
+        "  WHERE id = new.rowid;"
+        " END"
+    )
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS timetrack_intervals_delete AFTER DELETE ON timetrack BEGIN"
+        "  DELETE FROM timetrack_intervals WHERE id = old.rowid;"
+        " END"
+    )
+    cursor.execute(
+        "INSERT INTO timetrack_intervals (id, start_at, end_at) "
+        "SELECT rowid, strftime('%s', start), "
+        f"coalesce(strftime('%s', end), {OPEN_INTERVAL_END}) "
+        "FROM timetrack"
     )
-    row = cursor.fetchone()
-    entity = Timetracker.from_row(row)
-    connection.commit()
-    connection.close()
-    entity.show()
-
 
-class CommandStartIn(argparse.Namespace):
-    id: int
-    message: str
-    category: Optional[str]
 
+def migrate_running_entries(cursor: sqlite3.Cursor):
+    # Copy of the running entries, so status and 'end --last' never touch
+    # timetrack. Triggers update it in the same transaction as each write.
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS timetrack_running ("
+        "  id INTEGER PRIMARY KEY,"
+        "  message TEXT NOT NULL,"
+        "  start DATETIME NOT NULL,"
+        "  category TEXT"
+        ")"
+    )
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS timetrack_running_insert AFTER INSERT ON timetrack"
+        " WHEN new.end IS NULL BEGIN"
+        "  INSERT INTO timetrack_running (id, message, start, category)"
+        "  VALUES (new.rowid, new.message, new.start, new.category);"
+        " END"
+    )
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS timetrack_running_update AFTER UPDATE ON timetrack BEGIN"
+        "  DELETE FROM timetrack_running WHERE id = old.rowid;"
+        "  INSERT INTO timetrack_running (id, message, start, category)"
+        "  SELECT new.rowid, new.message, new.start, new.category WHERE new.end IS NULL;"
+        " END"
+    )
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS timetrack_running_delete AFTER DELETE ON timetrack BEGIN"
+        "  DELETE FROM timetrack_running WHERE id = old.rowid;"
+        " END"
+    )
+    cursor.execute(
+        "INSERT INTO timetrack_running (id, message, start, category) "
+        "SELECT rowid, message, start, category FROM timetrack WHERE end IS NULL"
+    )
 
-def command_start_in(args):
-    "Start a new time tracking entry in the end of other entry"
 
-    connection = sqlite3.connect(DB_PATH)
-    cursor = get_cursor(connection)
+def refresh_running_entries(cursor: sqlite3.Cursor):
+    cursor.execute('DELETE FROM timetrack_running')
     cursor.execute(
-        'SELECT end FROM timetrack WHERE rowid = ?',
-        (args.id,)
+        'INSERT INTO timetrack_running (id, message, start, category) '
+        'SELECT rowid, message, start, category FROM timetrack_entries WHERE end IS NULL'
     )
-    row = cursor.fetchone()
-    if row is None:
-        raise CommandError(f'No row with id {args.id} found')
 
-    if row[0] is None:
-        raise CommandError(f'Row with id {args.id} is still running')
 
+def migrate_change_log(cursor: sqlite3.Cursor):
+    # Append only log of the ids written, 'seq' is the sync token given to
+    # 'export --since'. Deleted entries are kept as tombstones.
     cursor.execute(
-        'INSERT INTO timetrack (message, start, end, category) '
-        'VALUES (?, ?, ?, ?) '
-        'RETURNING rowid, message, start, end, category',
-        (args.message, row[0], None, args.category)
+        "CREATE TABLE IF NOT EXISTS timetrack_changes ("
+        "  seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "  entry_id INTEGER NOT NULL,"
+        "  op TEXT NOT NULL,"
+        "  changed_at DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%SZ', 'now'))"
+        ")"
+    )
+    for op, event, ref in [('insert', 'INSERT', 'new'), ('update', 'UPDATE', 'new'), ('delete', 'DELETE', 'old')]:
+        cursor.execute(
+            f"CREATE TRIGGER IF NOT EXISTS timetrack_changes_{op} AFTER {event} ON timetrack BEGIN"
+            f"  INSERT INTO timetrack_changes (entry_id, op) VALUES ({ref}.rowid, '{op}');"
+            " END"
+        )
+    cursor.execute(
+        "INSERT INTO timetrack_changes (entry_id, op) "
+        "SELECT rowid, 'insert' FROM timetrack ORDER BY rowid"
     )
-    row = cursor.fetchone()
-    entity = Timetracker.from_row(row)
-    connection.commit()
-    connection.close()
-    entity.show()
 
 
-class CommandEnd(argparse.Namespace):
-    id: int
-    end: Optional[str]
+def migrate_categories(cursor: sqlite3.Cursor):
+    # Categories move to their own table, timetrack keeps an integer id. The
+    # triggers reading the column are dropped while it is rewritten, so the
+    # rewrite is not logged as a change of every entry.
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS categories ("
+        "  id INTEGER PRIMARY KEY,"
+        "  name TEXT NOT NULL UNIQUE"
+        ")"
+    )
+    cursor.execute("DROP TRIGGER IF EXISTS timetrack_running_insert")
+    cursor.execute("DROP TRIGGER IF EXISTS timetrack_running_update")
+    cursor.execute("DROP TRIGGER IF EXISTS timetrack_changes_update")
+    cursor.execute(
+        "ALTER TABLE timetrack ADD COLUMN category_id INTEGER REFERENCES categories (id)"
+    )
+    cursor.execute(
+        "INSERT OR IGNORE INTO categories (name) "
+        "SELECT DISTINCT category FROM timetrack WHERE category IS NOT NULL ORDER BY category"
+    )
+    cursor.execute(
+        "UPDATE timetrack SET category_id = (SELECT id FROM categories WHERE name = category) "
+        "WHERE category IS NOT NULL"
+    )
+    cursor.execute("ALTER TABLE timetrack DROP COLUMN category")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS timetrack_category ON timetrack (category_id)"
+    )
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS timetrack_running_insert AFTER INSERT ON timetrack"
+        " WHEN new.end IS NULL BEGIN"
+        "  INSERT INTO timetrack_running (id, message, start, category)"
+        "  VALUES (new.rowid, new.message, new.start,"
+        "    (SELECT name FROM categories WHERE id = new.category_id));"
+        " END"
+    )
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS timetrack_running_update AFTER UPDATE ON timetrack BEGIN"
+        "  DELETE FROM timetrack_running WHERE id = old.rowid;"
+        "  INSERT INTO timetrack_running (id, message, start, category)"
+        "  SELECT new.rowid, new.message, new.start,"
+        "    (SELECT name FROM categories WHERE id = new.category_id)"
+        "  WHERE new.end IS NULL;"
+        " END"
+    )
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS timetrack_changes_update AFTER UPDATE ON timetrack BEGIN"
+        "  INSERT INTO timetrack_changes (entry_id, op) VALUES (new.rowid, 'update');"
+        " END"
+    )
+    # Entries with their category name, for the read paths
+    cursor.execute(
+        "CREATE VIEW IF NOT EXISTS timetrack_entries AS"
+        " SELECT t.rowid AS rowid, t.start, t.message, t.end, c.name AS category"
+        " FROM timetrack t LEFT JOIN categories c ON c.id = t.category_id"
+    )
 
 
-def command_end(args: CommandEnd):
-    "End a time tracking entry"
-    end = datetime.now().strftime(DB_DATE_FORMAT)
-    if args.end is not None:
-        end = parse_date_or_throw('end', args.end)
-        end = end.strftime(DB_DATE_FORMAT)
+def migrate_change_log_entry_index(cursor: sqlite3.Cursor):
+    # Last change of an entry, used by sync to pick the newer side
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS timetrack_changes_entry ON timetrack_changes (entry_id, changed_at)"
+    )
 
-    connection = sqlite3.connect(DB_PATH)
-    cursor = get_cursor(connection)
+
+def migrate_meta(cursor: sqlite3.Cursor):
+    # Database wide settings and the progress of the long running repairs
     cursor.execute(
-        'UPDATE timetrack SET end = ? WHERE rowid = ? '
-        'RETURNING rowid, message, start, end, category',
-        (end, args.id)
+        "CREATE TABLE IF NOT EXISTS meta ("
+        "  key TEXT PRIMARY KEY,"
+        "  value TEXT NOT NULL"
+        ") WITHOUT ROWID"
     )
-    row = cursor.fetchone()
-    entity = Timetracker.from_row(row)
-    connection.commit()
-    connection.close()
-    entity.show()
+    cursor.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('encoding_repaired_rowid', '0')")
 
 
-class CommandDrop(argparse.Namespace):
-    id: Optional[int]
-    all: bool
+def migrate_rules(cursor: sqlite3.Cursor):
+    # Alert rules, see 'add-rule'. The triggers keep the total of the ended
+    # entries per daily rule and day, entries count on the day they start,
+    # so a write updates one row per rule instead of summing timetrack again.
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS rules ("
+        "  id INTEGER PRIMARY KEY,"
+        "  name TEXT NOT NULL UNIQUE,"
+        "  kind TEXT NOT NULL CHECK (kind IN ('daily', 'running')),"
+        "  category_id INTEGER REFERENCES categories (id),"
+        "  threshold INTEGER NOT NULL"
+        ")"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS rule_totals ("
+        "  day TEXT NOT NULL,"
+        "  rule_id INTEGER NOT NULL REFERENCES rules (id),"
+        "  seconds INTEGER NOT NULL,"
+        "  PRIMARY KEY (day, rule_id)"
+        ") WITHOUT ROWID"
+    )
+    add = (
+        "  INSERT INTO rule_totals (day, rule_id, seconds)"
+        "  SELECT substr(new.start, 1, 10), id,"
+        "    CAST(round((julianday(new.end) - julianday(new.start)) * 86400) AS INTEGER)"
+        "  FROM rules WHERE new.end IS NOT NULL AND kind = 'daily'"
+        "    AND (category_id IS NULL OR category_id = new.category_id)"
+        "  ON CONFLICT (day, rule_id) DO UPDATE SET seconds = seconds + excluded.seconds;"
+    )
+    subtract = (
+        "  UPDATE rule_totals SET seconds = seconds -"
+        "    CAST(round((julianday(old.end) - julianday(old.start)) * 86400) AS INTEGER)"
+        "  WHERE old.end IS NOT NULL AND day = substr(old.start, 1, 10) AND rule_id IN ("
+        "    SELECT id FROM rules WHERE kind = 'daily'"
+        "    AND (category_id IS NULL OR category_id = old.category_id));"
+    )
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS rule_totals_insert AFTER INSERT ON timetrack BEGIN{add} END")
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS rule_totals_update AFTER UPDATE OF start, end, category_id ON timetrack"
+        f" BEGIN{subtract}{add} END"
+    )
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS rule_totals_delete AFTER DELETE ON timetrack BEGIN{subtract} END")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS timetrack_running_start ON timetrack_running (start)"
+    )
 
 
-def command_drop(args: CommandDrop):
-    "Drop a time tracking entry"
-    if args.id is None and not args.all:
-        raise CommandError('No id given')
+def migrate_monotonic_rowids(cursor: sqlite3.Cursor):
+    # Without AUTOINCREMENT SQLite hands out the rowid of the last entry again
+    # once it is archived or dropped, which mixes up archived entries, the
+    # change log and the working set. The table is rebuilt with the same
+    # rowids, its indexes, triggers and the views reading it are created
+    # again as they were.
+    cursor.execute(
+        "SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL "
+        "AND (tbl_name = 'timetrack' AND type IN ('index', 'trigger') OR type = 'view')"
+    )
+    schema = cursor.fetchall()
+    for kind, name, _ in schema:
+        if kind == 'view':
+            # Renaming the rebuilt table fails while a view reads a missing table
+            cursor.execute(f'DROP VIEW {name}')
+    cursor.execute(
+        "CREATE TABLE timetrack_rebuilt ("
+        "  id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "  start DATETIME NOT NULL,"
+        "  message TEXT NOT NULL,"
+        "  end DATETIME,"
+        "  category_id INTEGER REFERENCES categories (id)"
+        ")"
+    )
+    cursor.execute(
+        "INSERT INTO timetrack_rebuilt (id, start, message, end, category_id) "
+        "SELECT rowid, start, message, end, category_id FROM timetrack"
+    )
+    cursor.execute("DROP TABLE timetrack")
+    cursor.execute("ALTER TABLE timetrack_rebuilt RENAME TO timetrack")
+    # The change log still holds the rowids of entries archived or dropped so far
+    cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'timetrack'")
+    cursor.execute(
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'timetrack', max("
+        "  (SELECT coalesce(max(rowid), 0) FROM timetrack),"
+        "  (SELECT coalesce(max(entry_id), 0) FROM timetrack_changes))"
+    )
+    for _, _, sql in schema:
+        cursor.execute(sql)
+
+
+# Applied in order, the database 'user_version' is the number of applied migrations
+MIGRATIONS = [
+    migrate_initial,
+    migrate_search_index,
+    migrate_interval_index,
+    migrate_running_entries,
+    migrate_change_log,
+    migrate_categories,
+    migrate_change_log_entry_index,
+    migrate_meta,
+    migrate_rules,
+    migrate_monotonic_rowids,
+]
+
+ENCODING_REPAIR_BATCH = 5000
+
+
+def repair_message(message: str) -> str:
+    "Message decoded back from the latin-1 mojibake of old imports, or as is"
+    try:
+        return message.encode('latin-1').decode(DATA_ENCODING)
+    except UnicodeError:
+        return message
+
+
+def repair_encoding(connection: sqlite3.Connection, batch_size: int = ENCODING_REPAIR_BATCH) -> int:
+    "Fix the mis-encoded messages once and mark the database clean, returns the rows fixed"
+    # Each batch of rowids is its own transaction and stores how far it got,
+    # so an interrupted repair resumes where it stopped. Only messages with
+    # non ASCII characters can be mojibake, the GLOB skips all the others.
+    cursor = get_cursor(connection)
+    cursor.execute("SELECT value FROM meta WHERE key = 'encoding_repaired_rowid'")
+    row = cursor.fetchone()
+    if row is None:
+        return 0
+    done = int(row[0])
+    cursor.execute('SELECT coalesce(max(rowid), 0) FROM timetrack')
+    last = cursor.fetchone()[0]
+    fixed = 0
+    while True:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute(
+            "SELECT rowid, message FROM timetrack "
+            "WHERE rowid > ? AND rowid <= ? AND message GLOB '*[^ -~]*'",
+            (done, done + batch_size)
+        )
+        for rowid, message in cursor.fetchall():
+            repaired = repair_message(message)
+            if repaired == message:
+                continue
+            try:
+                cursor.execute('UPDATE timetrack SET message = ? WHERE rowid = ?', (repaired, rowid))
+            except sqlite3.IntegrityError:
+                cursor.execute(
+                    'SELECT other.rowid, other.end IS this.end AND other.category_id IS this.category_id '
+                    'FROM timetrack AS this JOIN timetrack AS other '
+                    'ON other.start = this.start AND other.message = ? WHERE this.rowid = ?',
+                    (repaired, rowid)
+                )
+                other, same = cursor.fetchone()
+                if not same:
+                    # Two different entries, removing either one would lose data
+                    print(f'Entry {rowid} left mis-encoded, entry {other} has the same start and message')
+                    continue
+                # The same entry was imported again with the right encoding
+                cursor.execute('DELETE FROM timetrack WHERE rowid = ?', (rowid,))
+            fixed += 1
+        done += batch_size
+        if done < last:
+            cursor.execute(
+                "UPDATE meta SET value = ? WHERE key = 'encoding_repaired_rowid'", (str(done),))
+            cursor.execute('COMMIT')
+            continue
+        # Entries are only written as str from here on, they stay clean
+        cursor.execute("DELETE FROM meta WHERE key = 'encoding_repaired_rowid'")
+        cursor.execute(
+            "INSERT INTO meta (key, value) VALUES ('encoding', ?)", (DATA_ENCODING,))
+        cursor.execute('COMMIT')
+        return fixed
 
-    if args.all:
-        print('Deleting all')
-        connection = sqlite3.connect(DB_PATH)
-        cursor = get_cursor(connection)
-        cursor.execute('DELETE FROM timetrack')
-        count = cursor.rowcount
-        connection.commit()
-        connection.close()
-        print(f'Deleted {count} rows')
-    else:
-        print('Deleting', args.id)
-        connection = sqlite3.connect(DB_PATH)
-        cursor = get_cursor(connection)
-        cursor.execute('DELETE FROM timetrack WHERE rowid = ?', (args.id,))
-        count = cursor.rowcount
-        connection.commit()
-        connection.close()
-        print(f'Deleted {count} rows')
 
+def migrate(connection: sqlite3.Connection):
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    cursor = get_cursor(connection)
+    cursor.execute('PRAGMA user_version')
+    current = cursor.fetchone()[0]
+    for version, migration in enumerate(MIGRATIONS[current:], start=current + 1):
+        cursor.execute('BEGIN')
+        migration(cursor)
+        cursor.execute(f'PRAGMA user_version = {version}')
+        cursor.execute('COMMIT')
+    repair_encoding(connection)
+    connection.isolation_level = isolation_level
 
-class CommandEdit(argparse.Namespace):
-    id: int
-    message: Optional[str]
-    category: Optional[str]
-    start: Optional[str]
-    end: Optional[str]
 
+class CommandSetup(argparse.Namespace):
+    database_path: str = DB_PATH
 
-def command_edit(args):
-    "Edit a time tracking entry"
-    connection = sqlite3.connect(DB_PATH)
-    cursor = get_cursor(connection)
-    cursor.execute('SELECT * FROM timetrack WHERE rowid = ?', (args.id,))
-    row = cursor.fetchone()
-    if row is None:
-        raise CommandError(f'No row with id {args.id} found')
 
-    fields = {'message': args.message, 'category': args.category,
-              'start': args.start, 'end': args.end}
-    fields = {k: v for k, v in fields.items() if v is not UNSET}
-    if 'start' in fields:
-        fields['start'] = parse_date_or_throw('start', fields['start'])
-        fields['start'] = fields['start'].strftime(DB_DATE_FORMAT)
-    if 'end' in fields:
-        fields['end'] = parse_date_or_throw('end', fields['end'])
-        fields['end'] = fields['end'].strftime(DB_DATE_FORMAT)
-    if not fields:
-        print('No changes given')
-        return
+def configure_database(connection: sqlite3.Connection):
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA auto_vacuum')
+    if cursor.fetchone()[0] != 2:
+        # Only takes effect on an existing database after a VACUUM
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+    # Readers do not block the writer, so maintenance can run alongside commands
+    cursor.execute('PRAGMA journal_mode = WAL')
 
-    update = ', '.join(f'{k} = ?' for k in fields)
-    values = [v for v in fields.values()]
-    values.append(args.id)
-    cursor.execute(
-        f'UPDATE timetrack SET {update} WHERE rowid = ? '
-        'RETURNING rowid, message, start, end, category',
-        values
-    )
-    row = cursor.fetchone()
-    entity = Timetracker.from_row(row)
-    connection.commit()
+
+def command_setup(args: CommandSetup):
+    "Setup the database"
+    path = Path(args.database_path or DB_PATH)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(path)
+    configure_database(connection)
+    migrate(connection)
     connection.close()
-    entity.show()
 
 
-class CommandList(argparse.Namespace):
-    start: Optional[str]
+class CommandMaintain(argparse.Namespace):
+    budget: float
+    vacuum_pages: int
 
 
-def command_list(args: CommandList):
-    "List time tracking entries"
-    # TODO: Add ms formatter
-    if args.start is None:
-        start = datetime.now() - timedelta(hours=48)
-        start = start.strftime(DB_DATE_FORMAT)
-    elif args.start != 'all':
-        start = parse_date_or_throw('start', args.start)
-        start = start.strftime(DB_DATE_FORMAT)
-    else:
-        start = None
+def database_pages(cursor: sqlite3.Cursor) -> tuple:
+    "Page size, page count and free pages of the main database"
+    values = []
+    for pragma in ('page_size', 'page_count', 'freelist_count'):
+        cursor.execute(f'PRAGMA {pragma}')
+        values.append(cursor.fetchone()[0])
+    return tuple(values)
+
 
-    connection = sqlite3.connect(DB_PATH)
+def command_maintain(args: CommandMaintain):
+    "Optimize, analyze, vacuum, checkpoint and check the database within a time budget"
+    # Every step is a short transaction of its own, and the incremental vacuum
+    # frees a few pages at a time, so concurrent commands only wait briefly.
+    began = time.monotonic()
+    deadline = began + args.budget
+    connection = connect(isolation_level=None)
     cursor = get_cursor(connection)
+    page_size, pages_before, free_before = database_pages(cursor)
+
+    def vacuum():
+        cursor.execute('PRAGMA auto_vacuum')
+        if cursor.fetchone()[0] != 2:
+            return 'auto_vacuum is not incremental, run setup'
+        freed = 0
+        while time.monotonic() < deadline:
+            free = database_pages(cursor)[2]
+            if free == 0:
+                break
+            cursor.execute(f'PRAGMA incremental_vacuum({args.vacuum_pages})')
+            cursor.fetchall()
+            freed += min(free, args.vacuum_pages)
+        return f'{freed} pages freed'
+
+    def checkpoint():
+        cursor.execute('PRAGMA wal_checkpoint(PASSIVE)')
+        busy, frames, checkpointed = cursor.fetchone()
+        return f'{checkpointed} of {frames} frames checkpointed'
+
+    def quick_check():
+        cursor.execute('PRAGMA quick_check')
+        return ', '.join(row[0] for row in cursor.fetchall())
+
+    def analyze():
+        cursor.execute('PRAGMA analysis_limit = 1000')
+        cursor.execute('ANALYZE')
+        return 'ok'
+
+    def optimize():
+        cursor.execute('PRAGMA optimize')
+        return 'ok'
+
+    steps = [
+        ('optimize', optimize),
+        ('analyze', analyze),
+        ('vacuum', vacuum),
+        ('checkpoint', checkpoint),
+        ('quick_check', quick_check),
+    ]
+    for name, step in steps:
+        if time.monotonic() >= deadline:
+            print(f'{name}: skipped, out of time budget')
+            continue
+        step_began = time.monotonic()
+        result = step()
+        print(f'{name}: {result} ({time.monotonic() - step_began:.2f}s)')
+
+    _, pages_after, free_after = database_pages(cursor)
+    connection.close()
+    reclaimed = (pages_before - pages_after) * page_size
+    print(f'Reclaimed {reclaimed} bytes, {free_after} free pages left '
+          f'in {time.monotonic() - began:.2f}s')
 
-    rowid_len = 0
-    cursor.execute('SELECT MAX(rowid) FROM timetrack')
-    row = cursor.fetchone()
-    if row:
-        rowid_len = len(str(row[0]))
 
-    if start:
+class CommandBackup(argparse.Namespace):
+    path: str
+    pages: int = 256
+    sleep: float = 0.005
+    compress: bool = False
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def backup_database(source: sqlite3.Connection, path: Path, pages: int, sleep: float) -> int:
+    "Copy 'source' to 'path' in steps of 'pages', sleeping between steps"
+    copied = 0
+
+    def progress(status, remaining, total):
+        nonlocal copied
+        copied = total
+        if remaining:
+            # Connection.backup only sleeps when the source is busy, so give
+            # writers a window between every step
+            time.sleep(sleep)
+
+    # Pin one WAL snapshot for the whole copy: otherwise every write from
+    # another connection restarts the backup, which never finishes while
+    # the tracker is in use. Writers are not blocked by the open read.
+    source.isolation_level = None
+    source.execute('BEGIN')
+    source.execute('SELECT count(*) FROM sqlite_master').fetchone()
+    target = sqlite3.connect(path)
+    try:
+        source.backup(target, pages=pages, progress=progress)
+    finally:
+        target.close()
+        source.execute('COMMIT')
+    return copied
+
+
+def command_backup(args: CommandBackup):
+    "Take a consistent snapshot of the live database"
+    # Archives are read only once written, so they are copied as plain files
+    path = Path(args.path)
+    partial = path.with_name(path.name + '.partial')
+    partial.unlink(missing_ok=True)
+    began = time.monotonic()
+    connection = connect()
+    try:
+        copied = backup_database(connection, partial, args.pages, args.sleep)
+    finally:
+        connection.close()
+    if args.compress:
+        with open(partial, 'rb') as src, open(path, 'wb') as dst:
+            compressor = zlib.compressobj(wbits=31)  # gzip container
+            while block := src.read(1 << 20):
+                dst.write(compressor.compress(block))
+            dst.write(compressor.flush())
+        partial.unlink()
+    else:
+        partial.replace(path)
+    print(f'Backed up {copied} pages to {path} in {time.monotonic() - began:.2f}s')
+
+
+class CommandRestore(argparse.Namespace):
+    path: str
+
+
+def command_restore(args: CommandRestore):
+    "Replace the live database with a verified backup"
+    path = Path(args.path)
+    if not path.exists():
+        raise CommandError(f'Backup {path} does not exist')
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == GZIP_MAGIC
+    source_path = path
+    if compressed:
+        source_path = Path(DB_PATH).with_name(Path(DB_PATH).name + '.restore')
+        with open(path, 'rb') as src, open(source_path, 'wb') as dst:
+            decompressor = zlib.decompressobj(wbits=31)
+            while block := src.read(1 << 20):
+                dst.write(decompressor.decompress(block))
+            dst.write(decompressor.flush())
+    try:
+        source = connect_readonly(source_path)
+        try:
+            cursor = source.cursor()
+            try:
+                cursor.execute('PRAGMA integrity_check')
+                problems = [row[0] for row in cursor.fetchall()]
+                cursor.execute('PRAGMA user_version')
+                version = cursor.fetchone()[0]
+            except sqlite3.DatabaseError as e:
+                raise CommandError(f'Backup {path} is not a database: {e}')
+            if problems != ['ok']:
+                raise CommandError(f'Backup {path} is corrupt: ' + '; '.join(problems))
+            if version > len(MIGRATIONS):
+                raise CommandError(f'Backup {path} is from a newer version ({version})')
+            connection = connect()
+            source.backup(connection)
+            migrate(connection)
+            connection.close()
+        finally:
+            source.close()
+    finally:
+        if compressed:
+            source_path.unlink()
+    category_cache().clear()
+    print(f'Restored {path} (schema version {version})')
+
+
+def rule_alerts(cursor: sqlite3.Cursor, now: str, day: str) -> list:
+    "Messages of the rules over their threshold, for the totals of 'day' and the running entries"
+    # Entries count on the day they start. The ended ones are summed in
+    # rule_totals by the timetrack triggers, running ones count until now.
+    cursor.execute(
+        'SELECT r.name, r.threshold, c.name, coalesce(t.seconds, 0) + coalesce(('
+        '  SELECT sum(CAST(round((julianday(:now) - julianday(e.start)) * 86400) AS INTEGER))'
+        '  FROM timetrack_running e LEFT JOIN categories ec ON ec.name = e.category'
+        "  WHERE e.start >= :day AND e.start < date(:day, '+1 day')"
+        '    AND (r.category_id IS NULL OR r.category_id = ec.id)'
+        '), 0) '
+        'FROM rules r LEFT JOIN rule_totals t ON t.rule_id = r.id AND t.day = :day '
+        'LEFT JOIN categories c ON c.id = r.category_id '
+        "WHERE r.kind = 'daily' "
+        'ORDER BY r.name',
+        {'now': now, 'day': day}
+    )
+    alerts = [
+        f'Alert {name}: {format_duration(timedelta(seconds=seconds))} of {category or "entries"} on {day}, '
+        f'over {format_duration(timedelta(seconds=threshold))}'
+        for name, threshold, category, seconds in cursor.fetchall() if seconds > threshold
+    ]
+    # One range of timetrack_running_start per rule, CROSS JOIN keeps the rules outside
+    cursor.execute(
+        'SELECT r.name, r.threshold, e.id, e.message,'
+        '  CAST(round((julianday(:now) - julianday(e.start)) * 86400) AS INTEGER) '
+        'FROM rules r '
+        "CROSS JOIN timetrack_running e ON e.start < strftime('%Y-%m-%dT%H:%M:%SZ', :now, -r.threshold || ' seconds') "
+        'LEFT JOIN categories c ON c.name = e.category '
+        "WHERE r.kind = 'running' AND (r.category_id IS NULL OR r.category_id = c.id) "
+        'ORDER BY e.start, r.name',
+        {'now': now}
+    )
+    alerts.extend(
+        f'Alert {name}: entry {rowid} "{message}" running for {format_duration(timedelta(seconds=seconds))}, '
+        f'over {format_duration(timedelta(seconds=threshold))}'
+        for name, threshold, rowid, message, seconds in cursor.fetchall()
+    )
+    return alerts
+
+
+def show_rule_alerts(entity: Timetracker):
+    "Print the alerts of the rules over their threshold after a write"
+    connection = connect_readonly(DB_PATH)
+    alerts = rule_alerts(connection.cursor(), datetime.now().strftime(DB_DATE_FORMAT), entity.start.strftime('%Y-%m-%d'))
+    connection.close()
+    for alert in alerts:
+        print(alert)
+
+
+class CommandStart(argparse.Namespace):
+    message: str
+    category: Optional[str]
+    start: Optional[str]
+    end: Optional[str]
+
+
+def command_start(args: CommandStart):
+    "Start a new time tracking entry"
+    start = datetime.now().strftime(DB_DATE_FORMAT)
+    end = None
+    if args.start is not None:
+        start = format_date_or_throw('start', args.start)
+
+    if args.end is not None:
+        end = format_date_or_throw('end', args.end)
+
+    entity = run_write(lambda cursor: insert_entry(cursor, args.message, start, end, args.category))
+    entity.show()
+    show_rule_alerts(entity)
+
+
+class CommandStartIn(argparse.Namespace):
+    id: int
+    message: str
+    category: Optional[str]
+
+
+def command_start_in(args):
+    "Start a new time tracking entry in the end of other entry"
+
+    def write(cursor):
         cursor.execute(
-            'SELECT rowid, message, start, end, category '
-            'FROM timetrack '
-            'WHERE start >= ? '
-            'ORDER BY start',
-            (start,)
+            'SELECT end FROM timetrack WHERE rowid = ?',
+            (args.id,)
         )
+        row = cursor.fetchone()
+        if row is None:
+            raise CommandError(f'No row with id {args.id} found')
+
+        if row[0] is None:
+            raise CommandError(f'Row with id {args.id} is still running')
+
+        return insert_entry(cursor, args.message, row[0], None, args.category)
+
+    entity = run_write(write)
+    entity.show()
+    show_rule_alerts(entity)
+
+
+def compile_entry_filter(args) -> Optional[tuple]:
+    "WHERE clause and values of the bulk filter options, None when no filter is given"
+    # Each predicate maps to an index: start bounds to timetrack_start, the
+    # category to timetrack_category, running entries to their cached ids.
+    # A LIKE on the message is only cheap combined with one of those.
+    where = []
+    values = []
+    if args.after is not None:
+        where.append('start >= ?')
+        values.append(format_date_or_throw('after', args.after))
+    if args.before is not None:
+        where.append('start < ?')
+        values.append(format_date_or_throw('before', args.before))
+    if args.filter_category is not None:
+        where.append('category_id = (SELECT id FROM categories WHERE name = ?)')
+        values.append(args.filter_category)
+    if args.running:
+        where.append(RUNNING_FILTER)
+    if args.message_like is not None:
+        where.append('message LIKE ?')
+        values.append(args.message_like)
+    if not where:
+        return None
+    return ' AND '.join(where), values
+
+
+RUNNING_FILTER = 'rowid IN (SELECT id FROM timetrack_running)'
+FULL_SCAN = re.compile(r'SCAN timetrack\b(?! USING)')
+
+
+def bulk_write(statement: str, where: str, values: list, dry_run: bool, set_values=lambda cursor: []) -> int:
+    "Run 'statement WHERE where' in one transaction, or explain it and count the matches"
+    sql = f'{statement} WHERE {where}'
+    if not dry_run:
+        def write(cursor):
+            cursor.execute(sql, set_values(cursor) + values)
+            return cursor.rowcount
+        return run_write(write)
+
+    connection = connect()
+    cursor = get_cursor(connection)
+    placeholders = [None] * (statement.count('?'))
+    cursor.execute(f'EXPLAIN QUERY PLAN {sql}', placeholders + values)
+    plan = [row[3] for row in cursor.fetchall()]
+    cursor.execute(f'SELECT count(*) FROM timetrack WHERE {where}', values)
+    count = cursor.fetchone()[0]
+    connection.close()
+    for detail in plan:
+        print(f'Plan: {detail}')
+    if any(FULL_SCAN.match(detail) for detail in plan):
+        print('Warning: no index matches the filter, every entry is scanned')
+    return count
+
+
+class CommandEnd(argparse.Namespace):
+    id: Optional[int]
+    end: Optional[str]
+    last: bool = False
+    before: Optional[str] = None
+    after: Optional[str] = None
+    filter_category: Optional[str] = None
+    message_like: Optional[str] = None
+    running: bool = False
+    dry_run: bool = False
+
+
+def end_last_entry(cursor: sqlite3.Cursor, end: str) -> Timetracker:
+    "End the most recently started running entry"
+    for attempt in range(2):
+        cursor.execute(
+            'SELECT id FROM timetrack_running ORDER BY start DESC LIMIT 1')
+        row = cursor.fetchone()
+        if row is None:
+            raise CommandError('No running entry found')
+        cursor.execute(
+            'UPDATE timetrack SET end = ? WHERE rowid = ? AND end IS NULL '
+            f'{RETURNING_ENTRY}',
+            (end, row[0])
+        )
+        row = cursor.fetchone()
+        if row is not None:
+            return Timetracker.from_row(row)
+        # The cached entry is gone or already ended, rebuild it and retry
+        refresh_running_entries(cursor)
+    raise CommandError('No running entry found')
+
+
+def command_end(args: CommandEnd):
+    "End a time tracking entry, or every running entry matching the filter options"
+    end = datetime.now().strftime(DB_DATE_FORMAT)
+    if args.end is not None:
+        end = format_date_or_throw('end', args.end)
+
+    if args.id is None and not args.last:
+        entry_filter = compile_entry_filter(args)
+        if entry_filter is None:
+            raise CommandError('No id given')
+        where, values = entry_filter
+        if not args.running:
+            where = f'{RUNNING_FILTER} AND {where}'
+        count = bulk_write('UPDATE timetrack SET end = ?', where, values, args.dry_run,
+                           lambda cursor: [end])
+        print(f'{"Would end" if args.dry_run else "Ended"} {count} entries')
+        return
+
+    if args.last:
+        entity = run_write(lambda cursor: end_last_entry(cursor, end))
     else:
+        entity = run_write(lambda cursor: end_entry(cursor, args.id, end))
+    entity.show()
+    show_rule_alerts(entity)
+
+
+class CommandStatus(argparse.Namespace):
+    verify: bool
+
+
+def command_status(args: CommandStatus):
+    "Show the running time tracking entries"
+    connection = connect()
+    cursor = get_cursor(connection)
+    if args.verify:
         cursor.execute(
-            'SELECT rowid, message, start, end, category '
-            'FROM timetrack '
-            'ORDER BY start'
+            'SELECT rowid FROM timetrack WHERE end IS NULL '
+            'EXCEPT SELECT id FROM timetrack_running'
+        )
+        missing = cursor.fetchall()
+        cursor.execute(
+            'SELECT id FROM timetrack_running '
+            'EXCEPT SELECT rowid FROM timetrack WHERE end IS NULL'
+        )
+        stale = cursor.fetchall()
+        if missing or stale:
+            print(f'Running entries cache is out of date '
+                  f'({len(missing)} missing, {len(stale)} stale), rebuilding')
+            refresh_running_entries(cursor)
+            connection.commit()
+
+    cursor.execute(
+        'SELECT id, message, start, NULL, category '
+        'FROM timetrack_running '
+        'ORDER BY start'
+    )
+    rows = cursor.fetchall()
+    connection.close()
+    if not rows:
+        print('Nothing running')
+    now = datetime.now()
+    rowid_len = max((len(str(row[0])) for row in rows), default=0)
+    for row in rows:
+        Timetracker.from_row(row).show(now, rowid_len)
+
+
+class CommandDrop(argparse.Namespace):
+    id: Optional[int]
+    all: bool
+    before: Optional[str] = None
+    after: Optional[str] = None
+    filter_category: Optional[str] = None
+    message_like: Optional[str] = None
+    running: bool = False
+    dry_run: bool = False
+
+
+def command_drop(args: CommandDrop):
+    "Drop a time tracking entry, or every entry matching the filter options"
+    entry_filter = compile_entry_filter(args) if args.id is None else None
+    if entry_filter is not None:
+        count = bulk_write('DELETE FROM timetrack', *entry_filter, args.dry_run)
+        print(f'{"Would delete" if args.dry_run else "Deleted"} {count} rows')
+        return
+
+    if args.id is None and not args.all:
+        raise CommandError('No id given')
+
+    if args.all:
+        print('Deleting all')
+
+        def write(cursor):
+            cursor.execute('DELETE FROM timetrack')
+            return cursor.rowcount
+
+        count = run_write(write)
+        print(f'Deleted {count} rows')
+    else:
+        print('Deleting', args.id)
+        count = run_write(lambda cursor: delete_entry(cursor, args.id))
+        print(f'Deleted {count} rows')
+
+
+class CommandEdit(argparse.Namespace):
+    id: Optional[int]
+    message: Optional[str]
+    category: Optional[str]
+    start: Optional[str]
+    end: Optional[str]
+    before: Optional[str] = None
+    after: Optional[str] = None
+    filter_category: Optional[str] = None
+    message_like: Optional[str] = None
+    running: bool = False
+    dry_run: bool = False
+
+
+def command_edit(args):
+    "Edit a time tracking entry, or every entry matching the filter options"
+    fields = {'message': args.message, 'category': args.category,
+              'start': args.start, 'end': args.end}
+    fields = {k: v for k, v in fields.items() if v is not UNSET}
+    if 'start' in fields:
+        fields['start'] = format_date_or_throw('start', fields['start'])
+    if 'end' in fields:
+        fields['end'] = format_date_or_throw('end', fields['end'])
+    if not fields:
+        print('No changes given')
+        return
+
+    if args.id is None:
+        entry_filter = compile_entry_filter(args)
+        if entry_filter is None:
+            raise CommandError('No id given')
+
+        def set_values(cursor):
+            if 'category' in fields:
+                return [category_cache().get_id(cursor, value) if key == 'category' else value
+                        for key, value in fields.items()]
+            return list(fields.values())
+
+        columns = ', '.join(f'{"category_id" if key == "category" else key} = ?' for key in fields)
+        count = bulk_write(f'UPDATE timetrack SET {columns}', *entry_filter, args.dry_run, set_values)
+        print(f'{"Would update" if args.dry_run else "Updated"} {count} rows')
+        return
+
+    def write(cursor):
+        cursor.execute('SELECT * FROM timetrack WHERE rowid = ?', (args.id,))
+        row = cursor.fetchone()
+        if row is None:
+            raise CommandError(f'No row with id {args.id} found')
+        return update_entry(cursor, args.id, fields)
+
+    entity = run_write(write)
+    entity.show()
+    show_rule_alerts(entity)
+
+
+class CommandAddRule(argparse.Namespace):
+    name: str
+    kind: str
+    threshold: str
+    category: Optional[str] = None
+
+
+def command_add_rule(args: CommandAddRule):
+    "Add an alert rule: a daily total or a running entry over a threshold such as 8h or 90m"
+    threshold = parse_duration(args.threshold)
+
+    def write(cursor):
+        category_id = category_cache().get_id(cursor, args.category)
+        try:
+            cursor.execute(
+                'INSERT INTO rules (name, kind, category_id, threshold) VALUES (?, ?, ?, ?)',
+                (args.name, args.kind, category_id, threshold)
+            )
+        except sqlite3.IntegrityError:
+            raise CommandError(f'A rule named {args.name} already exists')
+        if args.kind == 'daily':
+            # Totals of the existing entries, the triggers keep them from here on
+            cursor.execute(
+                'INSERT INTO rule_totals (day, rule_id, seconds) '
+                'SELECT substr(start, 1, 10), ?,'
+                '  sum(CAST(round((julianday(end) - julianday(start)) * 86400) AS INTEGER)) '
+                'FROM timetrack WHERE end IS NOT NULL AND (? IS NULL OR category_id = ?) '
+                'GROUP BY 1',
+                (cursor.lastrowid, category_id, category_id)
+            )
+
+    run_write(write)
+    print(f'Added rule {args.name}')
+
+
+class CommandDropRule(argparse.Namespace):
+    name: str
+
+
+def command_drop_rule(args: CommandDropRule):
+    "Delete an alert rule"
+    def write(cursor):
+        cursor.execute('DELETE FROM rule_totals WHERE rule_id IN (SELECT id FROM rules WHERE name = ?)',
+                       (args.name,))
+        cursor.execute('DELETE FROM rules WHERE name = ?', (args.name,))
+        return cursor.rowcount
+
+    if not run_write(write):
+        raise CommandError(f'No rule named {args.name} found')
+    print(f'Deleted rule {args.name}')
+
+
+class CommandCheckRules(argparse.Namespace):
+    pass
+
+
+def command_check_rules(args: CommandCheckRules):
+    "Show the rules over their threshold today and for the running entries"
+    now = datetime.now().strftime(DB_DATE_FORMAT)
+    connection = connect()
+    cursor = get_cursor(connection)
+    alerts = rule_alerts(cursor, now, now[:10])
+    connection.close()
+    for alert in alerts:
+        print(alert)
+    if not alerts:
+        print('No rule is over its threshold')
+
+
+def archive_directory(database: Optional[Path] = None) -> Path:
+    path = Path(DB_PATH if database is None else database)
+    return path.with_name(f'{path.stem}-archive')
+
+
+def archive_path(year: str) -> Path:
+    return archive_directory() / f'{year}.db'
+
+
+def archive_years(start: Optional[str] = None, end: Optional[str] = None) -> list:
+    "Years of the archive databases holding entries that started in the [start, end] range"
+    directory = archive_directory()
+    if not directory.is_dir():
+        return []
+    years = sorted(path.stem for path in directory.glob('[0-9][0-9][0-9][0-9].db'))
+    return [year for year in years
+            if (start is None or year >= start[:4]) and (end is None or year <= end[:4])]
+
+
+def create_archive_schema(cursor: sqlite3.Cursor, schema: str):
+    cursor.execute(
+        f"CREATE TABLE IF NOT EXISTS {schema}.timetrack ("
+        "  start DATETIME NOT NULL,"
+        "  message TEXT NOT NULL,"
+        "  end DATETIME,"
+        "  category TEXT"
+        ")"
+    )
+    cursor.execute(
+        f"CREATE INDEX IF NOT EXISTS {schema}.timetrack_start ON timetrack (start DESC)"
+    )
+    cursor.execute(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {schema}.timetrack_start_message ON timetrack (start, message)"
+    )
+
+
+# Rows per compressed archive block
+ARCHIVE_BLOCK_ROWS = 1024
+
+
+def create_archive_blocks(cursor: sqlite3.Cursor, schema: str):
+    cursor.execute(
+        f"CREATE TABLE IF NOT EXISTS {schema}.timetrack_blocks ("
+        "  first_start TEXT NOT NULL,"
+        "  last_start TEXT NOT NULL,"
+        "  rows INTEGER NOT NULL,"
+        "  data BLOB NOT NULL"
+        ")"
+    )
+    cursor.execute(
+        f"CREATE INDEX IF NOT EXISTS {schema}.timetrack_blocks_start "
+        "ON timetrack_blocks (first_start, last_start)"
+    )
+
+
+def iter_archive_blocks(cursor: sqlite3.Cursor, schema: str, start: Optional[str] = None, end: Optional[str] = None):
+    "Yield the (rowid, start, message, end, category) rows of the blocks overlapping [start, end]"
+    cursor.execute(
+        f'SELECT data FROM {schema}.timetrack_blocks '
+        'WHERE last_start >= ? AND first_start <= ? '
+        'ORDER BY first_start',
+        (start or '', end or '9999')
+    )
+    for data, in cursor.fetchall():
+        yield from map(tuple, json.loads(zlib.decompress(data)))
+
+
+def compress_archive(cursor: sqlite3.Cursor, schema: str):
+    "Rewrite all the rows of an attached archive as zlib compressed blocks sorted by start"
+    create_archive_blocks(cursor, schema)
+    rows = list(iter_archive_blocks(cursor, schema))
+    cursor.execute(
+        f'SELECT rowid, start, message, end, category FROM {schema}.timetrack')
+    rows.extend(cursor.fetchall())
+    rows.sort(key=lambda row: (row[1], row[2]))
+    cursor.execute(f'DELETE FROM {schema}.timetrack_blocks')
+    cursor.execute(f'DELETE FROM {schema}.timetrack')
+    for block in batched(rows, ARCHIVE_BLOCK_ROWS):
+        cursor.execute(
+            f'INSERT INTO {schema}.timetrack_blocks (first_start, last_start, rows, data) '
+            'VALUES (?, ?, ?, ?)',
+            (block[0][1], block[-1][1], len(block),
+             zlib.compress(json.dumps(block).encode(), 9))
         )
 
+
+def load_archive_blocks(cursor: sqlite3.Cursor, schema: str, start: Optional[str], end: Optional[str]) -> str:
+    "Decompress the blocks overlapping [start, end] and the plain rows of an archive into a temporary table"
+    table = f'{schema}_rows'
+    cursor.execute(
+        f"CREATE TEMP TABLE {table} ("
+        "  start DATETIME NOT NULL,"
+        "  message TEXT NOT NULL,"
+        "  end DATETIME,"
+        "  category TEXT"
+        ")"
+    )
+    cursor.execute(
+        f'INSERT INTO temp.{table} (rowid, start, message, end, category) '
+        f'SELECT rowid, start, message, end, category FROM {schema}.timetrack'
+    )
+    cursor.executemany(
+        f'INSERT INTO temp.{table} (rowid, start, message, end, category) '
+        'VALUES (?, ?, ?, ?, ?)',
+        iter_archive_blocks(cursor.connection.cursor(), schema, start, end)
+    )
+    # End the implicit transaction of the inserts, the archive can not be
+    # detached while it is open
+    cursor.connection.commit()
+    return f'temp.{table}'
+
+
+def is_compressed_archive(cursor: sqlite3.Cursor, schema: str) -> bool:
+    cursor.execute(
+        f"SELECT 1 FROM {schema}.sqlite_master WHERE name = 'timetrack_blocks'")
+    return cursor.fetchone() is not None
+
+
+def iter_archive(cursor: sqlite3.Cursor, year: str, read, start: Optional[str] = None, end: Optional[str] = None):
+    schema = f'archive_{year}'
+    cursor.execute(f'ATTACH DATABASE ? AS {schema}', (str(archive_path(year)),))
+    archive_cursor = cursor.connection.cursor()
+    source = f'{schema}.timetrack'
+    compressed = is_compressed_archive(cursor, schema)
+    try:
+        if compressed:
+            source = load_archive_blocks(cursor, schema, start, end)
+        yield from read(archive_cursor, source)
+    finally:
+        archive_cursor.close()
+        if compressed:
+            cursor.execute(f'DROP TABLE IF EXISTS {source}')
+        cursor.execute(f'DETACH DATABASE {schema}')
+
+
+def iter_federated(cursor: sqlite3.Cursor, read, start: Optional[str] = None, end: Optional[str] = None, start_column: int = 2):
+    """Merge in start order the rows of timetrack and of the archives holding [start, end]
+
+    'read(cursor, source)' returns the rows of the 'source' table ordered by
+    start. Archives are attached one at a time while their rows are read.
+    """
+    years = archive_years(start, end)
+    if not years:
+        yield from read(cursor, 'timetrack_entries')
+        return
+    # Read the hot database first, an archive can not be detached while
+    # a statement is still running on the connection
+    rows = list(read(cursor, 'timetrack_entries'))
+    archived = chain.from_iterable(
+        iter_archive(cursor, year, read, start, end) for year in years)
+    yield from heapq.merge(rows, archived, key=lambda row: row[start_column])
+
+
+class CommandArchive(argparse.Namespace):
+    before: str
+    compress: bool = False
+
+
+def command_archive(args: CommandArchive):
+    "Move entries that ended before 'before' to per year archive databases"
+    # Archived entries are read back by list, metrics and export, but are no
+    # longer editable nor indexed for search, at and between.
+    cutoff = format_date_or_throw('before', args.before)
+    with shared_write_lock():
+        connection = connect(isolation_level=None)
+        cursor = get_cursor(connection)
+        cursor.execute(
+            'SELECT DISTINCT substr(start, 1, 4) FROM timetrack WHERE start < ? ORDER BY 1',
+            (cutoff,)
+        )
+        years = [row[0] for row in cursor.fetchall()]
+        archive_directory().mkdir(parents=True, exist_ok=True)
+
+        total = 0
+        for year in years:
+            schema = f'archive_{year}'
+            cursor.execute(f'ATTACH DATABASE ? AS {schema}', (str(archive_path(year)),))
+            try:
+                create_archive_schema(cursor, schema)
+                where = 'start >= ? AND start < ? AND end IS NOT NULL AND end <= ?'
+                values = (*partition_bounds(year), cutoff)
+                begin_immediate(cursor)
+                try:
+                    cursor.execute(
+                        f'INSERT INTO {schema}.timetrack (rowid, start, message, end, category) '
+                        'SELECT rowid, start, message, end, category FROM main.timetrack_entries '
+                        f'WHERE {where}',
+                        values
+                    )
+                    moved = cursor.rowcount
+                    cursor.execute(f'DELETE FROM main.timetrack WHERE {where}', values)
+                    # Archiving is not a deletion for 'export --since', and the
+                    # earlier changes of the archived entries have no row left to export
+                    cursor.execute(
+                        'DELETE FROM timetrack_changes WHERE entry_id IN '
+                        f'(SELECT rowid FROM {schema}.timetrack WHERE {where})',
+                        values
+                    )
+                    if args.compress:
+                        compress_archive(cursor, schema)
+                    cursor.execute('COMMIT')
+                except BaseException:
+                    cursor.execute('ROLLBACK')
+                    raise
+                if args.compress:
+                    cursor.execute(f'VACUUM {schema}')
+            finally:
+                cursor.execute(f'DETACH DATABASE {schema}')
+            total += moved
+            print(f'{year}: archived {moved} rows to {archive_path(year)}')
+        connection.close()
+    print(f'Archived {total} rows')
+
+
+USER_NAME = re.compile(r'[A-Za-z0-9_][A-Za-z0-9_.-]*')
+
+
+def user_db_path(user: str) -> Path:
+    "Database of 'user', every user has its own file under USERS_DIR"
+    if not USER_NAME.fullmatch(user):
+        raise CommandError(f'Invalid user name {user!r}')
+    return USERS_DIR / f'{user}.db'
+
+
+def list_users() -> list:
+    if not USERS_DIR.is_dir():
+        return []
+    return sorted(path.stem for path in USERS_DIR.glob('*.db') if USER_NAME.fullmatch(path.stem))
+
+
+def run_in_database(path: Path, func, *args):
+    "Run func(*args) with DB_PATH pointing to 'path', in a worker process"
+    global DB_PATH
+    DB_PATH = path
+    return func(*args)
+
+
+def map_users(func, *args, jobs: Optional[int] = None) -> dict:
+    "Results of func(*args) run against every user database, in parallel, by user"
+    # One task per user file: the files share nothing, so reports over many
+    # users scale with the number of processes
+    users = list_users()
+    if not users:
+        raise CommandError(f'No user databases found in {USERS_DIR}')
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = {user: executor.submit(run_in_database, user_db_path(user), func, *args)
+                   for user in users}
+        return {user: future.result() for user, future in futures.items()}
+
+
+FILTER_NOW = object()
+WEEKDAYS = ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat')
+DURATION_UNITS = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+FILTER_TERM = re.compile(r'(-?)([a-z]+)(:|>=|<=|>|<|=)(.*)')
+# Predicates on indexed columns first, then the cheap and the costly ones
+FILTER_RANK = {'since': 0, 'until': 0, 'category': 1, 'running': 2, 'weekday': 3,
+               'message': 4, 'duration': 5}
+
+
+@dataclass(frozen=True)
+class EntryFilter:
+    "WHERE clauses of a filter expression, see compile_filter"
+    where: str  # over category names: timetrack_entries and the archives
+    where_by_id: str  # over category ids: timetrack
+    values: tuple
+    since: Optional[str]
+
+    def bind(self) -> list:
+        now = datetime.now().strftime(DB_DATE_FORMAT)
+        return [now if value is FILTER_NOW else value for value in self.values]
+
+
+def parse_duration(value: str) -> int:
+    "Seconds of a duration like '1h30m', '45m' or '2d'"
+    parts = re.fullmatch(r'((\d+)[dhms])+', value) and re.findall(r'(\d+)([dhms])', value)
+    if not parts:
+        raise CommandError(f'Invalid duration {value!r}, expected e.g. 1h30m')
+    return sum(int(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def parse_weekdays(value: str) -> list:
+    "strftime('%w') values of 'mon-fri', 'sat,sun' and the like"
+    days = []
+    for part in value.split(','):
+        first, _, last = part.partition('-')
+        if first not in WEEKDAYS or (last and last not in WEEKDAYS):
+            raise CommandError(f'Invalid weekday {part!r}, expected e.g. mon-fri')
+        i = WEEKDAYS.index(first)
+        while True:
+            days.append(str(i))
+            if not last or WEEKDAYS[i] == last:
+                break
+            i = (i + 1) % 7
+    return days
+
+
+def compile_filter_term(key: str, op: str, value: str) -> tuple:
+    "(SQL over names, SQL over ids, values) of one filter term"
+    if op != ':' and key != 'duration':
+        raise CommandError(f'Use {key}:VALUE')
+    if key in ('since', 'until'):
+        date = format_date_or_throw(key, value)
+        sql = 'start >= ?' if key == 'since' else 'start < ?'
+        return sql, sql, [date]
+    if key == 'category':
+        # 'none' stands for the entries without category, also within a list
+        names = value.split(',')
+        where, where_by_id = [], []
+        if 'none' in names:
+            names = [name for name in names if name != 'none']
+            where.append('category IS NULL')
+            where_by_id.append('category_id IS NULL')
+        if names:
+            marks = ', '.join('?' * len(names))
+            where.append(f'category IN ({marks})')
+            where_by_id.append(f'category_id IN (SELECT id FROM categories WHERE name IN ({marks}))')
+        if len(where) == 1:
+            return where[0], where_by_id[0], names
+        return f'({" OR ".join(where)})', f'({" OR ".join(where_by_id)})', names
+    if key == 'running':
+        if value not in ('yes', 'no'):
+            raise CommandError('Use running:yes or running:no')
+        negate = 'NOT ' if value == 'no' else ''
+        # Archives hold no running entries and no running cache
+        return (f'end IS {negate}NULL',
+                f'rowid {negate}IN (SELECT id FROM timetrack_running)', [])
+    if key == 'weekday':
+        days = parse_weekdays(value)
+        sql = f"strftime('%w', start) IN ({', '.join('?' * len(days))})"
+        return sql, sql, days
+    if key == 'message':
+        return 'message LIKE ?', 'message LIKE ?', [f'%{value}%']
+    if key == 'duration':
+        if op == ':':
+            op = '='
+        sql = ("CAST(strftime('%s', coalesce(end, ?)) AS INTEGER) "
+               f"- CAST(strftime('%s', start) AS INTEGER) {op} ?")
+        return sql, sql, [FILTER_NOW, parse_duration(value)]
+    raise CommandError(f'Unknown filter {key!r}, expected one of {", ".join(FILTER_RANK)}')
+
+
+@lru_cache(maxsize=256)
+def compile_filter(expression: str) -> EntryFilter:
+    """Compile a filter expression to parameterized WHERE clauses
+
+    Terms are 'key:value' or 'duration<op>value' separated by spaces, quote
+    values with spaces. A bare word matches the message, '-' negates a term.
+    Keys: since, until, category (a,b or none), running (yes or no),
+    weekday (mon-fri, sat,sun), message and duration (1h30m, 45m).
+    """
+    # Compiled filters are immutable and cached, 'now' is bound on every use
+    try:
+        terms = shlex.split(expression)
+    except ValueError as e:
+        raise CommandError(f'Invalid filter: {e}')
+    predicates = []
+    since = None
+    for term in terms:
+        match = FILTER_TERM.fullmatch(term)
+        negate, key, op, value = match.groups() if match else ('', 'message', ':', term)
+        if key == 'message' and not match and term.startswith('-'):
+            negate, value = '-', term[1:]
+        if not value:
+            raise CommandError(f'No value given for {key!r}')
+        sql, sql_by_id, values = compile_filter_term(key, op, value)
+        if negate:
+            # NULL columns do not match, so the negation keeps them
+            sql, sql_by_id = f'NOT coalesce({sql}, 0)', f'NOT coalesce({sql_by_id}, 0)'
+        elif key == 'since':
+            since = max(since or values[0], values[0])
+        predicates.append((FILTER_RANK[key], sql, sql_by_id, values))
+    if not predicates:
+        raise CommandError('Empty filter')
+    predicates.sort(key=lambda predicate: predicate[0])
+    return EntryFilter(
+        where=' AND '.join(predicate[1] for predicate in predicates),
+        where_by_id=' AND '.join(predicate[2] for predicate in predicates),
+        values=tuple(value for predicate in predicates for value in predicate[3]),
+        since=since,
+    )
+
+
+class CommandList(argparse.Namespace):
+    start: Optional[str]
+    all_users: bool = False
+    jobs: Optional[int] = None
+    follow: bool = False
+    interval: float = 1.0
+    filter: Optional[str] = None
+
+
+def select_entries(cursor: sqlite3.Cursor, source: str, start: Optional[str],
+                   entry_filter: Optional[EntryFilter] = None) -> sqlite3.Cursor:
+    where = []
+    values = []
+    if start:
+        where.append('start >= ?')
+        values.append(start)
+    if entry_filter:
+        where.append(entry_filter.where)
+        values.extend(entry_filter.bind())
+    cursor.execute(
+        'SELECT rowid, message, start, end, category '
+        f'FROM {source} '
+        f'{"WHERE " + " AND ".join(where) + " " if where else ""}'
+        'ORDER BY start',
+        values
+    )
+    return cursor
+
+
+def read_entries(start: Optional[str], expression: Optional[str] = None) -> list:
+    entry_filter = expression and compile_filter(expression)
+    connection = connect()
+    cursor = get_cursor(connection)
+    rows = list(iter_federated(
+        cursor, lambda cursor, source: select_entries(cursor, source, start, entry_filter), start))
+    connection.close()
+    return rows
+
+
+def list_start(value: Optional[str]) -> Optional[str]:
+    "Start bound of 'list': the last 48 hours by default, None for 'all'"
+    if value is None:
+        start = datetime.now() - timedelta(hours=48)
+        return start.strftime(DB_DATE_FORMAT)
+    if value != 'all':
+        start = parse_date_or_throw('start', value)
+        return start.strftime(DB_DATE_FORMAT)
+    return None
+
+
+def command_list(args: CommandList):
+    "List time tracking entries"
+    # TODO: Add ms formatter
+    entry_filter = args.filter and compile_filter(args.filter)
+    if args.start is None and entry_filter and entry_filter.since:
+        start = entry_filter.since
+    else:
+        start = list_start(args.start)
+    if args.follow and entry_filter:
+        raise CommandError('--follow lists every change, it can not be combined with --filter')
+
     now = datetime.now()
-    for row in cursor:
+    if args.all_users:
+        if args.follow:
+            raise CommandError('--follow lists the entries of a single user')
+        for user, rows in map_users(read_entries, start, args.filter, jobs=args.jobs).items():
+            print(f'== {user}')
+            rowid_len = max((len(str(row[0])) for row in rows), default=0)
+            for row in rows:
+                Timetracker.from_row(row).show(now, rowid_len)
+        return
+
+    connection = connect()
+    cursor = get_cursor(connection)
+
+    rowid_len = 0
+    cursor.execute('SELECT MAX(rowid) FROM timetrack')
+    row = cursor.fetchone()
+    if row:
+        rowid_len = len(str(row[0]))
+
+    def read(cursor, source):
+        return select_entries(cursor, source, start, entry_filter)
+
+    # Changes after this point are picked up by --follow
+    seq = last_change_seq(cursor) if args.follow else None
+    entries = {}
+    for row in iter_federated(cursor, read, start):
         entity = Timetracker.from_row(row)
         entity.show(now, rowid_len)
+        if args.follow:
+            entries[entity.rowid] = entity
+    if args.follow:
+        follow_entries(cursor, entries, start, seq, args.interval)
     connection.close()
 
 
+def follow_entries(cursor: sqlite3.Cursor, entries: dict, start: Optional[str], seq: int, interval: float):
+    "Keep the listed 'entries' up to date from the change log until interrupted"
+    # PRAGMA data_version only changes when another connection commits, so an
+    # idle poll reads no table. Only the entries changed since 'seq' are
+    # fetched. On a terminal the list is redrawn, running durations tick
+    # from memory; otherwise every changed entry is printed once.
+    redraw = sys.stdout.isatty()
+    cursor.execute('PRAGMA data_version')
+    version = cursor.fetchone()[0]
+    try:
+        while True:
+            time.sleep(interval)
+            cursor.execute('PRAGMA data_version')
+            current = cursor.fetchone()[0]
+            changed = []
+            if current != version:
+                version = current
+                for change_seq, rowid, op, *row in fetch_changes(cursor, seq):
+                    seq = change_seq
+                    if op == 'delete' or row[0] is None:
+                        if entries.pop(rowid, None) is not None:
+                            changed.append((rowid, None))
+                    elif rowid in entries or start is None or row[0] >= start:
+                        entity = Timetracker.from_row((rowid, row[3], row[0], row[1], row[2]))
+                        entries[rowid] = entity
+                        changed.append((rowid, entity))
+
+            now = datetime.now()
+            if not redraw:
+                for rowid, entity in changed:
+                    if entity is None:
+                        print(f'{rowid}: deleted')
+                    else:
+                        entity.show(now)
+            elif changed or any(entity.end is None for entity in entries.values()):
+                print('\x1b[H\x1b[J', end='')
+                rowid_len = max((len(str(rowid)) for rowid in entries), default=0)
+                for entity in sorted(entries.values(), key=lambda entity: entity.start):
+                    entity.show(now, rowid_len)
+    except KeyboardInterrupt:
+        pass
+
+
 class CommandExport(argparse.Namespace):
     path: str
     format: Optional[str]
+    since: Optional[int] = None
+    all_users: bool = False
+    jobs: Optional[int] = None
 
 
-def command_export(args: CommandExport):
-    "Export time tracking entries to 'format' file"
+def write_export(f, rows: list, out_format: str, users: Optional[list] = None):
+    "Write (rowid, start, end, category, message) rows to 'f' in 'out_format'"
+    # 'users' holds the user of every row for cross user exports
+    if out_format == 'csv':
+        print('user,' * bool(users) + 'start,end,category,message', file=f)
+        for i, row in enumerate(rows):
+            category = (row[3] or '').replace('"', '""')
+            message = row[4].replace('"', '""')
+            user = f'{users[i]},' if users else ''
+            print(f'{user}{row[1]},{row[2] or ""},"{category}","{message}"', file=f)
 
-    connection = sqlite3.connect(DB_PATH)
-    cursor = get_cursor(connection)
+    elif out_format == 'json':
+        json.dump([{
+            **({'user': users[i]} if users else {}),
+            'start': row[1],
+            'end': row[2],
+            'category': row[3],
+            'message': row[4],
+        } for i, row in enumerate(rows)], f)
+
+    else:
+        raise CommandError(f'Unknown format {out_format!r}')
+
+
+def write_changes(f, rows: list, out_format: str):
+    "Write (seq, id, op, start, end, category, message) change rows to 'f' in 'out_format'"
+    if out_format == 'csv':
+        print('id,op,start,end,category,message', file=f)
+        for row in rows:
+            category = (row[5] or '').replace('"', '""')
+            message = (row[6] or '').replace('"', '""')
+            print(f'{row[1]},{row[2]},{row[3] or ""},{row[4] or ""},"{category}","{message}"', file=f)
+
+    elif out_format == 'json':
+        json.dump([{
+            'id': row[1],
+            'op': row[2],
+            'start': row[3],
+            'end': row[4],
+            'category': row[5],
+            'message': row[6],
+        } for row in rows], f)
+
+    else:
+        raise CommandError(f'Unknown format {out_format!r}')
+
+
+def fetch_changes(cursor: sqlite3.Cursor, since: int) -> list:
+    "Latest change of every entry written after the 'since' token, oldest first"
+    # Reads the change log from 'since' on through its primary key, so the
+    # cost depends on the number of changes and not on the table size.
     cursor.execute(
-        'SELECT rowid, start, end, category, message '
-        'FROM timetrack '
-        'ORDER BY start'
+        'SELECT c.seq, c.entry_id, '
+        "CASE WHEN c.op = 'delete' THEN 'delete' ELSE 'upsert' END, "
+        't.start, t.end, cat.name, t.message '
+        'FROM ('
+        '  SELECT entry_id, MAX(seq) AS seq FROM timetrack_changes '
+        '  WHERE seq > ? GROUP BY entry_id'
+        ') latest '
+        'JOIN timetrack_changes c ON c.seq = latest.seq '
+        "LEFT JOIN timetrack t ON t.rowid = c.entry_id AND c.op != 'delete' "
+        'LEFT JOIN categories cat ON cat.id = t.category_id '
+        # Entries archived since their last change are not deleted, they are
+        # left out of the changes
+        "WHERE c.op = 'delete' OR t.rowid IS NOT NULL "
+        'ORDER BY c.seq',
+        (since,)
     )
-    rows = cursor.fetchall()
+    return cursor.fetchall()
+
+
+def read_export_rows() -> list:
+    def read(cursor, source):
+        cursor.execute(
+            'SELECT rowid, start, end, category, message '
+            f'FROM {source} '
+            'ORDER BY start'
+        )
+        return cursor
+
+    connection = connect()
+    cursor = get_cursor(connection)
+    rows = list(iter_federated(cursor, read, start_column=1))
     connection.close()
+    return rows
+
 
+def command_export(args: CommandExport):
+    "Export time tracking entries to 'format' file"
     out_format = args.format
     if out_format is None:
         out_format = Path(args.path).suffix[1:]
 
-    if out_format == 'csv':
+    if args.since is not None:
+        connection = connect()
+        rows = fetch_changes(get_cursor(connection), args.since)
+        connection.close()
+        token = rows[-1][0] if rows else args.since
         with open(args.path, 'w') as f:
-            print('start,end,category,message', file=f)
-            for row in rows:
-                print(f'{row[1]},{row[2] or ""},"{row[3]}","{row[4]}"', file=f)
-        print(f'Exported {len(rows)} rows to {args.path}')
+            write_changes(f, rows, out_format)
+        print(f'Exported {len(rows)} changes to {args.path}')
+        print(f'Next sync token: {token}')
+        return
 
-    elif out_format == 'json':
+    if args.all_users:
+        # Every user file is read in parallel, rows are merged on start
+        by_user = map_users(read_export_rows, jobs=args.jobs)
+        merged = list(heapq.merge(
+            *([(row, user) for row in rows] for user, rows in by_user.items()),
+            key=lambda item: item[0][1]))
+        rows = [row for row, _ in merged]
         with open(args.path, 'w') as f:
-            json.dump([{
-                'start': row[1],
-                'end': row[2],
-                'category': row[3],
-                'message': row[4],
-            } for row in rows], f)
-        print(f'Exported {len(rows)} rows to {args.path}')
+            write_export(f, rows, out_format, [user for _, user in merged])
+        print(f'Exported {len(rows)} rows of {len(by_user)} users to {args.path}')
+        return
+
+    rows = read_export_rows()
+    with open(args.path, 'w') as f:
+        write_export(f, rows, out_format)
+    print(f'Exported {len(rows)} rows to {args.path}')
+
+
+class CommandExportShards(argparse.Namespace):
+    directory: str
+    by: str
+    format: str
+    jobs: int
+
+
+PARTITION_KEY_LENGTH = {'year': 4, 'month': 7, 'day': 10}
+
+
+def partition_bounds(key: str) -> tuple:
+    "Start (inclusive) and end (exclusive) of a 'YYYY', 'YYYY-MM' or 'YYYY-MM-DD' partition"
+    # start has NUMERIC affinity, a bare year bound would compare as a number
+    if len(key) == 4:
+        return f'{key}-01-01', f'{int(key) + 1:04d}-01-01'
+    if len(key) == 7:
+        year, month = int(key[:4]), int(key[5:])
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return key, f'{year:04d}-{month:02d}'
+    day = datetime.strptime(key, '%Y-%m-%d') + timedelta(days=1)
+    return key, day.strftime('%Y-%m-%d')
+
+
+def list_partitions(cursor: sqlite3.Cursor, by: str) -> list:
+    "Partitions of the entries, archived ones included"
+    def read(cursor, source):
+        # Scans the start index only
+        cursor.execute(
+            f'SELECT DISTINCT substr(start, 1, ?) FROM {source}',
+            (PARTITION_KEY_LENGTH[by],)
+        )
+        return [row[0] for row in cursor]
+
+    keys = set(read(cursor, 'timetrack'))
+    for year in archive_years():
+        keys.update(iter_archive(cursor, year, read))
+    return sorted(keys)
+
+
+def connect_readonly(path) -> sqlite3.Connection:
+    return sqlite3.connect(Path(path).resolve().as_uri() + '?mode=ro', uri=True)
+
+
+def export_shard(key: str, path: Path, out_format: str, checksum: Optional[str]) -> dict:
+    "Export the 'key' partition to 'path', unless its contents still match 'checksum'"
+    start, end = partition_bounds(key)
+
+    def read(cursor, source):
+        cursor.execute(
+            'SELECT rowid, start, end, category, message '
+            f'FROM {source} '
+            'WHERE start >= ? AND start < ? '
+            'ORDER BY start, message',
+            (start, end)
+        )
+        return cursor
+
+    connection = connect_readonly(DB_PATH)
+    rows = list(iter_federated(get_cursor(connection), read, start, end, start_column=1))
+    connection.close()
+
+    content = io.StringIO()
+    write_export(content, rows, out_format)
+    content = content.getvalue().encode()
+    shard = {
+        'file': path.name,
+        'rows': len(rows),
+        'sha256': hashlib.sha256(content).hexdigest(),
+    }
+    shard['written'] = shard['sha256'] != checksum or not path.exists()
+    if shard['written']:
+        temporary = path.with_name(path.name + '.tmp')
+        temporary.write_bytes(content)
+        os.replace(temporary, path)
+    return shard
+
+
+def command_export_shards(args: CommandExportShards):
+    "Export time tracking entries to one 'format' file per partition, in parallel"
+    directory = Path(args.directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    manifest_path = directory / 'manifest.json'
+    manifest = {'by': args.by, 'format': args.format, 'shards': {}}
+    if manifest_path.exists():
+        previous = json.loads(manifest_path.read_text())
+        if previous.get('by') == args.by and previous.get('format') == args.format:
+            manifest['shards'] = previous['shards']
+
+    connection = connect()
+    keys = list_partitions(get_cursor(connection), args.by)
+    connection.close()
+
+    shards = {}
+    with ProcessPoolExecutor(args.jobs) as executor:
+        futures = {key: executor.submit(
+            run_in_database, DB_PATH, export_shard, key, directory / f'{key}.{args.format}',
+            args.format, manifest['shards'].get(key, {}).get('sha256')
+        ) for key in keys}
+        for key, future in futures.items():
+            shards[key] = future.result()
+
+    for key, shard in manifest['shards'].items():
+        if key not in shards:
+            (directory / shard['file']).unlink(missing_ok=True)
+
+    written = sum(shard.pop('written') for shard in shards.values())
+    manifest['shards'] = shards
+    temporary = manifest_path.with_name(manifest_path.name + '.tmp')
+    temporary.write_text(json.dumps(manifest, indent=2))
+    os.replace(temporary, manifest_path)
+    rows = sum(shard['rows'] for shard in shards.values())
+    print(f'Exported {rows} rows in {len(shards)} shards to {directory} '
+          f'({written} written, {len(shards) - written} unchanged)')
+
+
+class CommandSync(argparse.Namespace):
+    path: str
+    dry_run: bool = False
+
+
+def row_digest(*values) -> int:
+    digest = hashlib.blake2b(repr(values).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class PartitionHash:
+    "SQL aggregate XOR-ing the row digests, so the hash does not depend on the row order"
+
+    def __init__(self):
+        self.value = 0
+
+    def step(self, *values):
+        self.value ^= row_digest(*values)
+
+    def finalize(self):
+        return self.value
+
+
+def archive_cutoff(cursor: sqlite3.Cursor, database: Path) -> str:
+    "Start of the last archived entry of 'database', '' when it has no archive"
+    years = sorted(archive_directory(database).glob('[0-9][0-9][0-9][0-9].db'))
+    if not years:
+        return ''
+    cursor.execute('ATTACH DATABASE ? AS sync_archive', (str(years[-1]),))
+    try:
+        if is_compressed_archive(cursor, 'sync_archive'):
+            cursor.execute('SELECT max(last_start) FROM sync_archive.timetrack_blocks')
+        else:
+            cursor.execute('SELECT max(start) FROM sync_archive.timetrack')
+        return cursor.fetchone()[0] or ''
+    finally:
+        cursor.execute('DETACH DATABASE sync_archive')
+
+
+def partition_hashes(cursor: sqlite3.Cursor, schema: str, by: str, within: Optional[str] = None,
+                     after: str = '') -> dict:
+    "{partition key: (rows, hash)} of the 'by' partitions of 'schema' after 'after', inside the 'within' partition"
+    where = 'WHERE t.start > ? '
+    values = [PARTITION_KEY_LENGTH[by], after]
+    if within is not None:
+        where += 'AND t.start >= ? AND t.start < ? '
+        values.extend(partition_bounds(within))
+    cursor.execute(
+        'SELECT substr(t.start, 1, ?), count(*), partition_hash(t.start, t.message, t.end, c.name) '
+        f'FROM {schema}.timetrack t LEFT JOIN {schema}.categories c ON c.id = t.category_id '
+        f'{where}'
+        'GROUP BY 1',
+        values
+    )
+    return {row[0]: tuple(row[1:]) for row in cursor}
+
+
+def partition_rows(cursor: sqlite3.Cursor, schema: str, key: str, after: str = '') -> dict:
+    "{(start, message): (rowid, end, category)} of the 'key' partition of 'schema' after 'after'"
+    cursor.execute(
+        'SELECT t.start, t.message, t.rowid, t.end, c.name '
+        f'FROM {schema}.timetrack t LEFT JOIN {schema}.categories c ON c.id = t.category_id '
+        'WHERE t.start > ? AND t.start >= ? AND t.start < ?',
+        (after, *partition_bounds(key))
+    )
+    return {row[:2]: row[2:] for row in cursor}
+
+
+def last_changed_at(cursor: sqlite3.Cursor, schema: str, rowid: int) -> str:
+    cursor.execute(
+        f'SELECT max(changed_at) FROM {schema}.timetrack_changes WHERE entry_id = ?', (rowid,))
+    return cursor.fetchone()[0] or ''
+
+
+def differing(local: dict, other: dict) -> list:
+    return sorted(key for key in local.keys() | other.keys() if local.get(key) != other.get(key))
+
+
+def command_sync(args: CommandSync):
+    "Merge the entries of another database into this one"
+    # Month hashes are compared first, then the day hashes of the months that
+    # differ, and only the days that differ are read row by row, so the rows
+    # read and written grow with the divergence and not with the history.
+    # Entries are matched on (start, message); when both sides changed an
+    # entry the most recent change wins. Deletions are not propagated.
+    # Archived entries stay out of it: only the entries after the last
+    # archived one of either side are compared, so archiving on one side does
+    # not bring the archived entries back into the hot table.
+    path = Path(args.path)
+    if not path.exists():
+        raise CommandError(f'Database {path} does not exist')
+    with shared_write_lock():
+        connection = connect(isolation_level=None)
+        connection.create_aggregate('partition_hash', 4, PartitionHash)
+        cursor = get_cursor(connection)
+        cursor.execute('ATTACH DATABASE ? AS sync_other', (str(path),))
+        try:
+            cursor.execute('PRAGMA sync_other.user_version')
+            if cursor.fetchone()[0] != len(MIGRATIONS):
+                raise CommandError(f'Database {path} is not up to date, run setup on it first')
+            cursor.execute("SELECT 1 FROM sync_other.meta WHERE key = 'encoding_repaired_rowid'")
+            if cursor.fetchone() is not None:
+                raise CommandError(f'Database {path} has messages left to repair, run setup on it first')
+            after = max(archive_cutoff(cursor, DB_PATH), archive_cutoff(cursor, path))
+            begin_immediate(cursor)
+            months = differing(partition_hashes(cursor, 'main', 'month', after=after),
+                               partition_hashes(cursor, 'sync_other', 'month', after=after))
+            days = [day for month in months for day in differing(
+                partition_hashes(cursor, 'main', 'day', month, after),
+                partition_hashes(cursor, 'sync_other', 'day', month, after))]
+
+            inserted = updated = only_here = 0
+            for day in days:
+                local = partition_rows(cursor, 'main', day, after)
+                other = partition_rows(cursor, 'sync_other', day, after)
+                for key in differing(local, other):
+                    if key not in other:
+                        only_here += 1
+                        continue
+                    _, end, category = other[key]
+                    if key not in local:
+                        inserted += 1
+                        if not args.dry_run:
+                            insert_entry(cursor, key[1], key[0], end, category)
+                        continue
+                    if (end, category) == local[key][1:]:
+                        continue
+                    if last_changed_at(cursor, 'sync_other', other[key][0]) > \
+                            last_changed_at(cursor, 'main', local[key][0]):
+                        updated += 1
+                        if not args.dry_run:
+                            update_entry(cursor, local[key][0], {'end': end, 'category': category})
+            cursor.execute('ROLLBACK' if args.dry_run else 'COMMIT')
+        except BaseException:
+            if connection.in_transaction:
+                cursor.execute('ROLLBACK')
+            raise
+        finally:
+            category_cache().clear()
+            cursor.execute('DETACH DATABASE sync_other')
+            connection.close()
+    print(f'{len(months)} months and {len(days)} days differ')
+    print(f'{"Would insert" if args.dry_run else "Inserted"} {inserted}, '
+          f'{"update" if args.dry_run else "updated"} {updated}, {only_here} only here')
 
 
 class CommandImport(argparse.Namespace):
     path: str
     format: Optional[str]
+    jobs: int = 1
+    chunk_size: int = 10000
+
+
+def parse_import_record(record: dict) -> tuple:
+    start = format_date_or_throw('start', record['start'])
+    end = record.get('end') or None
+    if end is not None:
+        end = format_date_or_throw('end', end)
+    return (start, end, record.get('category') or None, record['message'])
+
+
+def parse_import_chunk(header: Optional[list], chunk: list) -> list:
+    "Validate a chunk of (line, record) pairs, CSV rows when 'header' is given, into insert tuples"
+    rows = []
+    for line_no, record in chunk:
+        if header is not None:
+            record = dict(zip(header, record))
+        try:
+            rows.append(parse_import_record(record))
+        except (CommandError, KeyError, TypeError) as e:
+            raise CommandError(f'Invalid record {line_no}: {e!r}') from None
+    return rows
+
+
+def iter_csv_records(reader):
+    "Yield (first line, row) of the CSV records, a quoted field may span lines"
+    line_no = reader.line_num + 1
+    for row in reader:
+        yield line_no, row
+        line_no = reader.line_num + 1
+
+
+def iter_import_chunks(path: str, in_format: str, chunk_size: int):
+    "Yield (header, chunk) split at record boundaries, chunks hold (line, record) pairs"
+    if in_format == 'csv':
+        with open(path, newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            for chunk in batched(iter_csv_records(reader), chunk_size):
+                yield header, chunk
+
+    elif in_format == 'json':
+        with open(path) as f:
+            data = json.load(f)
+        for chunk in batched(enumerate(data, start=1), chunk_size):
+            yield None, chunk
+
+    else:
+        raise CommandError(f'Unknown format {in_format!r}')
+
+
+def parse_import_chunks_parallel(chunks, jobs: int):
+    "Parse chunks in 'jobs' processes, yielding results in input order"
+    with ProcessPoolExecutor(jobs) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(parse_import_chunk, *chunk))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 
 def command_import(args: CommandImport):
@@ -378,37 +2349,274 @@ def command_import(args: CommandImport):
     if in_format is None:
         in_format = Path(args.path).suffix[1:]
 
-    if in_format == 'csv':
-        data = []
-        with open(args.path) as f:
-            for i, line in enumerate(f):
-                if i == 0:
-                    header = line.strip().split(',')
-                else:
-                    row = line.strip().split(',')
-                    data.append(dict(zip(header, row)))
-
-    elif in_format == 'json':
-        with open(args.path) as f:
-            data = json.load(f)
+    chunks = iter_import_chunks(args.path, in_format, args.chunk_size)
+    if args.jobs > 1:
+        parsed = parse_import_chunks_parallel(chunks, args.jobs)
+    else:
+        parsed = (parse_import_chunk(*chunk) for chunk in chunks)
 
-    connection = sqlite3.connect(DB_PATH)
-    cursor = get_cursor(connection)
-    for batch in batched(data, 100):
+    def insert_rows(cursor):
+        categories = category_cache()
         cursor.executemany(
-            'INSERT INTO timetrack (start, end, category, message) '
+            'INSERT INTO timetrack (start, end, category_id, message) '
             'VALUES (?, ?, ?, ?)',
-            [(row['start'], row['end'], row['category'], row['message'])
-                for row in batch]
+            [(start, end, categories.get_id(cursor, category), message)
+             for start, end, category, message in rows]
+        )
+
+    # Single writer, one transaction per chunk
+    count = 0
+    for rows in parsed:
+        run_write(insert_rows)
+        count += len(rows)
+    print(f'Imported {count} rows from {args.path}')
+
+
+def iter_rows_by_start(cursor: sqlite3.Cursor, start: Optional[str] = None, end: Optional[str] = None, chunk_size: int = 1000, source: str = 'timetrack_entries',
+                       entry_filter: Optional[EntryFilter] = None):
+    "Yield rows ordered by start, reading the table in chunks of 'chunk_size' rows"
+    # Keyset pagination over the unique (start, message) index, so every chunk
+    # is an index range scan and the table is never loaded at once.
+    after = None
+    while True:
+        where = []
+        values = []
+        if after is not None:
+            where.append('(start, message) > (?, ?)')
+            values.extend(after)
+        elif start:
+            where.append('start >= ?')
+            values.append(start)
+        if end:
+            where.append('start < ?')
+            values.append(end)
+        if entry_filter:
+            where.append(entry_filter.where)
+            values.extend(entry_filter.bind())
+        cursor.execute(
+            'SELECT rowid, message, start, end, category '
+            f'FROM {source} '
+            f'{"WHERE " + " AND ".join(where) if where else ""} '
+            'ORDER BY start, message '
+            'LIMIT ?',
+            (*values, chunk_size)
         )
-        connection.commit()
+        rows = cursor.fetchall()
+        yield from rows
+        if len(rows) < chunk_size:
+            break
+        after = (rows[-1][2], rows[-1][1])
+
+
+class IntervalUnion:
+    "Length of the union of intervals added in start order"
+
+    def __init__(self):
+        self.total = timedelta()
+        self.start: Optional[datetime] = None
+        self.end: Optional[datetime] = None
+
+    def add(self, start: datetime, end: datetime):
+        if self.end is None or start > self.end:
+            self.total = self.length()
+            self.start, self.end = start, end
+        elif end > self.end:
+            self.end = end
+
+    def length(self) -> timedelta:
+        if self.end is None:
+            return self.total
+        return self.total + (self.end - self.start)
+
+
+@dataclass
+class TimelineIssue:
+    kind: str
+    start: datetime
+    end: datetime
+    ids: list
+
+    def show(self):
+        start = self.start.strftime(CLI_PRINT_DATE_FORMAT)
+        end = self.end.strftime(CLI_PRINT_DATE_FORMAT)
+        duration = format_duration(self.end - self.start)
+        ids = ', '.join(str(rowid) for rowid in self.ids)
+        print(f'{self.kind:<8} {start} .. {end} | {duration} | {ids}')
+
+
+def sweep_timeline(entities, now: datetime, min_gap: timedelta, max_gap: timedelta):
+    "Yield overlaps, gaps and concurrently running entries from entities sorted by start"
+    active = []  # heap of (end, rowid) for entries covering the sweep position
+    running = []
+    covered_until = None
+    last_rowid = None
+    for entity in entities:
+        end = entity.end or now
+        while active and active[0][0] <= entity.start:
+            heapq.heappop(active)
+        if active:
+            overlap_end = min(end, max(active_end for active_end, _ in active))
+            ids = sorted(rowid for _, rowid in active)
+            yield TimelineIssue('overlap', entity.start, overlap_end, ids + [entity.rowid])
+        elif covered_until is not None and min_gap <= entity.start - covered_until <= max_gap:
+            yield TimelineIssue('gap', covered_until, entity.start, [last_rowid, entity.rowid])
+        if entity.end is None:
+            running.append(entity)
+        heapq.heappush(active, (end, entity.rowid))
+        if covered_until is None or end > covered_until:
+            covered_until = end
+            last_rowid = entity.rowid
+    if len(running) > 1:
+        yield TimelineIssue('running', max(e.start for e in running), now, [e.rowid for e in running])
+
+
+class CommandTimeline(argparse.Namespace):
+    start: Optional[str]
+    end: Optional[str]
+    min_gap: int
+    max_gap: int
+
+
+def command_timeline(args: CommandTimeline):
+    "Check the timeline for overlapping entries, gaps and concurrently running entries"
+    start = args.start and format_date_or_throw('start', args.start)
+    end = args.end and format_date_or_throw('end', args.end)
+
+    connection = connect()
+    cursor = get_cursor(connection)
+    entities = (Timetracker.from_row(row)
+                for row in iter_rows_by_start(cursor, start, end))
+    counts = {'overlap': 0, 'gap': 0, 'running': 0}
+    issues = sweep_timeline(entities, datetime.now(), timedelta(
+        minutes=args.min_gap), timedelta(minutes=args.max_gap))
+    for issue in issues:
+        counts[issue.kind] += 1
+        issue.show()
     connection.close()
-    print(f'Imported {len(data)} rows from {args.path}')
+    print(f'Found {counts["overlap"]} overlaps, {counts["gap"]} gaps, '
+          f'{counts["running"]} groups of running entries')
 
 
 class CommandMetrics(argparse.Namespace):
     start: Optional[str]
     end: Optional[str]
+    merged: bool = False
+    all_users: bool = False
+    jobs: Optional[int] = None
+    filter: Optional[str] = None
+
+
+@dataclass
+class Metrics:
+    rows: int = 0
+    total: timedelta = timedelta()
+    category_rows: int = 0
+    categories: dict = field(default_factory=dict)
+
+    def add(self, other: 'Metrics'):
+        self.rows += other.rows
+        self.total += other.total
+        self.category_rows += other.category_rows
+        for category, total in other.categories.items():
+            self.categories[category] = self.categories.get(category, timedelta()) + total
+
+    def to_dict(self) -> dict:
+        return {
+            'rows': self.rows,
+            'total_seconds': self.total.total_seconds(),
+            'category_rows': self.category_rows,
+            'categories': {category: total.total_seconds()
+                           for category, total in sorted(self.categories.items())},
+        }
+
+    def show(self):
+        print(f'Total rows: {self.rows}')
+        print(f'Total time: {self.total}')
+        print(f'Total rows with category: {self.category_rows}')
+        for category, total in sorted(self.categories.items()):
+            print(f'{category}: {total}')
+
+
+def merged_metrics(cursor: sqlite3.Cursor, start: datetime, end: Optional[datetime],
+                   entry_filter: Optional[EntryFilter] = None) -> Metrics:
+    total = IntervalUnion()
+    categories = {}
+    metrics = Metrics()
+    start = start.strftime(DB_DATE_FORMAT)
+    rows = iter_federated(
+        cursor,
+        lambda cursor, source: iter_rows_by_start(cursor, start, source=source, entry_filter=entry_filter),
+        start,
+        end and end.strftime(DB_DATE_FORMAT),
+    )
+    for row in rows:
+        entity = Timetracker.from_row(row)
+        if end and (entity.end is None or entity.end > end):
+            continue
+        metrics.rows += 1
+        if entity.category:
+            metrics.category_rows += 1
+        if entity.end is None:
+            continue
+        total.add(entity.start, entity.end)
+        if entity.category:
+            categories.setdefault(entity.category, IntervalUnion()).add(
+                entity.start, entity.end)
+
+    metrics.total = total.length()
+    metrics.categories = {category: union.length() for category, union in categories.items()}
+    return metrics
+
+
+def collect_metrics(start: datetime, end: Optional[datetime], merged: bool,
+                    expression: Optional[str] = None) -> Metrics:
+    entry_filter = expression and compile_filter(expression)
+    connection = connect()
+    metrics = metrics_for(get_cursor(connection), start, end, merged, entry_filter)
+    connection.close()
+    return metrics
+
+
+def metrics_for(cursor: sqlite3.Cursor, start: datetime, end: Optional[datetime], merged: bool,
+                entry_filter: Optional[EntryFilter] = None) -> Metrics:
+    if merged:
+        # Overlapping entries are counted once
+        return merged_metrics(cursor, start, end, entry_filter)
+
+    def read(cursor, source, category='category'):
+        where = 'WHERE start >= ? AND end <= ?' if end else 'WHERE start >= ?'
+        values = [start, end] if end else [start]
+        if entry_filter:
+            by_id = category == 'category_id'
+            where += f' AND {entry_filter.where_by_id if by_id else entry_filter.where}'
+            values.extend(entry_filter.bind())
+        cursor.execute(
+            f'SELECT {category}, start, end '
+            f'FROM {source} '
+            f'{where}',
+            values
+        )
+        return cursor.fetchall()
+
+    # Rows are grouped on category names, the hot table stores ids
+    categories = category_cache()
+    rows = [(categories.get_name(cursor, row[0]), row[1], row[2])
+            for row in read(cursor, 'timetrack', 'category_id')]
+    bounds = (start.strftime(DB_DATE_FORMAT), end and end.strftime(DB_DATE_FORMAT))
+    for year in archive_years(*bounds):
+        rows.extend(iter_archive(cursor, year, read, *bounds))
+    rows = [(row[0], parse_date_db(row[1]), row[2] and parse_date_db(row[2]))
+            for row in rows]
+    cat_rows = sorted((row for row in rows if row[0]), key=lambda row: row[0])
+    return Metrics(
+        rows=len(rows),
+        total=sum((row[2] - row[1] for row in rows if row[2]), timedelta()),
+        category_rows=len(cat_rows),
+        categories={
+            category: sum((row[2] - row[1] for row in category_rows if row[2]), timedelta())
+            for category, category_rows in groupby(cat_rows, key=lambda row: row[0])
+        },
+    )
 
 
 def command_metrics(args: CommandMetrics):
@@ -417,37 +2625,1144 @@ def command_metrics(args: CommandMetrics):
     end = None
     if args.start:
         start = parse_date_or_throw('start', args.start)
+    elif args.filter and compile_filter(args.filter).since:
+        start = parse_date_db(compile_filter(args.filter).since)
     if args.end:
         end = parse_date_or_throw('end', args.end)
 
-    connection = sqlite3.connect(DB_PATH)
+    if not args.all_users:
+        collect_metrics(start, end, args.merged, args.filter).show()
+        return
+
+    total = Metrics()
+    users = map_users(collect_metrics, start, end, args.merged, args.filter, jobs=args.jobs)
+    for user, metrics in users.items():
+        print(f'{user}: {metrics.rows} rows, {metrics.total}')
+        total.add(metrics)
+    total.show()
+
+
+class CommandTimesheet(argparse.Namespace):
+    start: Optional[str] = None
+    end: Optional[str] = None
+    format: str = 'table'
+
+
+TIMESHEET_QUERY = """
+WITH RECURSIVE
+  entries(start, end, category) AS (
+    SELECT max(t.start, :lo), min(coalesce(t.end, :now), :hi), coalesce(t.category, '')
+    FROM timetrack_intervals i
+    JOIN timetrack_entries t ON t.rowid = i.id
+    WHERE i.start_at < :hi_at AND i.end_at > :lo_at
+    UNION ALL
+    SELECT max(start, :lo), min(end, :hi), coalesce(category, '') FROM temp.timesheet_archived
+  ),
+  pieces(day, start, end, category) AS (
+    SELECT substr(start, 1, 10), start, end, category FROM entries WHERE start < end
+    UNION ALL
+    SELECT date(day, '+1 day'), date(day, '+1 day') || 'T00:00:00Z', end, category
+    FROM pieces WHERE date(day, '+1 day') || 'T00:00:00Z' < end
+  ),
+  days(day) AS (
+    SELECT substr(:lo, 1, 10)
+    UNION ALL
+    SELECT date(day, '+1 day') FROM days WHERE date(day, '+1 day') < substr(:hi, 1, 10)
+  ),
+  cells(day, category, seconds) AS (
+    SELECT day, category, sum(
+      strftime('%s', min(end, date(day, '+1 day') || 'T00:00:00Z')) - strftime('%s', start))
+    FROM pieces GROUP BY day, category
+    UNION ALL
+    SELECT day, NULL, 0 FROM days WHERE day NOT IN (SELECT day FROM pieces)
+  ),
+  -- Weeks are keyed on their monday, so a week is not split at the new year
+  weeks(day, monday, category, seconds) AS (
+    SELECT day, date(day, '-' || ((strftime('%w', day) + 6) % 7) || ' days'), category, seconds
+    FROM cells
+  )
+SELECT day, monday, category, seconds,
+  sum(seconds) OVER (PARTITION BY day),
+  sum(seconds) OVER (PARTITION BY monday),
+  sum(seconds) OVER (ORDER BY day RANGE UNBOUNDED PRECEDING)
+FROM weeks
+ORDER BY day, category
+"""
+
+
+def iter_timesheet(cursor: sqlite3.Cursor, lo: datetime, hi: datetime):
+    "Yield (day, week, {category: seconds}, day total, week total, running total) for every day in [lo, hi)"
+    # Entries are found through the interval index, clipped to the range and
+    # split at midnight by the recursive CTE; the totals are window functions.
+    # Archived entries are read first, an archive can not be attached once
+    # the temporary table is written, and go through the same CTE.
+    def read(archive_cursor, source):
+        archive_cursor.execute(
+            f'SELECT start, end, category FROM {source} WHERE start < ? AND end > ?',
+            (hi.strftime(DB_DATE_FORMAT), lo.strftime(DB_DATE_FORMAT)))
+        return archive_cursor.fetchall()
+
+    # Archives are by start year, an entry may start in the year before the range
+    archived = []
+    for year in archive_years(str(lo.year - 1), hi.strftime(DB_DATE_FORMAT)):
+        archived.extend(iter_archive(cursor, year, read, None, hi.strftime(DB_DATE_FORMAT)))
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS timesheet_archived (start, end, category)')
+    cursor.execute('DELETE FROM temp.timesheet_archived')
+    cursor.executemany('INSERT INTO temp.timesheet_archived VALUES (?, ?, ?)', archived)
+    cursor.execute(TIMESHEET_QUERY, {
+        'lo': lo.strftime(DB_DATE_FORMAT),
+        'hi': hi.strftime(DB_DATE_FORMAT),
+        'lo_at': epoch_seconds(lo),
+        'hi_at': epoch_seconds(hi),
+        'now': datetime.now().strftime(DB_DATE_FORMAT),
+    })
+    for day, cells in groupby(cursor, key=lambda row: row[0]):
+        cells = list(cells)
+        seconds = {cell[2]: cell[3] for cell in cells if cell[2] is not None}
+        # ISO 8601 week of the monday, SQLite only knows %V from 3.46
+        year, week, _ = date.fromisoformat(cells[0][1]).isocalendar()
+        yield day, f'{year}-W{week:02d}', seconds, *cells[0][4:]
+
+
+def command_timesheet(args: CommandTimesheet):
+    "Show time per day and category, with daily, weekly and running totals"
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    lo = today - timedelta(days=today.weekday())
+    if args.start is not None:
+        lo = parse_date_or_throw('start', args.start).replace(hour=0, minute=0, second=0)
+    hi = lo + timedelta(days=7)
+    if args.end is not None:
+        hi = parse_date_or_throw('end', args.end).replace(hour=0, minute=0, second=0) + timedelta(days=1)
+    if hi <= lo:
+        raise CommandError('The end is before the start')
+
+    connection = connect()
+    cursor = get_cursor(connection)
+    days = list(iter_timesheet(cursor, lo, hi))
+    connection.close()
+    categories = sorted({category for day in days for category in day[2]},
+                        key=lambda category: (category == '', category))
+    names = [category or '(none)' for category in categories]
+
+    def hours(seconds):
+        return round(seconds / 3600, 2)
+
+    if args.format == 'json':
+        json.dump([{
+            'day': day,
+            'week': week,
+            'categories': {name: hours(seconds.get(category, 0))
+                           for category, name in zip(categories, names)},
+            'total': hours(day_total),
+            'week_total': hours(week_total),
+            'cumulative': hours(cumulative),
+        } for day, week, seconds, day_total, week_total, cumulative in days], sys.stdout)
+        print()
+        return
+
+    if args.format == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(['day', *names, 'total', 'week_total', 'cumulative'])
+        for day, week, seconds, day_total, week_total, cumulative in days:
+            writer.writerow([day, *(hours(seconds.get(category, 0)) for category in categories),
+                             hours(day_total), hours(week_total), hours(cumulative)])
+        return
+
+    def duration(seconds):
+        return format_duration(timedelta(seconds=seconds))
+
+    widths = [max(len(name), 5) for name in names]
+    print('Day        ' + ' '.join(name.rjust(width) for name, width in zip(names, widths))
+          + '  Total  Cumulative')
+    for week, week_days in groupby(days, key=lambda day: day[1]):
+        week_days = list(week_days)
+        for day, _, seconds, day_total, _, cumulative in week_days:
+            cells = ' '.join(duration(seconds.get(category, 0)).rjust(width)
+                             for category, width in zip(categories, widths))
+            print(f'{day} {cells}  {duration(day_total)}  {duration(cumulative).rjust(10)}')
+        cells = ' '.join(duration(sum(day[2].get(category, 0) for day in week_days)).rjust(width)
+                         for category, width in zip(categories, widths))
+        print(f'{week:<10} {cells}  {duration(week_days[0][4])}')
+
+
+class CommandAnalyze(argparse.Namespace):
+    analysis: str
+    start: Optional[str] = None
+    end: Optional[str] = None
+    engine: str = 'auto'
+    format: str = 'table'
+
+
+# Entries as (year, month, weekday, hour, hours, category) for the analyses,
+# in the dialect of each engine. Running entries count until now.
+ANALYZE_ENTRIES = {
+    'sqlite': (
+        "SELECT CAST(strftime('%Y', t.start) AS INTEGER) AS year, substr(t.start, 1, 7) AS month,"
+        "  CAST(strftime('%w', t.start) AS INTEGER) AS weekday, CAST(strftime('%H', t.start) AS INTEGER) AS hour,"
+        "  (julianday(coalesce(t.end, ?)) - julianday(t.start)) * 24 AS hours,"
+        "  coalesce(c.name, '(none)') AS category"
+        " FROM timetrack t LEFT JOIN categories c ON c.id = t.category_id"
+        " WHERE t.start >= ? AND t.start < ?"
+    ),
+    # Read through the sqlite scanner with every column as VARCHAR
+    'duckdb': (
+        "SELECT year(t.s) AS year, strftime(t.s, '%Y-%m') AS month,"
+        "  dayofweek(t.s) AS weekday, hour(t.s) AS hour,"
+        "  date_diff('second', t.s, coalesce(t.e, strptime(?, '%Y-%m-%dT%H:%M:%SZ'))) / 3600.0 AS hours,"
+        "  coalesce(c.name, '(none)') AS category"
+        " FROM (SELECT strptime(start, '%Y-%m-%dT%H:%M:%SZ') AS s, strptime(\"end\", '%Y-%m-%dT%H:%M:%SZ') AS e,"
+        "   category_id FROM timetrack_db.timetrack WHERE start >= ? AND start < ?) t"
+        " LEFT JOIN timetrack_db.categories c ON c.id = t.category_id"
+    ),
+}
+
+# name: (help, query over 'entries'), the queries run unchanged on both engines
+ANALYSES = {
+    'trend': (
+        'hours and entries per year and category, with the change from the previous year',
+        "SELECT year, category, round(sum(hours), 2) AS hours, count(*) AS entries,"
+        "  round(sum(hours) - lag(sum(hours)) OVER (PARTITION BY category ORDER BY year), 2) AS change"
+        " FROM entries GROUP BY year, category ORDER BY year, category"
+    ),
+    'monthly': (
+        'hours and entries per month, with a three month moving average',
+        "SELECT month, round(sum(hours), 2) AS hours, count(*) AS entries,"
+        "  round(avg(sum(hours)) OVER (ORDER BY month ROWS BETWEEN 2 PRECEDING AND CURRENT ROW), 2) AS average"
+        " FROM entries GROUP BY month ORDER BY month"
+    ),
+    'heatmap': (
+        'hours per weekday and hour of the day the entries start',
+        "SELECT substr('SunMonTueWedThuFriSat', weekday * 3 + 1, 3) AS day, hour,"
+        "  round(sum(hours), 2) AS hours, count(*) AS entries"
+        " FROM entries GROUP BY weekday, hour ORDER BY weekday, hour"
+    ),
+    'quantiles': (
+        'entry duration quantiles in hours per category',
+        # Nearest rank: the smallest duration with at least that share of the entries
+        "SELECT category, count(*) AS entries,"
+        "  round(min(CASE WHEN share >= 0.5 THEN hours END), 2) AS p50,"
+        "  round(min(CASE WHEN share >= 0.9 THEN hours END), 2) AS p90,"
+        "  round(min(CASE WHEN share >= 0.99 THEN hours END), 2) AS p99,"
+        "  round(max(hours), 2) AS max"
+        " FROM (SELECT category, hours, cume_dist() OVER (PARTITION BY category ORDER BY hours) AS share"
+        "   FROM entries) ranked"
+        " GROUP BY category ORDER BY category"
+    ),
+}
+
+
+def duckdb_reads_sqlite() -> bool:
+    "Whether the sqlite extension of DuckDB can be loaded"
+    connection = duckdb.connect()
+    try:
+        try:
+            connection.load_extension('sqlite')
+        except duckdb.Error:
+            # Downloaded the first time only, which needs the network
+            connection.install_extension('sqlite')
+            connection.load_extension('sqlite')
+        return True
+    except duckdb.Error:
+        return False
+    finally:
+        connection.close()
+
+
+def analyze_engine(engine: str) -> str:
+    "Engine to run with, 'auto' is DuckDB when it is installed and can read SQLite"
+    if engine == 'sqlite':
+        return engine
+    if duckdb is None:
+        if engine == 'auto':
+            return 'sqlite'
+        raise CommandError('The duckdb package is not installed, use --engine sqlite')
+    if not duckdb_reads_sqlite():
+        if engine == 'auto':
+            return 'sqlite'
+        raise CommandError('The sqlite extension of DuckDB can not be loaded, use --engine sqlite')
+    return 'duckdb'
+
+
+def run_analysis(engine: str, analysis: str, start: str, end: str) -> tuple:
+    "(column names, rows) of an analysis of the entries starting in [start, end)"
+    sql = f'WITH entries AS ({ANALYZE_ENTRIES[engine]}) {ANALYSES[analysis][1]}'
+    values = (datetime.now().strftime(DB_DATE_FORMAT), start, end)
+    if engine == 'duckdb':
+        # Columnar and parallel, the SQLite file is scanned read only
+        connection = duckdb.connect()
+        try:
+            connection.load_extension('sqlite')
+            connection.execute('SET sqlite_all_varchar = true')
+            path = str(DB_PATH).replace("'", "''")
+            connection.execute(f"ATTACH '{path}' AS timetrack_db (TYPE sqlite, READ_ONLY)")
+            cursor = connection.execute(sql, values)
+            return [column[0] for column in cursor.description], cursor.fetchall()
+        finally:
+            connection.close()
+    connection = connect_readonly(DB_PATH)
+    try:
+        cursor = get_cursor(connection)
+        cursor.execute(sql, values)
+        return [column[0] for column in cursor.description], cursor.fetchall()
+    finally:
+        connection.close()
+
+
+def command_analyze(args: CommandAnalyze):
+    "Run a predefined analysis of the entries, with DuckDB when it is installed"
+    # Archived years are not included, 'list' and 'export' read them
+    start = format_date_or_throw('start', args.start) if args.start else ''
+    # A bare '9999' would compare as a number against the DATETIME column
+    end = format_date_or_throw('end', args.end) if args.end else '9999-12-31T23:59:59Z'
+    engine = analyze_engine(args.engine)
+    columns, rows = run_analysis(engine, args.analysis, start, end)
+
+    if args.format == 'json':
+        json.dump([dict(zip(columns, row)) for row in rows], sys.stdout)
+        print()
+        return
+    if args.format == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(columns)
+        writer.writerows(rows)
+        return
+    cells = [['' if value is None else str(value) for value in row] for row in rows]
+    widths = [max([len(column)] + [len(row[i]) for row in cells]) for i, column in enumerate(columns)]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)).rstrip())
+    for row in cells:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)).rstrip())
+
+
+class CommandSearch(argparse.Namespace):
+    query: str
+    start: Optional[str]
+    end: Optional[str]
+    sort: str
+    limit: int
+    page: int
+    raw: bool
+
+
+def fts_query(query: str) -> str:
+    "Quote every term so punctuation like 'JIRA-123' is matched as a phrase"
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+
+def command_search(args: CommandSearch):
+    "Search time tracking entries by words in the message"
+    query = args.query if args.raw else fts_query(args.query)
+    if not query:
+        raise CommandError('No query given')
+
+    where = ['timetrack_fts MATCH ?']
+    values = [query]
+    if args.start is not None:
+        where.append('t.start >= ?')
+        values.append(format_date_or_throw('start', args.start))
+    if args.end is not None:
+        where.append('t.start < ?')
+        values.append(format_date_or_throw('end', args.end))
+    order_by = 'f.rank' if args.sort == 'rank' else 't.start'
+    values.extend([args.limit, (args.page - 1) * args.limit])
+
+    connection = connect()
     cursor = get_cursor(connection)
-    if end:
+    cursor.execute(
+        'SELECT t.rowid, t.message, t.start, t.end, t.category '
+        'FROM timetrack_fts f '
+        'JOIN timetrack_entries t ON t.rowid = f.rowid '
+        f'WHERE {" AND ".join(where)} '
+        f'ORDER BY {order_by} '
+        'LIMIT ? OFFSET ?',
+        values
+    )
+    rows = cursor.fetchall()
+    connection.close()
+
+    now = datetime.now()
+    rowid_len = max((len(str(row[0])) for row in rows), default=0)
+    for row in rows:
+        Timetracker.from_row(row).show(now, rowid_len)
+    print(f'Page {args.page}: {len(rows)} rows')
+
+
+def epoch_seconds(date: datetime) -> int:
+    return int((date - datetime(1970, 1, 1)).total_seconds())
+
+
+def iter_intersecting(cursor: sqlite3.Cursor, start: datetime, end: datetime):
+    "Yield rows whose [start, end) interval intersects [start, end], running entries included"
+    lo = epoch_seconds(start)
+    hi = epoch_seconds(end)
+    cursor.execute(
+        'SELECT t.rowid, t.message, t.start, t.end, t.category '
+        'FROM timetrack_intervals i '
+        'JOIN timetrack_entries t ON t.rowid = i.id '
+        'WHERE i.start_at <= ? AND i.end_at >= ? '
+        "AND CAST(strftime('%s', t.start) AS INTEGER) <= ? "
+        f"AND coalesce(CAST(strftime('%s', t.end) AS INTEGER), {OPEN_INTERVAL_END}) > ? "
+        'ORDER BY t.start',
+        (hi, lo, hi, lo)
+    )
+    yield from cursor
+
+
+class CommandAt(argparse.Namespace):
+    time: str
+
+
+def command_at(args: CommandAt):
+    "List time tracking entries running at 'time'"
+    time = parse_date_or_throw('time', args.time)
+    connection = connect()
+    cursor = get_cursor(connection)
+    now = datetime.now()
+    for row in iter_intersecting(cursor, time, time):
+        Timetracker.from_row(row).show(now)
+    connection.close()
+
+
+class CommandBetween(argparse.Namespace):
+    start: str
+    end: str
+
+
+def command_between(args: CommandBetween):
+    "List time tracking entries intersecting the 'start' .. 'end' range"
+    start = parse_date_or_throw('start', args.start)
+    end = parse_date_or_throw('end', args.end)
+    if end < start:
+        raise CommandError('The end is before the start')
+    connection = connect()
+    cursor = get_cursor(connection)
+    now = datetime.now()
+    for row in iter_intersecting(cursor, start, end):
+        Timetracker.from_row(row).show(now)
+    connection.close()
+
+
+class CommandBatch(argparse.Namespace):
+    path: str
+    group_size: int
+
+
+BATCH_EDIT_FIELDS = ('message', 'category', 'start', 'end')
+# JSON types of the fields of batch commands and API writes, null stands for
+# a field not given
+FIELD_TYPES = {'op': (str,), 'ref': (str,), 'id': (int, str), 'message': (str,),
+               'category': (str,), 'start': (str,), 'end': (str,), 'last': (bool,)}
+TYPE_NAMES = {str: 'a string', int: 'an integer', bool: 'a boolean'}
+
+
+def check_field_types(fields: dict):
+    for key, types in FIELD_TYPES.items():
+        value = fields.get(key)
+        if value is None:
+            continue
+        # bool is an int in Python but not in JSON
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            raise CommandError(f'Invalid {key!r}, expected {" or ".join(TYPE_NAMES[t] for t in types)}')
+
+
+def resolve_batch_id(command: dict, refs: dict) -> int:
+    if 'ref' in command:
+        if command['ref'] not in refs:
+            raise CommandError(f'Unknown ref {command["ref"]!r}')
+        return refs[command['ref']]
+    if command.get('id') is None:
+        raise CommandError('No id or ref given')
+    return int(command['id'])
+
+
+def apply_batch_command(cursor: sqlite3.Cursor, command: dict, refs: dict) -> dict:
+    check_field_types(command)
+    op = command.get('op')
+    if op == 'start':
+        if not command.get('message'):
+            raise CommandError('No message given')
+        start = datetime.now().strftime(DB_DATE_FORMAT)
+        if command.get('start') is not None:
+            start = format_date_or_throw('start', command['start'])
+        end = None
+        if command.get('end') is not None:
+            end = format_date_or_throw('end', command['end'])
+        entity = insert_entry(
+            cursor, command['message'], start, end, command.get('category'))
+        if 'ref' in command:
+            refs[command['ref']] = entity.rowid
+        return {'entry': entity.to_dict()}
+
+    if op == 'end':
+        rowid = resolve_batch_id(command, refs)
+        end = datetime.now().strftime(DB_DATE_FORMAT)
+        if command.get('end') is not None:
+            end = format_date_or_throw('end', command['end'])
+        return {'entry': end_entry(cursor, rowid, end).to_dict()}
+
+    if op == 'edit':
+        rowid = resolve_batch_id(command, refs)
+        fields = {k: command[k] for k in BATCH_EDIT_FIELDS if k in command}
+        for key in ('message', 'start'):
+            if key in fields and fields[key] is None:
+                raise CommandError(f'No {key} given')
+        if 'start' in fields:
+            fields['start'] = format_date_or_throw('start', fields['start'])
+        # A null end runs the entry again
+        if fields.get('end') is not None:
+            fields['end'] = format_date_or_throw('end', fields['end'])
+        if not fields:
+            raise CommandError('No changes given')
+        return {'entry': update_entry(cursor, rowid, fields).to_dict()}
+
+    if op == 'drop':
+        rowid = resolve_batch_id(command, refs)
+        return {'deleted': delete_entry(cursor, rowid)}
+
+    raise CommandError(f'Unknown op {op!r}')
+
+
+def command_batch(args: CommandBatch):
+    "Apply start/end/edit/drop commands read as NDJSON from 'path' ('-' for stdin)"
+    # Commands are applied in transactions of 'group_size' commands, each one
+    # inside its own savepoint so a failing command does not discard the group.
+    # 'ref' names given to started entries can be used by later commands.
+    connection = connect(isolation_level=None)
+    cursor = get_cursor(connection)
+    source = sys.stdin if args.path == '-' else open(args.path)
+    refs = {}
+    try:
+        with shared_write_lock():
+            for group in batched(enumerate(source, start=1), args.group_size):
+                begin_immediate(cursor)
+                for line_no, line in group:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    result = {'line': line_no}
+                    cursor.execute('SAVEPOINT batch_command')
+                    try:
+                        command = json.loads(line)
+                        if not isinstance(command, dict):
+                            raise CommandError('Expected a JSON object')
+                        result['op'] = command.get('op')
+                        result.update(apply_batch_command(cursor, command, refs))
+                        result['ok'] = True
+                        cursor.execute('RELEASE batch_command')
+                    except (CommandError, ValueError, sqlite3.Error) as e:
+                        cursor.execute('ROLLBACK TO batch_command')
+                        cursor.execute('RELEASE batch_command')
+                        category_cache().clear()
+                        result['ok'] = False
+                        result['error'] = str(e)
+                    print(json.dumps(result))
+                cursor.execute('COMMIT')
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        connection.close()
+
+
+class WorkingSet:
+    "Recent and running entries held in memory, writes persisted behind them by a flush thread"
+    # The working set is the only writer of its database: rowids of new
+    # entries are handed out in memory, so it holds an exclusive lock on
+    # <db>.lock and run_write in other processes refuses to write while it
+    # does. Every write is appended to a journal
+    # before it is acknowledged, and the sequence number of the last write
+    # flushed is committed with the group of writes, so after a crash the
+    # journal replays exactly the writes that did not reach the database.
+
+    def __init__(self, window: timedelta = timedelta(hours=48), flush_interval: float = 1.0,
+                 flush_rows: int = 1000, sync_journal: bool = True, flush_on_close: bool = True):
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.sync_journal = sync_journal
+        self.flush_on_close = flush_on_close
+        self.window = window
+        self.journal_path = Path(f'{DB_PATH}.writes')
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.pending = []
+        # Writes the database refused after they were acknowledged, and the
+        # error of the last flush when it failed
+        self.refused = deque(maxlen=100)
+        self.flush_error = None
+        self.version = 0
+        self.closed = False
+        self.acquire()
+        try:
+            self.seq = self.recover()
+            self.load()
+        except BaseException:
+            self.release()
+            raise
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        self.thread = threading.Thread(target=self.run, name='working-set-flush', daemon=True)
+        self.thread.start()
+
+    def acquire(self):
+        "Take the exclusive writer lock, failing while another process writes"
+        if fcntl is None:
+            raise CommandError('The write-behind working set needs file locks, unavailable on this platform')
+        self.path = str(DB_PATH)
+        self.lock_fd = os.open(writer_lock_path(), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self.lock_fd)
+            raise CommandError('Another process is writing to the database, '
+                               'the working set has to be its only writer')
+        EXCLUSIVE_WRITERS.add(self.path)
+
+    def recover(self) -> int:
+        "Apply the journaled writes missing from the database, returns the last sequence number"
+        def write(cursor):
+            cursor.execute("SELECT value FROM meta WHERE key = 'working_set_seq'")
+            row = cursor.fetchone()
+            seq = int(row[0]) if row else 0
+            replay = []
+            if self.journal_path.exists():
+                with open(self.journal_path, encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            op = json.loads(line)
+                        except ValueError:
+                            # Torn last line, it was never acknowledged
+                            break
+                        if op['seq'] > seq:
+                            replay.append(op)
+            if replay:
+                self.apply(cursor, replay)
+                seq = replay[-1]['seq']
+            return seq
+
+        seq = run_write(write)
+        self.journal_path.unlink(missing_ok=True)
+        return seq
+
+    def load(self):
+        self.since = datetime.now() - self.window
+        connection = connect()
+        cursor = get_cursor(connection)
+        # Served by timetrack_start, running entries come from their own table
         cursor.execute(
-            'SELECT category, start, end '
-            'FROM timetrack '
-            'WHERE start >= ? AND end <= ?',
-            (start, end)
+            'SELECT rowid, message, start, end, category FROM timetrack_entries WHERE start >= ? '
+            'UNION '
+            'SELECT id, message, start, NULL, category FROM timetrack_running',
+            (self.since.strftime(DB_DATE_FORMAT),)
         )
-    else:
+        self.entries_by_id = {row[0]: Timetracker.from_row(row) for row in cursor}
+        # AUTOINCREMENT, rowids of archived and dropped entries are not reused
+        cursor.execute("SELECT coalesce(max(seq), 0) FROM sqlite_sequence WHERE name = 'timetrack'")
+        self.next_rowid = cursor.fetchone()[0] + 1
+        connection.close()
+
+    def covers(self, start: Optional[str]) -> bool:
+        "Whether the entries starting from 'start' are all in memory"
+        return start is not None and parse_date_db(start) >= self.since
+
+    def entries(self, start: Optional[str] = None) -> list:
+        since = parse_date_db(start) if start else self.since
+        with self.lock:
+            return sorted((e for e in self.entries_by_id.values() if e.start >= since),
+                          key=lambda e: (e.start, e.rowid))
+
+    def running(self) -> list:
+        with self.lock:
+            return sorted((e for e in self.entries_by_id.values() if e.end is None),
+                          key=lambda e: (e.start, e.rowid))
+
+    def insert(self, message: str, start: str, end: Optional[str], category: Optional[str]) -> Timetracker:
+        if not self.covers(start):
+            return self.insert_through(message, start, end, category)
+        with self.lock:
+            for entity in self.entries_by_id.values():
+                if entity.message == message and entity.start.strftime(DB_DATE_FORMAT) == start:
+                    raise CommandError(f'An entry "{message}" already starts at {start}')
+            rowid = self.next_rowid
+            self.next_rowid += 1
+            self.queue({'op': 'insert', 'id': rowid, 'message': message,
+                        'start': start, 'end': end, 'category': category})
+            entity = Timetracker.from_row((rowid, message, start, end, category))
+            self.entries_by_id[rowid] = entity
+            return entity
+
+    def insert_through(self, message: str, start: str, end: Optional[str], category: Optional[str]) -> Timetracker:
+        "Write an entry older than the window, whose duplicates are not in memory, to the database"
+        with self.lock:
+            rowid = self.next_rowid
+            self.next_rowid += 1
+        self.flush()
+
+        def write(cursor):
+            cursor.execute(
+                'INSERT INTO timetrack (rowid, message, start, end, category_id) VALUES (?, ?, ?, ?, ?) '
+                f'{RETURNING_ENTRY}',
+                (rowid, message, start, end, category_cache().get_id(cursor, category))
+            )
+            return Timetracker.from_row(cursor.fetchone())
+
+        entity = run_write(write)
+        with self.lock:
+            if end is None:
+                # Running entries stay in memory whatever their age
+                self.entries_by_id[rowid] = entity
+            self.version += 1
+        return entity
+
+    def end(self, rowid: int, end: str) -> Timetracker:
+        with self.lock:
+            entity = self.entries_by_id.get(rowid)
+            if entity is not None:
+                self.queue({'op': 'update', 'id': rowid, 'fields': {'end': end}})
+                entity.end = parse_date_db(end)
+                return entity
+        # Older entries are not in memory, write them through
+        self.flush()
+        entity = run_write(lambda cursor: end_entry(cursor, rowid, end))
+        with self.lock:
+            self.version += 1
+        return entity
+
+    def end_last(self, end: str) -> Timetracker:
+        running = self.running()
+        if not running:
+            raise CommandError('No running entry found')
+        return self.end(running[-1].rowid, end)
+
+    def queue(self, op: dict):
+        "Journal and queue a write, called with the lock held"
+        if self.closed:
+            raise CommandError('The working set is closed')
+        self.seq += 1
+        op['seq'] = self.seq
+        self.journal.write(json.dumps(op) + '\n')
+        self.journal.flush()
+        if self.sync_journal:
+            os.fsync(self.journal.fileno())
+        self.pending.append(op)
+        self.version += 1
+        if len(self.pending) >= self.flush_rows:
+            self.wakeup.notify()
+
+    def apply(self, cursor: sqlite3.Cursor, ops: list) -> list:
+        "Apply the writes in order, returns the ids of the writes the database refused"
+        failed = []
+        for op in ops:
+            cursor.execute('SAVEPOINT working_set_op')
+            try:
+                if op['op'] == 'insert':
+                    cursor.execute(
+                        'INSERT INTO timetrack (rowid, message, start, end, category_id) VALUES (?, ?, ?, ?, ?)',
+                        (op['id'], op['message'], op['start'], op['end'],
+                         category_cache().get_id(cursor, op['category']))
+                    )
+                else:
+                    update_entry(cursor, op['id'], op['fields'])
+            except (sqlite3.IntegrityError, CommandError) as e:
+                cursor.execute('ROLLBACK TO working_set_op')
+                # A category created by the refused write is gone as well
+                category_cache().clear()
+                failed.append(op['id'])
+                self.refused.append({'write': op, 'error': str(e)})
+                print(f'Write {op["seq"]} refused by the database: {e}')
+            cursor.execute('RELEASE working_set_op')
         cursor.execute(
-            'SELECT category, start, end '
-            'FROM timetrack '
-            'WHERE start >= ?',
-            (start,)
-        )
-    rows = cursor.fetchall()
-    rows = [(row[0], parse_date_db(row[1]), row[2] and parse_date_db(row[2]))
-            for row in rows]
-    cat_rows = [row for row in rows if row[0]]
-    print(f'Total rows: {len(rows)}')
-    print(
-        f'Total time: {sum((row[2] - row[1] for row in rows if row[2]), timedelta())}')
-    print(f'Total rows with category: {len(cat_rows)}')
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('working_set_seq', ?)", (str(ops[-1]['seq']),))
+        return failed
+
+    def flush(self):
+        "Write the queued writes to the database in one transaction"
+        with self.flush_lock:
+            with self.lock:
+                ops, self.pending = self.pending, []
+            if not ops:
+                return
+            try:
+                failed = run_write(lambda cursor: self.apply(cursor, ops))
+            except BaseException:
+                with self.lock:
+                    self.pending[:0] = ops
+                category_cache().clear()
+                raise
+            if failed:
+                self.reload(failed)
+            with self.lock:
+                if not self.pending:
+                    self.journal.truncate(0)
+                self.evict()
+
+    def reload(self, rowids: list):
+        "Replace the entries the database refused by their stored version"
+        connection = connect()
+        cursor = get_cursor(connection)
+        with self.lock:
+            for rowid in rowids:
+                cursor.execute(
+                    'SELECT rowid, message, start, end, category FROM timetrack_entries WHERE rowid = ?',
+                    (rowid,))
+                row = cursor.fetchone()
+                if row is None:
+                    self.entries_by_id.pop(rowid, None)
+                else:
+                    self.entries_by_id[rowid] = Timetracker.from_row(row)
+            self.version += 1
+        connection.close()
+
+    def evict(self):
+        "Drop the ended entries that left the window, called with the lock held"
+        self.since = max(self.since, datetime.now() - self.window)
+        old = [rowid for rowid, e in self.entries_by_id.items() if e.end is not None and e.start < self.since]
+        for rowid in old:
+            del self.entries_by_id[rowid]
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.pending and not self.closed:
+                    self.wakeup.wait(self.flush_interval)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+                self.flush_error = None
+            except (CommandError, sqlite3.Error) as e:
+                # Still locked or failing, the writes stay queued and journaled
+                # for the next round
+                if str(e) != self.flush_error:
+                    print(f'Flush failed, {len(self.pending)} writes stay queued: {e}')
+                self.flush_error = str(e)
+
+    def status(self) -> dict:
+        # After a flush, whose writes are not pending while it runs
+        with self.flush_lock, self.lock:
+            return {'pending': len(self.pending), 'flush_error': self.flush_error,
+                    'refused': list(self.refused)}
+
+    def close(self):
+        "Stop the flush thread, flushing the queued writes unless flush_on_close is off"
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        self.thread.join()
+        if self.flush_on_close:
+            self.flush()
+        self.journal.close()
+        self.release()
+
+    def release(self):
+        EXCLUSIVE_WRITERS.discard(self.path)
+        os.close(self.lock_fd)
+
+
+class ConnectionPool:
+    "Connections shared by the request threads, opened once for the server lifetime"
+
+    def __init__(self, size: int):
+        self.connections = queue.LifoQueue()
+        for _ in range(size):
+            self.connections.put(connect(check_same_thread=False))
+
+    @contextmanager
+    def connection(self):
+        connection = self.connections.get()
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                connection.rollback()
+            self.connections.put(connection)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+
+def last_change_seq(cursor: sqlite3.Cursor) -> int:
+    "Last change log sequence number, it grows with every write from any process"
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'timetrack_changes'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+class ResponseCache:
+    "Read responses by request, valid while the data version is unchanged"
+
+    def __init__(self):
+        self.entries = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, version: int, compute) -> tuple:
+        "(etag, body) of 'key', calling compute() for the body when it is out of date"
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1:]
+        with self.lock:
+            key_lock = self.locks.setdefault(key, threading.Lock())
+        # Requests missing the same key wait for one computation
+        with key_lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                return entry[1:]
+            body = compute()
+            etag = f'"{version}-{hashlib.sha1(body).hexdigest()[:16]}"'
+            self.entries[key] = (version, etag, body)
+            return etag, body
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.locks.clear()
+
+
+def entry_dict(row: tuple) -> dict:
+    "Timetracker.to_dict of a (rowid, message, start, end, category) row, without parsing the dates"
+    return {'id': row[0], 'message': row[1], 'start': row[2], 'end': row[3], 'category': row[4]}
+
+
+def api_entries(cursor: sqlite3.Cursor, params: dict):
+    start = list_start(params.get('start'))
+    rows = iter_federated(
+        cursor, lambda cursor, source: select_entries(cursor, source, start), start)
+    return [entry_dict(row) for row in rows]
+
+
+def api_running(cursor: sqlite3.Cursor, params: dict):
+    cursor.execute(
+        'SELECT id, message, start, NULL, category '
+        'FROM timetrack_running '
+        'ORDER BY start'
+    )
+    return [entry_dict(row) for row in cursor.fetchall()]
+
+
+def api_metrics(cursor: sqlite3.Cursor, params: dict):
+    start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    end = None
+    if params.get('start'):
+        start = parse_date_or_throw('start', params['start'])
+    if params.get('end'):
+        end = parse_date_or_throw('end', params['end'])
+    merged = params.get('merged', '').lower() in ('1', 'true', 'yes')
+    return metrics_for(cursor, start, end, merged).to_dict()
+
+
+def api_working_set_read(working_set: WorkingSet, path: str, read, cursor: sqlite3.Cursor, params: dict):
+    if path == '/running':
+        return [e.to_dict() for e in working_set.running()]
+    if path == '/entries':
+        start = list_start(params.get('start'))
+        if working_set.covers(start):
+            return [e.to_dict() for e in working_set.entries(start)]
+    # Older entries and metrics come from the database, once it has the queued writes
+    working_set.flush()
+    return read(cursor, params)
+
+
+def api_start(body: dict, working_set: Optional[WorkingSet] = None):
+    check_field_types(body)
+    if not body.get('message'):
+        raise CommandError('No message given')
+    start = datetime.now().strftime(DB_DATE_FORMAT)
+    if body.get('start') is not None:
+        start = format_date_or_throw('start', body['start'])
+    end = None
+    if body.get('end') is not None:
+        end = format_date_or_throw('end', body['end'])
+    if working_set is not None:
+        return working_set.insert(body['message'], start, end, body.get('category')).to_dict()
+    return run_write(lambda cursor: insert_entry(
+        cursor, body['message'], start, end, body.get('category'))).to_dict()
 
-    for category, category_rows in groupby(cat_rows, key=lambda row: row[0]):
-        print(
-            f'{category}: {sum((row[2] - row[1] for row in category_rows if row[2]), timedelta())}')
+
+def api_end(body: dict, working_set: Optional[WorkingSet] = None):
+    check_field_types(body)
+    end = datetime.now().strftime(DB_DATE_FORMAT)
+    if body.get('end') is not None:
+        end = format_date_or_throw('end', body['end'])
+    if body.get('last'):
+        if working_set is not None:
+            return working_set.end_last(end).to_dict()
+        return run_write(lambda cursor: end_last_entry(cursor, end)).to_dict()
+    if body.get('id') is None:
+        raise CommandError('No id given')
+    if working_set is not None:
+        return working_set.end(int(body['id']), end).to_dict()
+    return run_write(lambda cursor: end_entry(cursor, int(body['id']), end)).to_dict()
+
+
+API_READS = {
+    '/entries': api_entries,
+    '/running': api_running,
+    '/metrics': api_metrics,
+}
+
+API_WRITES = {
+    '/start': api_start,
+    '/end': api_end,
+}
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive, idle ones are dropped after 'timeout'
+    # seconds so they do not hold a pool thread forever
+    protocol_version = 'HTTP/1.1'
+    timeout = 5
+    # Headers and body are separate writes, with Nagle a small body waits
+    # for the delayed ACK of the headers
+    disable_nagle_algorithm = True
+    server: 'ApiServer'
+
+    def send_body(self, status: int, body: bytes, etag: Optional[str] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status: int, message: str):
+        self.send_body(status, json.dumps({'error': message}).encode())
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/writes' and self.server.working_set is not None:
+            self.send_body(200, json.dumps(self.server.working_set.status()).encode())
+            return
+        read = API_READS.get(url.path)
+        if read is None:
+            self.send_error_json(404, f'Unknown endpoint {url.path}')
+            return
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        # Default ranges are relative to today
+        key = (url.path, url.query, date.today())
+        working_set = self.server.working_set
+        with self.server.pool.connection() as connection:
+            cursor = get_cursor(connection)
+            if working_set is None:
+                # Read before the data, a write in between only makes the entry stale
+                version = last_change_seq(cursor)
+            else:
+                # The working set is the only writer, it counts its own writes
+                version = working_set.version
+
+            def compute():
+                if working_set is None:
+                    return read(cursor, params)
+                return api_working_set_read(working_set, url.path, read, cursor, params)
+
+            try:
+                etag, body = self.server.cache.get(key, version, lambda: json.dumps(compute()).encode())
+            except CommandError as e:
+                self.send_error_json(400, str(e))
+                return
+            except sqlite3.Error as e:
+                self.send_error_json(500, str(e))
+                return
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_body(200, body, etag)
+
+    def do_POST(self):
+        write = API_WRITES.get(urlsplit(self.path).path)
+        length = self.headers.get('Content-Length') or '0'
+        if not length.isdigit():
+            # The body can not be skipped, so neither can the connection be kept
+            self.close_connection = True
+            self.send_error_json(400, f'Invalid Content-Length {length!r}')
+            return
+        raw = self.rfile.read(int(length))
+        if write is None:
+            self.send_error_json(404, f'Unknown endpoint {self.path}')
+            return
+        try:
+            body = json.loads(raw or b'{}')
+            if not isinstance(body, dict):
+                raise CommandError('Expected a JSON object')
+            result = write(body, self.server.working_set)
+        except (CommandError, ValueError) as e:
+            self.send_error_json(400, str(e))
+            return
+        except sqlite3.IntegrityError as e:
+            # Such as an entry with the same start and message
+            self.send_error_json(409, str(e))
+            return
+        except sqlite3.Error as e:
+            self.send_error_json(500, str(e))
+            return
+        finally:
+            self.server.cache.clear()
+        self.send_body(201 if write is api_start else 200, json.dumps(result).encode())
+
+    def log_message(self, format, *args):
+        if self.server.log:
+            super().log_message(format, *args)
+
+
+class ApiServer(HTTPServer):
+    "HTTP server handing connections to a fixed pool of threads"
+
+    def __init__(self, address: tuple, threads: int, log: bool = False,
+                 working_set: Optional[WorkingSet] = None):
+        super().__init__(address, ApiHandler)
+        self.executor = ThreadPoolExecutor(threads)
+        self.pool = ConnectionPool(threads)
+        self.cache = ResponseCache()
+        self.log = log
+        self.working_set = working_set
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+        if self.working_set is not None:
+            self.working_set.close()
+
+
+class CommandServeHttp(argparse.Namespace):
+    host: str
+    port: int
+    threads: int
+    log: bool
+    write_behind: bool = False
+    flush_interval: float = 1.0
+    no_sync_journal: bool = False
+
+
+def command_serve_http(args: CommandServeHttp):
+    "Serve entries, running entries and metrics as JSON, and accept start and end"
+    # GET /entries?start=, /running, /metrics?start=&end=&merged=
+    # POST /start {message, category, start, end}, /end {id | last, end}
+    # GET /writes with --write-behind: queued, refused and failed writes
+    working_set = None
+    if args.write_behind:
+        working_set = WorkingSet(flush_interval=args.flush_interval, sync_journal=not args.no_sync_journal)
+    server = ApiServer((args.host, args.port), args.threads, args.log, working_set)
+    host, port = server.server_address[:2]
+    print(f'Serving on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
 def get_parser():
@@ -458,10 +3773,28 @@ def get_parser():
         return parser
 
     parser = argparse.ArgumentParser(description='Time tracker')
+    parser.add_argument('--busy-timeout', type=float, default=DB_BUSY_TIMEOUT,
+                        help='seconds to wait for other writers before retrying')
+    parser.add_argument('--write-attempts', type=int, default=DB_WRITE_ATTEMPTS)
+    parser.add_argument('-u', '--user', default=None,
+                        help='use the database of USER instead of the personal one')
     subparsers = parser.add_subparsers(dest='command')
 
     sb = command(command_setup)
-    sb.add_argument('--database-path', default=DB_PATH)
+    sb.add_argument('--database-path', default=None)
+
+    sb = command(command_maintain)
+    sb.add_argument('--budget', type=float, default=10, help='seconds')
+    sb.add_argument('--vacuum-pages', type=int, default=256)
+
+    sb = command(command_backup)
+    sb.add_argument('path', type=str)
+    sb.add_argument('--pages', type=int, default=256, help='pages copied per step')
+    sb.add_argument('--sleep', type=float, default=0.005, help='seconds between steps')
+    sb.add_argument('--compress', action='store_true', help='write a gzip compressed snapshot')
+
+    sb = command(command_restore)
+    sb.add_argument('path', type=str)
 
     sb = command(command_start)
     sb.add_argument('message', type=str)
@@ -474,35 +3807,150 @@ def get_parser():
     sb.add_argument('message', type=str)
     sb.add_argument('--category', default=None)
 
+    def add_filter_arguments(sb, category_flag='--category'):
+        group = sb.add_argument_group('bulk filter', 'apply to every matching entry instead of one id')
+        group.add_argument('--after', default=None, help='entries started at or after AFTER')
+        group.add_argument('--before', default=None, help='entries started before BEFORE')
+        group.add_argument(category_flag, dest='filter_category', default=None,
+                           help='entries in this category')
+        group.add_argument('--message-like', default=None, help='SQL LIKE pattern, e.g. %%JIRA-1%%')
+        group.add_argument('--running', action='store_true', help='entries still running')
+        group.add_argument('--dry-run', action='store_true',
+                           help='count the matching entries and show the query plan')
+
     sb = command(command_end)
-    sb.add_argument('id', type=int)
+    sb.add_argument('id', type=int, default=None, nargs='?')
     sb.add_argument('--end', default=None)
+    sb.add_argument('--last', action='store_true')
+    add_filter_arguments(sb)
+
+    sb = command(command_status)
+    sb.add_argument('--verify', action='store_true')
 
     sb = command(command_drop)
     sb.add_argument('id', type=int, default=None, nargs='?')
     sb.add_argument('--all', action='store_true')
+    add_filter_arguments(sb)
 
     sb = command(command_edit)
-    sb.add_argument('id', type=int)
+    sb.add_argument('id', type=int, default=None, nargs='?')
     sb.add_argument('-m', '--message', type=str, default=UNSET)
     sb.add_argument('-c', '--category', type=str, default=UNSET)
     sb.add_argument('-s', '--start', default=UNSET)
     sb.add_argument('-e', '--end', default=UNSET)
+    # -c sets the new category, the filter selects on the current one
+    add_filter_arguments(sb, category_flag='--from-category')
 
     sb = command(command_list)
     sb.add_argument('--start', default=None)
+    sb.add_argument('-f', '--follow', action='store_true',
+                    help='keep listing changes as they are written')
+    sb.add_argument('--interval', type=float, default=1.0, help='seconds between polls')
+    sb.add_argument('--filter', default=None,
+                    help="e.g. 'category:dev duration>1h weekday:mon-fri since:2024-01-01'")
+    sb.add_argument('--all-users', action='store_true')
+    sb.add_argument('-j', '--jobs', type=int, default=None)
+
+    sb = command(command_archive)
+    sb.add_argument('before', type=str)
+    sb.add_argument('--compress', action='store_true',
+                    help='store the archived years as zlib compressed blocks')
 
     sb = command(command_export)
     sb.add_argument('path', type=str)
     sb.add_argument('--format', default=None, choices=['csv', 'json'])
+    sb.add_argument('--since', type=int, default=None,
+                    help='sync token printed by the previous export --since')
+    sb.add_argument('--all-users', action='store_true')
+    sb.add_argument('-j', '--jobs', type=int, default=None)
+
+    sb = command(command_export_shards)
+    sb.add_argument('directory', type=str)
+    sb.add_argument('--by', default='month', choices=['year', 'month'])
+    sb.add_argument('--format', default='csv', choices=['csv', 'json'])
+    sb.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+
+    sb = command(command_sync)
+    sb.add_argument('path', type=str, help='database to merge into this one')
+    sb.add_argument('--dry-run', action='store_true', help='only count the differences')
 
     sb = command(command_import)
     sb.add_argument('path', type=str)
     sb.add_argument('--format', default=None, choices=['csv', 'json'])
+    sb.add_argument('-j', '--jobs', type=int, default=1)
+    sb.add_argument('--chunk-size', type=int, default=10000)
 
     sb = command(command_metrics)
     sb.add_argument('--start', default=None)
     sb.add_argument('--end', default=None)
+    sb.add_argument('--merged', action='store_true')
+    sb.add_argument('--filter', default=None,
+                    help="e.g. 'category:dev duration>1h weekday:mon-fri since:2024-01-01'")
+    sb.add_argument('--all-users', action='store_true')
+    sb.add_argument('-j', '--jobs', type=int, default=None)
+
+    sb = command(command_timesheet)
+    sb.add_argument('--start', default=None, help='first day, this week\'s monday by default')
+    sb.add_argument('--end', default=None, help='last day, a week after the start by default')
+    sb.add_argument('--format', default='table', choices=['table', 'csv', 'json'])
+
+    sb = command(command_analyze)
+    sb.add_argument('analysis', choices=list(ANALYSES),
+                    help='; '.join(f'{name}: {help}' for name, (help, _) in ANALYSES.items()))
+    sb.add_argument('--start', default=None)
+    sb.add_argument('--end', default=None)
+    sb.add_argument('--engine', default='auto', choices=['auto', 'duckdb', 'sqlite'],
+                    help='duckdb by default when it is installed and its sqlite extension loads')
+    sb.add_argument('--format', default='table', choices=['table', 'csv', 'json'])
+
+    sb = command(command_add_rule)
+    sb.add_argument('name', type=str)
+    sb.add_argument('kind', choices=['daily', 'running'],
+                    help='daily: total of the entries started on a day, running: a single running entry')
+    sb.add_argument('threshold', type=str, help='duration such as 8h, 90m or 1h30m')
+    sb.add_argument('-c', '--category', default=None, help='only count the entries of this category')
+
+    sb = command(command_drop_rule)
+    sb.add_argument('name', type=str)
+
+    command(command_check_rules)
+
+    sb = command(command_timeline)
+    sb.add_argument('--start', default=None)
+    sb.add_argument('--end', default=None)
+    sb.add_argument('--min-gap', type=int, default=5, help='minutes')
+    sb.add_argument('--max-gap', type=int, default=240, help='minutes')
+
+    sb = command(command_search)
+    sb.add_argument('query', type=str)
+    sb.add_argument('--start', default=None)
+    sb.add_argument('--end', default=None)
+    sb.add_argument('--sort', default='rank', choices=['rank', 'start'])
+    sb.add_argument('--limit', type=int, default=20)
+    sb.add_argument('--page', type=int, default=1)
+    sb.add_argument('--raw', action='store_true')
+
+    sb = command(command_at)
+    sb.add_argument('time', type=str)
+
+    sb = command(command_between)
+    sb.add_argument('start', type=str)
+    sb.add_argument('end', type=str)
+
+    sb = command(command_batch)
+    sb.add_argument('path', type=str, default='-', nargs='?')
+    sb.add_argument('--group-size', type=int, default=1000)
+
+    sb = command(command_serve_http)
+    sb.add_argument('--host', default='127.0.0.1')
+    sb.add_argument('--port', type=int, default=8765)
+    sb.add_argument('--threads', type=int, default=8)
+    sb.add_argument('--log', action='store_true', help='log every request to stderr')
+    sb.add_argument('--write-behind', action='store_true',
+                    help='serve the last 48 hours from memory and write them to the database in the background')
+    sb.add_argument('--flush-interval', type=float, default=1.0, help='seconds between write-behind flushes')
+    sb.add_argument('--no-sync-journal', action='store_true',
+                    help='do not fsync the write-behind journal on every write')
 
     return parser
 
@@ -510,6 +3958,10 @@ def get_parser():
 def main():
     parser = get_parser()
     args = parser.parse_args()
+    global BUSY_TIMEOUT, WRITE_ATTEMPTS, DB_PATH
+    BUSY_TIMEOUT, WRITE_ATTEMPTS = args.busy_timeout, args.write_attempts
+    if args.user is not None:
+        DB_PATH = user_db_path(args.user)
     if args.command:
         args.func(args)
     else:
@@ -11,3 +11,10 @@ DB_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 CLI_PRINT_DATE_FORMAT = '%Y-%m-%d %H:%M'
 CLI_DATE_FORMAT = '%Y/%m/%d'
 CLI_HOUR_FORMAT = '%H:%M'
+
+# Seconds a command waits for another writer before retrying, and how often
+DB_BUSY_TIMEOUT = 5.0
+DB_WRITE_ATTEMPTS = 5
+
+# One database per user for shared installations, see 'cli.py --user'
+USERS_DIR = DATA_DIR / 'users'
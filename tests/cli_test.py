@@ -1,6 +1,16 @@
-from datetime import datetime
-from cli import CommandDrop, CommandEdit, CommandEnd, CommandError, CommandList, CommandStart, CommandStartIn, batched, command_drop, command_edit, command_end, command_list, command_start, command_start_in
+from datetime import datetime, timedelta
+import http.client
+import json
+from pathlib import Path
+import sqlite3
+import subprocess
+import sys
+import cli
+from cli import ApiServer, CommandAddRule, CommandAnalyze, CommandArchive, CommandAt, CommandBackup, CommandBatch, CommandBetween, CommandCheckRules, CommandDrop, CommandDropRule, CommandEdit, CommandEnd, CommandError, CommandExport, CommandExportShards, CommandImport, CommandList, CommandMaintain, CommandMetrics, CommandRestore, CommandSearch, CommandSetup, CommandStart, CommandStartIn, CommandStatus, CommandSync, CommandTimeline, CommandTimesheet, UNSET, WorkingSet, analyze_engine, batched, command_add_rule, command_analyze, command_archive, command_at, command_backup, command_batch, command_between, command_check_rules, command_drop, command_drop_rule, command_edit, command_end, command_export, command_export_shards, command_import, command_list, command_maintain, command_metrics, command_restore, command_search, command_setup, command_start, command_start_in, command_status, command_sync, command_timeline, command_timesheet, compile_filter, delete_entry, end_entry, get_cursor, insert_entry, is_busy, iter_rows_by_start, repair_encoding, run_write, update_entry, user_db_path
+from constants import DB_DATE_FORMAT
 import pytest
+import threading
+import time
 
 
 @pytest.mark.parametrize("values, batch_size, expected", [
@@ -38,9 +48,10 @@ class TestCommandStart:
         # Assert that the correct SQL query was executed
         cursor_mock = get_cursor_mock.return_value
         cursor_mock.execute.assert_called_once_with(
-            'INSERT INTO timetrack (message, start, end, category) '
+            'INSERT INTO timetrack (message, start, end, category_id) '
             'VALUES (?, ?, ?, ?) '
-            'RETURNING rowid, message, start, end, category',
+            'RETURNING rowid, message, start, end, '
+            '(SELECT name FROM categories WHERE id = category_id)',
             (args.message, "2000-01-01T12:00:00Z", None, args.category)
         )
 
@@ -70,9 +81,10 @@ class TestCommandStartIn:
 
         # Assert that the correct SQL query was executed
         cursor_mock.execute.assert_called_with(
-            'INSERT INTO timetrack (message, start, end, category) '
+            'INSERT INTO timetrack (message, start, end, category_id) '
             'VALUES (?, ?, ?, ?) '
-            'RETURNING rowid, message, start, end, category',
+            'RETURNING rowid, message, start, end, '
+            '(SELECT name FROM categories WHERE id = category_id)',
             (args.message, "2000-01-01T12:00:00Z", None, args.category)
         )
 
@@ -124,7 +136,8 @@ class TestCommandEnd:
         cursor_mock = get_cursor_mock.return_value
         cursor_mock.execute.assert_called_once_with(
             'UPDATE timetrack SET end = ? WHERE rowid = ? '
-            'RETURNING rowid, message, start, end, category',
+            'RETURNING rowid, message, start, end, '
+            '(SELECT name FROM categories WHERE id = category_id)',
             ("2000-01-01T12:00:00Z", args.id)
         )
 
@@ -175,10 +188,11 @@ class TestCommandEdit:
         # Assert that the correct SQL query was executed
         cursor_mock = get_cursor_mock.return_value
         cursor_mock.execute.mock_calls[1](
-            'UPDATE timetrack SET message = ?, category = ?, start = ?, end = ? WHERE rowid = ? '
-            'RETURNING rowid, message, start, end, category',
-            ['New message', 'New category',
-                '2022-01-01T00:00:00Z', '2022-01-02T00:00:00Z', 1]
+            'UPDATE timetrack SET message = ?, start = ?, end = ?, category_id = ? WHERE rowid = ? '
+            'RETURNING rowid, message, start, end, '
+            '(SELECT name FROM categories WHERE id = category_id)',
+            ['New message', '2022-01-01T00:00:00Z', '2022-01-02T00:00:00Z',
+                1, 1]
         )
 
 
@@ -255,3 +269,1399 @@ class TestCommandList:
             'ORDER BY start',
             ('2099-01-01T00:00:00Z',)
         )
+
+
+@pytest.fixture
+def database(tmp_path, mocker):
+    path = tmp_path / 'data.db'
+    mocker.patch('cli.DB_PATH', path)
+    command_setup(CommandSetup(database_path=path))
+    return path
+
+
+def insert_entries(connection, entries):
+    "Insert (start, end, message, category) entries through the cli write path"
+    cursor = connection.cursor()
+    for start, end, message, category in entries:
+        insert_entry(cursor, message, start, end, category)
+    connection.commit()
+
+
+class TestCommandBatch:
+    # Applies commands in order, resolving refs to entries started in the batch
+    def test_resolves_forward_refs(self, database, tmp_path, capsys):
+        commands = tmp_path / 'commands.ndjson'
+        commands.write_text('\n'.join([
+            '{"op": "start", "message": "build", "start": "2000-01-01", "ref": "b"}',
+            '{"op": "end", "ref": "b", "end": "2000-01-02"}',
+            '{"op": "end", "ref": "missing"}',
+            '{"op": "edit", "ref": "b", "category": "ci"}',
+        ]))
+
+        command_batch(CommandBatch(path=str(commands), group_size=2))
+
+        results = [json.loads(line)
+                   for line in capsys.readouterr().out.splitlines()]
+        assert [r['ok'] for r in results] == [True, True, False, True]
+        assert results[2]['error'] == "Unknown ref 'missing'"
+        assert results[3]['entry'] == {
+            'id': 1,
+            'message': 'build',
+            'start': '2000-01-01T00:00:00Z',
+            'end': '2000-01-02T00:00:00Z',
+            'category': 'ci',
+        }
+
+    # A failing command is rolled back without discarding the rest of the group
+    def test_failed_command_keeps_group(self, database, tmp_path, capsys):
+        commands = tmp_path / 'commands.ndjson'
+        commands.write_text('\n'.join([
+            '{"op": "start", "message": "a", "start": "2000-01-01"}',
+            '{"op": "start", "message": "a", "start": "2000-01-01"}',
+            '{"op": "start", "message": "b", "start": "2000-01-01"}',
+        ]))
+
+        command_batch(CommandBatch(path=str(commands), group_size=10))
+
+        connection = sqlite3.connect(database)
+        rows = connection.execute(
+            'SELECT message FROM timetrack ORDER BY message').fetchall()
+        assert rows == [('a',), ('b',)]
+
+    # Fields of the wrong JSON type fail their command only
+    def test_invalid_field_types(self, database, tmp_path, capsys):
+        commands = tmp_path / 'commands.ndjson'
+        commands.write_text('\n'.join([
+            '{"op": "start", "message": "a", "start": "2000-01-01"}',
+            '{"op": "edit", "id": 1, "start": null}',
+            '{"op": "start", "message": "b", "start": 5}',
+            '{"op": "end", "id": [1]}',
+            '{"op": "start", "message": "c", "start": "2000-01-02", "ref": {}}',
+        ]))
+
+        command_batch(CommandBatch(path=str(commands), group_size=10))
+
+        results = [json.loads(line)
+                   for line in capsys.readouterr().out.splitlines()]
+        assert [r['ok'] for r in results] == [True, False, False, False, False]
+        assert results[1]['error'] == 'No start given'
+        assert results[2]['error'] == "Invalid 'start', expected a string"
+        assert results[3]['error'] == "Invalid 'id', expected an integer or a string"
+        connection = sqlite3.connect(database)
+        assert connection.execute('SELECT message FROM timetrack').fetchall() == [('a',)]
+        connection.close()
+
+
+class TestCommandSearch:
+    # Finds entries by words in the message, kept in sync by triggers
+    def test_search_follows_writes(self, database, capsys):
+        connection = sqlite3.connect(database)
+        connection.executemany(
+            'INSERT INTO timetrack (start, message) VALUES (?, ?)',
+            [('2000-01-01T10:00:00Z', 'Review JIRA-123'),
+             ('2000-01-02T10:00:00Z', 'Standup'),
+             ('2000-01-03T10:00:00Z', 'Fix JIRA-123 tests')])
+        connection.execute(
+            "UPDATE timetrack SET message = 'Standup JIRA-123' WHERE rowid = 2")
+        connection.execute('DELETE FROM timetrack WHERE rowid = 1')
+        connection.commit()
+        connection.close()
+
+        command_search(CommandSearch(
+            query='jira-123', start='2000-01-02', end=None, sort='start',
+            limit=20, page=1, raw=False))
+
+        out = capsys.readouterr().out.splitlines()
+        assert [line.split(':')[0] for line in out[:-1]] == ['2', '3']
+        assert out[-1] == 'Page 1: 2 rows'
+
+
+class TestCommandTimeline:
+    # Reports overlaps, gaps and concurrently running entries in one sweep
+    def test_finds_overlaps_gaps_and_running(self, database, capsys):
+        connection = sqlite3.connect(database)
+        connection.executemany(
+            'INSERT INTO timetrack (start, end, message) VALUES (?, ?, ?)',
+            [('2000-01-01T09:00:00Z', '2000-01-01T11:00:00Z', 'a'),
+             ('2000-01-01T10:00:00Z', '2000-01-01T10:30:00Z', 'b'),
+             ('2000-01-01T12:00:00Z', None, 'c'),
+             ('2000-01-01T13:00:00Z', None, 'd')])
+        connection.commit()
+        connection.close()
+
+        command_timeline(CommandTimeline(
+            start=None, end=None, min_gap=5, max_gap=240))
+
+        out = capsys.readouterr().out.splitlines()
+        assert [line.split()[0] for line in out[:-1]] == [
+            'overlap', 'gap', 'overlap', 'running']
+        assert out[0].endswith('| 00:30 | 1, 2')
+        assert out[1].endswith('| 01:00 | 1, 3')
+        assert out[-1] == 'Found 2 overlaps, 1 gaps, 1 groups of running entries'
+
+
+def test_iter_rows_by_start_in_chunks(database):
+    connection = sqlite3.connect(database)
+    connection.executemany(
+        'INSERT INTO timetrack (start, message) VALUES (?, ?)',
+        [('2000-01-02T00:00:00Z', 'c'), ('2000-01-01T00:00:00Z', 'b'),
+         ('2000-01-01T00:00:00Z', 'a'), ('1999-01-01T00:00:00Z', 'x')])
+    rows = iter_rows_by_start(
+        connection.cursor(), start='2000-01-01T00:00:00Z', chunk_size=2)
+    assert [row[1] for row in rows] == ['a', 'b', 'c']
+
+
+class TestCommandMetrics:
+    # Overlapping time is counted once in merged mode
+    def test_merged_counts_overlap_once(self, database, capsys):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('2000-01-01T09:00:00Z', '2000-01-01T11:00:00Z', 'a', 'dev'),
+            ('2000-01-01T10:00:00Z', '2000-01-01T12:00:00Z', 'b', 'dev'),
+            ('2000-01-01T13:00:00Z', '2000-01-01T14:00:00Z', 'c', 'ops')])
+        connection.close()
+
+        command_metrics(CommandMetrics(
+            start='2000-01-01', end=None, merged=True))
+
+        assert capsys.readouterr().out.splitlines() == [
+            'Total rows: 3',
+            'Total time: 4:00:00',
+            'Total rows with category: 3',
+            'dev: 3:00:00',
+            'ops: 1:00:00',
+        ]
+
+
+class TestIntervalQueries:
+    # Long running and still open entries that started earlier are included
+    def test_between_includes_long_and_open_entries(self, database, capsys):
+        connection = sqlite3.connect(database)
+        connection.executemany(
+            'INSERT INTO timetrack (start, end, message) VALUES (?, ?, ?)',
+            [('1999-12-01T09:00:00Z', '2000-01-05T00:00:00Z', 'long'),
+             ('2000-01-01T14:30:00Z', '2000-01-01T14:45:00Z', 'inside'),
+             ('2000-01-01T15:00:01Z', '2000-01-01T16:00:00Z', 'after'),
+             ('2000-01-01T13:00:00Z', '2000-01-01T14:00:00Z', 'before'),
+             ('2000-01-01T10:00:00Z', None, 'open')])
+        connection.execute("UPDATE timetrack SET end = '2000-01-01T14:10:00Z' "
+                           "WHERE message = 'before'")
+        connection.commit()
+        connection.close()
+
+        command_between(CommandBetween(
+            start='2000-01-01 14:00', end='2000-01-01 15:00'))
+
+        out = capsys.readouterr().out
+        assert [line.split(':')[0].strip() for line in out.splitlines()] == [
+            '1', '5', '4', '2']
+
+    def test_at(self, database, capsys):
+        connection = sqlite3.connect(database)
+        connection.executemany(
+            'INSERT INTO timetrack (start, end, message) VALUES (?, ?, ?)',
+            [('2000-01-01T09:00:00Z', '2000-01-01T10:00:00Z', 'a'),
+             ('2000-01-01T10:00:00Z', '2000-01-01T11:00:00Z', 'b')])
+        connection.commit()
+        connection.close()
+
+        command_at(CommandAt(time='2000-01-01 10:00'))
+
+        assert capsys.readouterr().out.split(':')[0] == '2'
+
+
+class TestRunningEntries:
+    # status reads the running entries kept in sync by the writes
+    def test_status_follows_writes(self, database, capsys):
+        connection = sqlite3.connect(database)
+        connection.executemany(
+            'INSERT INTO timetrack (start, end, message) VALUES (?, ?, ?)',
+            [('2000-01-01T09:00:00Z', None, 'a'),
+             ('2000-01-01T10:00:00Z', None, 'b'),
+             ('2000-01-01T11:00:00Z', '2000-01-01T12:00:00Z', 'c')])
+        connection.execute("UPDATE timetrack SET end = NULL WHERE rowid = 3")
+        connection.execute("DELETE FROM timetrack WHERE rowid = 2")
+        connection.commit()
+        connection.close()
+
+        command_status(CommandStatus(verify=True))
+
+        out = capsys.readouterr().out.splitlines()
+        assert [line.split(':')[0] for line in out] == ['1', '3']
+
+    # end --last rebuilds the cache when it does not match the database
+    def test_end_last_with_stale_cache(self, database, capsys):
+        connection = sqlite3.connect(database)
+        connection.executemany(
+            'INSERT INTO timetrack (start, end, message) VALUES (?, ?, ?)',
+            [('2000-01-01T09:00:00Z', None, 'a'),
+             ('2000-01-01T10:00:00Z', None, 'b')])
+        connection.execute(
+            "INSERT INTO timetrack_running (id, message, start) "
+            "VALUES (99, 'gone', '2000-01-02T00:00:00Z')")
+        connection.commit()
+
+        command_end(CommandEnd(id=None, end='2000-01-01 12:00', last=True))
+
+        assert capsys.readouterr().out.split(':')[0] == '2'
+        assert connection.execute(
+            'SELECT id FROM timetrack_running').fetchall() == [(1,)]
+
+
+class TestCommandImport:
+    # Parallel import inserts exactly the same rows as the single process one
+    @pytest.mark.parametrize('jobs', [1, 3])
+    def test_import_csv(self, database, tmp_path, capsys, jobs):
+        path = tmp_path / 'import.csv'
+        lines = ['start,end,category,message']
+        lines += [f'2000-01-01T00:{i:02d}:00Z,2000/01/02,"dev","task, {i}"'
+                  for i in range(50)]
+        path.write_text('\n'.join(lines) + '\n')
+
+        command_import(CommandImport(
+            path=str(path), format=None, jobs=jobs, chunk_size=7))
+
+        connection = sqlite3.connect(database)
+        rows = connection.execute(
+            'SELECT rowid, start, end, category, message FROM timetrack_entries'
+        ).fetchall()
+        assert len(rows) == 50
+        assert rows[-1] == (50, '2000-01-01T00:49:00Z',
+                            '2000-01-02T00:00:00Z', 'dev', 'task, 49')
+        assert capsys.readouterr().out == f'Imported 50 rows from {path}\n'
+
+    def test_import_invalid_date(self, database, tmp_path):
+        path = tmp_path / 'import.json'
+        path.write_text(json.dumps([
+            {'start': '2000-01-01', 'end': None, 'category': None, 'message': 'a'},
+            {'start': 'yesterday', 'end': None, 'category': None, 'message': 'b'},
+        ]))
+
+        with pytest.raises(CommandError) as exc_info:
+            command_import(CommandImport(path=str(path), format=None))
+
+        assert str(exc_info.value).startswith('Invalid record 2:')
+
+
+    # Chunks are cut at records, a quoted message may span lines
+    @pytest.mark.parametrize('chunk_size', [1, 2, 100])
+    def test_import_multiline_csv(self, database, tmp_path, chunk_size):
+        path = tmp_path / 'import.csv'
+        path.write_text('start,end,category,message\n'
+                        '2000-01-01,,,"line1\nline2"\n'
+                        '2000-01-02,,,b\n')
+
+        command_import(CommandImport(path=str(path), format=None, chunk_size=chunk_size))
+
+        connection = sqlite3.connect(database)
+        messages = [row[0] for row in connection.execute('SELECT message FROM timetrack ORDER BY start')]
+        assert messages == ['line1\nline2', 'b']
+        connection.close()
+
+        path.write_text('start,end,category,message\n'
+                        '2000-01-03,,,"line1\nline2"\n'
+                        'yesterday,,,c\n')
+        with pytest.raises(CommandError, match='Invalid record 4:'):
+            command_import(CommandImport(path=str(path), format=None, chunk_size=chunk_size))
+
+
+class TestCommandExportShards:
+    # Re-running only rewrites the partitions that changed
+    def test_incremental_export(self, database, tmp_path, capsys):
+        connection = sqlite3.connect(database)
+        connection.executemany(
+            'INSERT INTO timetrack (start, end, message) VALUES (?, ?, ?)',
+            [('2000-01-01T09:00:00Z', '2000-01-01T10:00:00Z', 'a'),
+             ('2000-01-31T09:00:00Z', None, 'b'),
+             ('2000-02-01T09:00:00Z', None, 'c')])
+        connection.commit()
+        shards = tmp_path / 'shards'
+        args = CommandExportShards(
+            directory=str(shards), by='month', format='json', jobs=2)
+
+        command_export_shards(args)
+        connection.execute("UPDATE timetrack SET end = '2000-02-01T10:00:00Z' "
+                           "WHERE message = 'c'")
+        connection.commit()
+        command_export_shards(args)
+
+        assert capsys.readouterr().out.splitlines() == [
+            f'Exported 3 rows in 2 shards to {shards} (2 written, 0 unchanged)',
+            f'Exported 3 rows in 2 shards to {shards} (1 written, 1 unchanged)',
+        ]
+        manifest = json.loads((shards / 'manifest.json').read_text())
+        assert {key: shard['rows'] for key, shard in manifest['shards'].items()} == {
+            '2000-01': 2, '2000-02': 1}
+        assert json.loads((shards / '2000-02.json').read_text())[0]['end'] == \
+            '2000-02-01T10:00:00Z'
+
+
+    # Archived partitions are still exported, their shards are kept
+    @pytest.mark.parametrize('compress', [False, True])
+    def test_archived_partitions(self, database, tmp_path, capsys, compress):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('2019-06-01T09:00:00Z', '2019-06-01T10:00:00Z', 'a', 'dev'),
+            ('2020-06-01T09:00:00Z', None, 'b', None)])
+        connection.close()
+        shards = tmp_path / 'shards'
+        args = CommandExportShards(directory=str(shards), by='year', format='json', jobs=1)
+        command_export_shards(args)
+
+        command_archive(CommandArchive(before='2020-01-01', compress=compress))
+        command_export_shards(args)
+
+        assert capsys.readouterr().out.splitlines()[-1] == \
+            f'Exported 2 rows in 2 shards to {shards} (0 written, 2 unchanged)'
+        assert [row['message'] for row in json.loads((shards / '2019.json').read_text())] == ['a']
+
+
+class TestCommandExportSince:
+    # Only the latest change of the entries written after the token is exported
+    def test_export_changes_since_token(self, database, tmp_path, capsys):
+        connection = sqlite3.connect(database)
+        connection.executemany(
+            'INSERT INTO timetrack (start, message) VALUES (?, ?)',
+            [('2000-01-01T09:00:00Z', 'a'), ('2000-01-01T10:00:00Z', 'b')])
+        connection.commit()
+        path = tmp_path / 'changes.json'
+        command_export(CommandExport(path=str(path), format=None, since=0))
+        token = int(capsys.readouterr().out.split()[-1])
+
+        connection.execute("UPDATE timetrack SET end = '2000-01-01T11:00:00Z' "
+                           "WHERE rowid = 2")
+        update_entry(connection.cursor(), 2, {'category': 'dev'})
+        connection.execute("DELETE FROM timetrack WHERE rowid = 1")
+        connection.commit()
+        command_export(CommandExport(path=str(path), format=None, since=token))
+
+        assert json.loads(path.read_text()) == [
+            {'id': 2, 'op': 'upsert', 'start': '2000-01-01T10:00:00Z',
+             'end': '2000-01-01T11:00:00Z', 'category': 'dev', 'message': 'b'},
+            {'id': 1, 'op': 'delete', 'start': None,
+             'end': None, 'category': None, 'message': None},
+        ]
+        assert capsys.readouterr().out.splitlines()[-1] == \
+            f'Next sync token: {token + 3}'
+
+
+class TestCommandArchive:
+    # Archived entries, plain or compressed, are still read by list, metrics and export
+    @pytest.mark.parametrize('compress', [False, True])
+    def test_archive_and_read_back(self, database, tmp_path, capsys, compress):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('2019-06-01T09:00:00Z', '2019-06-01T10:00:00Z', 'a', 'dev'),
+            ('2020-06-01T09:00:00Z', None, 'b', 'dev'),
+            ('2020-07-01T09:00:00Z', '2020-07-01T11:00:00Z', 'c', 'dev'),
+            ('2021-06-01T09:00:00Z', '2021-06-01T10:00:00Z', 'd', 'dev')])
+        connection.execute('SELECT MAX(seq) FROM timetrack_changes')
+        token = connection.execute(
+            'SELECT MAX(seq) FROM timetrack_changes').fetchone()[0]
+
+        command_archive(CommandArchive(before='2021-01-01', compress=compress))
+
+        assert connection.execute(
+            'SELECT message FROM timetrack ORDER BY start').fetchall() == [('b',), ('d',)]
+        assert sorted(p.name for p in (tmp_path / 'data-archive').iterdir()) == [
+            '2019.db', '2020.db']
+        archive = sqlite3.connect(tmp_path / 'data-archive' / '2020.db')
+        plain_rows = archive.execute('SELECT COUNT(*) FROM timetrack').fetchone()
+        assert plain_rows == ((0,) if compress else (1,))
+        capsys.readouterr()
+
+        command_list(CommandList(start='all'))
+        listed = capsys.readouterr().out.splitlines()
+        assert [line.split(':')[0] for line in listed] == ['1', '2', '3', '4']
+
+        command_metrics(CommandMetrics(start='2020-01-01', end=None))
+        assert capsys.readouterr().out.splitlines()[:2] == [
+            'Total rows: 3', 'Total time: 3:00:00']
+
+        path = tmp_path / 'export.json'
+        command_export(CommandExport(path=str(path), format=None))
+        assert [row['message'] for row in json.loads(path.read_text())] == [
+            'a', 'b', 'c', 'd']
+        command_export(CommandExport(path=str(path), format=None, since=token))
+        assert json.loads(path.read_text()) == []
+
+    # The rowid of an archived entry is not handed out again, nor exported as a change
+    def test_rowids_not_reused(self, database, tmp_path, capsys):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('2021-06-01T09:00:00Z', '2021-06-01T10:00:00Z', 'a', 'dev'),
+            ('2019-06-01T09:00:00Z', '2019-06-01T10:00:00Z', 'b', 'dev')])
+        command_archive(CommandArchive(before='2020-01-01'))
+        insert_entries(connection, [('2019-07-01T09:00:00Z', '2019-07-01T10:00:00Z', 'c', 'dev')])
+        command_archive(CommandArchive(before='2020-01-01'))
+        connection.close()
+        capsys.readouterr()
+
+        command_list(CommandList(start='all'))
+        listed = capsys.readouterr().out.splitlines()
+        assert [line.split(':')[0] for line in listed] == ['2', '3', '1']
+
+        path = tmp_path / 'export.json'
+        command_export(CommandExport(path=str(path), format=None, since=0))
+        assert [(row['id'], row['message']) for row in json.loads(path.read_text())] == [(1, 'a')]
+
+    # Migrated databases continue after the rowids the change log has seen
+    def test_migration_keeps_dropped_rowids(self, tmp_path, mocker):
+        path = tmp_path / 'old.db'
+        mocker.patch('cli.MIGRATIONS', cli.MIGRATIONS[:-1])
+        command_setup(CommandSetup(database_path=path))
+        connection = sqlite3.connect(path)
+        insert_entries(connection, [('2000-01-01T09:00:00Z', None, 'a', None),
+                                    ('2000-01-02T09:00:00Z', None, 'b', None)])
+        connection.execute('DELETE FROM timetrack WHERE rowid = 2')
+        connection.commit()
+        mocker.stopall()
+
+        command_setup(CommandSetup(database_path=path))
+
+        insert_entries(connection, [('2000-01-03T09:00:00Z', None, 'c', None)])
+        assert connection.execute('SELECT rowid, message FROM timetrack_entries ORDER BY rowid').fetchall() == [
+            (1, 'a'), (3, 'c')]
+        connection.close()
+
+
+class TestCategories:
+    # Existing text categories are rewritten to ids without logging changes
+    def test_migrate_text_categories(self, tmp_path):
+        path = tmp_path / 'old.db'
+        connection = sqlite3.connect(path)
+        connection.execute(
+            'CREATE TABLE timetrack (start DATETIME NOT NULL, message TEXT NOT NULL, '
+            'end DATETIME, category TEXT)')
+        connection.executemany(
+            'INSERT INTO timetrack (start, end, message, category) VALUES (?, ?, ?, ?)',
+            [('2000-01-01T09:00:00Z', None, 'a', 'ops'),
+             ('2000-01-01T10:00:00Z', None, 'b', 'dev'),
+             ('2000-01-01T11:00:00Z', None, 'c', None)])
+        connection.commit()
+
+        command_setup(CommandSetup(database_path=path))
+
+        assert connection.execute(
+            'SELECT rowid, category_id FROM timetrack ORDER BY rowid').fetchall() == [
+            (1, 2), (2, 1), (3, None)]
+        assert connection.execute(
+            'SELECT id, category FROM timetrack_running ORDER BY id').fetchall() == [
+            (1, 'ops'), (2, 'dev'), (3, None)]
+        assert connection.execute(
+            "SELECT COUNT(*) FROM timetrack_changes WHERE op = 'update'").fetchone() == (0,)
+
+    # Unknown categories are created on first use and rejected ids fail
+    def test_category_ids(self, database):
+        connection = sqlite3.connect(database)
+        cursor = get_cursor(connection)
+        entity = insert_entry(cursor, 'a', '2000-01-01T09:00:00Z', None, 'dev')
+        insert_entry(cursor, 'b', '2000-01-01T10:00:00Z', None, 'dev')
+        connection.commit()
+
+        assert entity.category == 'dev'
+        assert connection.execute('SELECT * FROM categories').fetchall() == [(1, 'dev')]
+        with pytest.raises(sqlite3.IntegrityError):
+            cursor.execute('UPDATE timetrack SET category_id = 2 WHERE rowid = 1')
+
+    # Ids of categories created by a rolled back write are not reused
+    def test_rolled_back_category(self, database):
+        run_write(lambda cursor: insert_entry(cursor, 'a', '2000-01-01T09:00:00Z', None, None))
+        with pytest.raises(sqlite3.IntegrityError):
+            run_write(lambda cursor: insert_entry(cursor, 'a', '2000-01-01T09:00:00Z', None, 'new'))
+
+        entity = run_write(lambda cursor: insert_entry(cursor, 'b', '2000-01-01T10:00:00Z', None, 'new'))
+
+        assert entity.category == 'new'
+
+    # Metrics read archived category names without creating them
+    def test_metrics_of_archived_categories(self, database, capsys):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [('2019-06-01T09:00:00Z', '2019-06-01T10:00:00Z', 'a', 'gone')])
+        command_archive(CommandArchive(before='2020-01-01', compress=False))
+        connection.execute('DELETE FROM categories')
+        connection.commit()
+        cli.category_cache().clear()
+        capsys.readouterr()
+
+        command_metrics(CommandMetrics(start='2019-01-01', end=None))
+
+        assert 'gone' in capsys.readouterr().out
+        assert connection.execute('SELECT COUNT(*) FROM categories').fetchone() == (0,)
+        connection.close()
+
+
+class TestCommandMaintain:
+    # Free pages left by deletes are reclaimed by the incremental vacuum
+    def test_reclaims_space(self, database, capsys):
+        connection = sqlite3.connect(database)
+        connection.executemany(
+            'INSERT INTO timetrack (start, message) VALUES (?, ?)',
+            [(f'2000-01-01T00:00:{i % 60:02d}Z', 'x' * 500 + str(i)) for i in range(2000)])
+        connection.commit()
+        connection.execute('DELETE FROM timetrack')
+        connection.commit()
+        connection.close()
+
+        command_maintain(CommandMaintain(budget=10, vacuum_pages=64))
+
+        out = capsys.readouterr().out.splitlines()
+        assert [line.split(':')[0] for line in out[:-1]] == [
+            'optimize', 'analyze', 'vacuum', 'checkpoint', 'quick_check']
+        assert out[4].startswith('quick_check: ok')
+        assert out[-1].startswith('Reclaimed ')
+        assert out[-1].split()[3:6] == ['0', 'free', 'pages']
+        assert int(out[-1].split()[1]) > 0
+
+    def test_out_of_budget(self, database, capsys):
+        command_maintain(CommandMaintain(budget=0, vacuum_pages=64))
+
+        out = capsys.readouterr().out.splitlines()
+        assert out[0] == 'optimize: skipped, out of time budget'
+
+
+class TestCommandBackup:
+    @pytest.mark.parametrize('compress', [False, True])
+    def test_round_trip(self, database, tmp_path, compress):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('2000-01-01T00:00:00Z', '2000-01-01T01:00:00Z', 'one', 'dev'),
+            ('2000-01-02T00:00:00Z', None, 'two', None),
+        ])
+        connection.close()
+        backup = tmp_path / 'backup.db'
+
+        command_backup(CommandBackup(path=str(backup), pages=1, sleep=0, compress=compress))
+        assert (backup.read_bytes()[:2] == b'\x1f\x8b') == compress
+        connection = sqlite3.connect(database)
+        connection.execute('DELETE FROM timetrack')
+        connection.commit()
+        connection.close()
+        command_restore(CommandRestore(path=str(backup)))
+
+        connection = sqlite3.connect(database)
+        rows = connection.execute(
+            'SELECT start, end, message, category FROM timetrack_entries ORDER BY start').fetchall()
+        assert rows == [
+            ('2000-01-01T00:00:00Z', '2000-01-01T01:00:00Z', 'one', 'dev'),
+            ('2000-01-02T00:00:00Z', None, 'two', None),
+        ]
+        assert connection.execute('SELECT id FROM timetrack_running').fetchall() == [(2,)]
+
+    def test_rejects_invalid_backup(self, database, tmp_path):
+        backup = tmp_path / 'backup.db'
+        backup.write_bytes(b'not a database' * 100)
+
+        with pytest.raises(CommandError, match='not a database'):
+            command_restore(CommandRestore(path=str(backup)))
+
+
+class TestRunWrite:
+    # A writer holding the lock past the busy timeout makes the command retry
+    def test_retries_while_locked(self, database, mocker):
+        mocker.patch('cli.BUSY_TIMEOUT', 0)
+        sleep = mocker.patch('cli.time.sleep')
+        blocker = sqlite3.connect(database, isolation_level=None)
+        blocker.execute('BEGIN IMMEDIATE')
+        attempts = []
+
+        def write(cursor):
+            attempts.append(len(attempts))
+            cursor.execute("INSERT INTO timetrack (start, message) VALUES ('2000-01-01', 'x')")
+            return cursor.lastrowid
+
+        def release(delay):
+            if blocker.in_transaction and sleep.call_count == 2:
+                blocker.execute('COMMIT')
+        sleep.side_effect = release
+
+        assert run_write(write) == 1
+        assert sleep.call_count == 2
+        assert attempts == [0]
+
+    def test_gives_up(self, database, mocker):
+        mocker.patch('cli.BUSY_TIMEOUT', 0)
+        mocker.patch('cli.WRITE_ATTEMPTS', 3)
+        sleep = mocker.patch('cli.time.sleep')
+        blocker = sqlite3.connect(database, isolation_level=None)
+        blocker.execute('BEGIN IMMEDIATE')
+
+        with pytest.raises(CommandError, match='still locked after 3 attempts'):
+            run_write(lambda cursor: None)
+        assert sleep.call_count == 2
+        delays = [call.args[0] for call in sleep.call_args_list]
+        assert delays[0] <= 0.05 and delays[1] <= 0.1
+        blocker.execute('ROLLBACK')
+
+    # Bulk writers take the write lock with the same retries
+    @pytest.mark.parametrize('command', ['batch', 'import'])
+    def test_bulk_writers_retry_while_locked(self, database, tmp_path, mocker, capsys, command):
+        mocker.patch('cli.BUSY_TIMEOUT', 0)
+        sleep = mocker.patch('cli.time.sleep')
+        blocker = sqlite3.connect(database, isolation_level=None)
+        blocker.execute('BEGIN IMMEDIATE')
+
+        def release(delay):
+            if blocker.in_transaction and sleep.call_count == 2:
+                blocker.execute('COMMIT')
+        sleep.side_effect = release
+
+        if command == 'batch':
+            path = tmp_path / 'commands.ndjson'
+            path.write_text('{"op": "start", "message": "a", "start": "2000-01-01"}\n')
+            command_batch(CommandBatch(path=str(path), group_size=10))
+        else:
+            path = tmp_path / 'import.csv'
+            path.write_text('start,end,category,message\n2000-01-01T00:00:00Z,,dev,a\n')
+            command_import(CommandImport(path=str(path), format=None))
+
+        assert sleep.call_count == 2
+        connection = sqlite3.connect(database)
+        assert connection.execute('SELECT message FROM timetrack').fetchall() == [('a',)]
+        connection.close()
+
+    # Errors raised before Python 3.11 carry no sqlite_errorcode
+    def test_busy_without_error_code(self):
+        assert is_busy(sqlite3.OperationalError('database is locked'))
+        assert is_busy(sqlite3.OperationalError('database table is locked: timetrack'))
+        assert not is_busy(sqlite3.OperationalError('no such table: timetrack'))
+
+    def test_enforces_foreign_keys(self, database):
+        def write(cursor):
+            cursor.execute(
+                "INSERT INTO timetrack (start, message, category_id) VALUES ('2000-01-01T00:00:00Z', 'x', 999)")
+
+        with pytest.raises(sqlite3.IntegrityError):
+            run_write(write)
+        connection = sqlite3.connect(database)
+        assert connection.execute('SELECT count(*) FROM timetrack').fetchone() == (0,)
+        connection.close()
+
+
+class TestUsers:
+    @pytest.fixture
+    def users(self, tmp_path, mocker):
+        mocker.patch('cli.USERS_DIR', tmp_path / 'users')
+        entries = {
+            'alice': [('2000-01-01T09:00:00Z', '2000-01-01T10:00:00Z', 'a', 'dev'),
+                      ('2000-01-03T09:00:00Z', '2000-01-03T09:30:00Z', 'c', 'ops')],
+            'bob': [('2000-01-02T09:00:00Z', '2000-01-02T11:00:00Z', 'b', 'dev')],
+        }
+        for user, user_entries in entries.items():
+            path = user_db_path(user)
+            command_setup(CommandSetup(database_path=path))
+            connection = sqlite3.connect(path)
+            mocker.patch('cli.DB_PATH', path)
+            insert_entries(connection, user_entries)
+            connection.close()
+
+    def test_invalid_user_name(self):
+        with pytest.raises(CommandError, match='Invalid user name'):
+            user_db_path('../other')
+
+    # Totals are reported per user and summed across users
+    def test_metrics_all_users(self, users, capsys):
+        command_metrics(CommandMetrics(start='2000-01-01', end=None, all_users=True, jobs=2))
+
+        assert capsys.readouterr().out.splitlines() == [
+            'alice: 2 rows, 1:30:00',
+            'bob: 1 rows, 2:00:00',
+            'Total rows: 3',
+            'Total time: 3:30:00',
+            'Total rows with category: 3',
+            'dev: 3:00:00',
+            'ops: 0:30:00',
+        ]
+
+    def test_export_all_users(self, users, tmp_path):
+        path = tmp_path / 'export.csv'
+        command_export(CommandExport(path=str(path), format=None, all_users=True, jobs=2))
+
+        assert path.read_text().splitlines() == [
+            'user,start,end,category,message',
+            'alice,2000-01-01T09:00:00Z,2000-01-01T10:00:00Z,"dev","a"',
+            'bob,2000-01-02T09:00:00Z,2000-01-02T11:00:00Z,"dev","b"',
+            'alice,2000-01-03T09:00:00Z,2000-01-03T09:30:00Z,"ops","c"',
+        ]
+
+
+class TestServeHttp:
+    @pytest.fixture
+    def server(self, database):
+        server = ApiServer(('127.0.0.1', 0), 2)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        yield server
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    def request(self, connection, method, path, body=None, headers=None):
+        connection.request(method, path, body=None if body is None else json.dumps(body),
+                           headers=headers or {})
+        response = connection.getresponse()
+        data = response.read()
+        return response, data and json.loads(data)
+
+    # Reads are served from the cache until a write changes the data version
+    def test_etag_until_write(self, server):
+        connection = http.client.HTTPConnection(*server.server_address[:2])
+        response, entries = self.request(connection, 'GET', '/entries?start=all')
+        assert response.status == 200 and entries == []
+        etag = response.getheader('ETag')
+
+        response, _ = self.request(connection, 'GET', '/entries?start=all', headers={'If-None-Match': etag})
+        assert response.status == 304
+
+        response, entry = self.request(connection, 'POST', '/start', {
+            'message': 'build', 'category': 'ci', 'start': '2000-01-01 10:00'})
+        assert response.status == 201
+        assert entry == {'id': 1, 'message': 'build', 'start': '2000-01-01T10:00:00Z',
+                         'end': None, 'category': 'ci'}
+
+        response, entries = self.request(connection, 'GET', '/entries?start=all', headers={'If-None-Match': etag})
+        assert response.status == 200 and entries == [entry]
+        assert response.getheader('ETag') != etag
+        response, running = self.request(connection, 'GET', '/running')
+        assert running == [entry]
+
+        response, ended = self.request(connection, 'POST', '/end', {'last': True, 'end': '2000-01-01 12:00'})
+        assert ended['end'] == '2000-01-01T12:00:00Z'
+        response, metrics = self.request(connection, 'GET', '/metrics?start=2000-01-01')
+        assert metrics == {'rows': 1, 'total_seconds': 7200.0, 'category_rows': 1,
+                           'categories': {'ci': 7200.0}}
+        connection.close()
+
+    def test_errors(self, server):
+        connection = http.client.HTTPConnection(*server.server_address[:2])
+        response, body = self.request(connection, 'GET', '/nope')
+        assert response.status == 404
+        response, body = self.request(connection, 'POST', '/end', {})
+        assert response.status == 400 and body == {'error': 'No id given'}
+        response, body = self.request(connection, 'GET', '/metrics?start=yesterday-ish')
+        assert response.status == 400
+        entry = {'message': 'build', 'start': '2000-01-01 10:00'}
+        response, body = self.request(connection, 'POST', '/start', entry)
+        assert response.status == 201
+        response, body = self.request(connection, 'POST', '/start', entry)
+        assert response.status == 409 and 'UNIQUE' in body['error']
+        # Fields of the wrong type are refused and the connection is kept
+        response, body = self.request(connection, 'POST', '/start', {'message': 'x', 'start': 5})
+        assert response.status == 400 and body == {'error': "Invalid 'start', expected a string"}
+        response, body = self.request(connection, 'POST', '/end', {'id': {}})
+        assert response.status == 400
+        response, body = self.request(connection, 'GET', '/running')
+        assert response.status == 200
+        connection.close()
+        connection = http.client.HTTPConnection(*server.server_address[:2])
+        response, body = self.request(connection, 'POST', '/start', headers={'Content-Length': 'many'})
+        assert response.status == 400 and body == {'error': "Invalid Content-Length 'many'"}
+        connection.close()
+
+
+class TestListFollow:
+    # Only entries changed by other connections are printed after the first listing
+    def test_follow_prints_changes(self, database, mocker, capsys):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('2000-01-01T09:00:00Z', None, 'a', None),
+            ('2000-01-01T10:00:00Z', '2000-01-01T11:00:00Z', 'b', None),
+        ])
+        writes = [
+            lambda cursor: end_entry(cursor, 1, '2000-01-01T09:30:00Z'),
+            lambda cursor: insert_entry(cursor, 'c', '2000-01-01T12:00:00Z', None, 'dev'),
+            lambda cursor: delete_entry(cursor, 2),
+            None,
+            lambda cursor: insert_entry(cursor, 'old', '1999-01-01T12:00:00Z', None, None),
+        ]
+
+        def sleep(interval):
+            if not writes:
+                raise KeyboardInterrupt
+            write = writes.pop(0)
+            if write:
+                write(connection.cursor())
+                connection.commit()
+        mocker.patch('cli.time.sleep', side_effect=sleep)
+        fetch_changes = mocker.spy(cli, 'fetch_changes')
+
+        command_list(CommandList(start='2000-01-01', follow=True))
+        connection.close()
+
+        lines = [line.split()[-1] for line in capsys.readouterr().out.splitlines()]
+        assert lines == ['a', 'b', 'a', 'c', 'deleted']
+        # The poll without a commit in between read no rows
+        assert fetch_changes.call_count == 4
+
+
+class TestBulkFilters:
+    @pytest.fixture
+    def entries(self, database):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('2000-01-01T09:00:00Z', '2000-01-01T10:00:00Z', 'JIRA-1 a', 'dev'),
+            ('2000-01-02T09:00:00Z', None, 'JIRA-2 b', 'dev'),
+            ('2000-01-03T09:00:00Z', None, 'standup', 'meeting'),
+            ('2000-02-01T09:00:00Z', '2000-02-01T10:00:00Z', 'JIRA-3 c', 'dev'),
+        ])
+        yield connection
+        connection.close()
+
+    def rows(self, connection):
+        return connection.execute(
+            'SELECT rowid, end, category FROM timetrack_entries ORDER BY rowid').fetchall()
+
+    # The dry run uses the category index and leaves the entries untouched
+    def test_dry_run(self, entries, capsys):
+        before = self.rows(entries)
+        command_drop(CommandDrop(id=None, all=False, filter_category='dev',
+                                 before='2000-02-01', dry_run=True))
+
+        out = capsys.readouterr().out.splitlines()
+        assert out[0].startswith('Plan: SEARCH timetrack USING')
+        assert out[-1] == 'Would delete 2 rows'
+        assert self.rows(entries) == before
+
+    def test_edit_category_in_range(self, entries, capsys):
+        command_edit(CommandEdit(id=None, message=UNSET, category='work', start=UNSET, end=UNSET,
+                                 filter_category='dev', after='2000-01-01', before='2000-02-01'))
+
+        assert capsys.readouterr().out == 'Updated 2 rows\n'
+        assert [row[2] for row in self.rows(entries)] == ['work', 'work', 'meeting', 'dev']
+
+    def test_end_running_by_message(self, entries, capsys):
+        command_end(CommandEnd(id=None, end='2000-03-01', message_like='JIRA-%'))
+
+        assert capsys.readouterr().out == 'Ended 1 entries\n'
+        assert [row[1] for row in self.rows(entries)] == [
+            '2000-01-01T10:00:00Z', '2000-03-01T00:00:00Z', None, '2000-02-01T10:00:00Z']
+
+    def test_drop_without_filter(self, entries):
+        with pytest.raises(CommandError, match='No id given'):
+            command_drop(CommandDrop(id=None, all=False))
+
+
+class TestFilterExpressions:
+    @pytest.fixture
+    def entries(self, database):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            # 2000-01-01 is a Saturday
+            ('2000-01-01T09:00:00Z', '2000-01-01T12:00:00Z', 'JIRA-1 weekend', 'dev'),
+            ('2000-01-03T09:00:00Z', '2000-01-03T09:30:00Z', 'JIRA-2 short', 'dev'),
+            ('2000-01-04T09:00:00Z', '2000-01-04T11:00:00Z', 'JIRA-3 long', 'dev'),
+            ('2000-01-05T09:00:00Z', '2000-01-05T11:00:00Z', 'planning', 'meeting'),
+            ('2000-01-06T09:00:00Z', '2000-01-06T11:00:00Z', 'JIRA-4 unfiled', None),
+        ])
+        connection.close()
+
+    def listed(self, capsys):
+        return [line.split(' | ')[-1] for line in capsys.readouterr().out.splitlines()]
+
+    def test_list(self, entries, capsys):
+        command_list(CommandList(start=None, filter='category:dev duration>1h weekday:mon-fri since:2000-01-01'))
+        assert self.listed(capsys) == ['JIRA-3 long']
+
+        command_list(CommandList(start='all', filter='category:none,meeting'))
+        assert self.listed(capsys) == ['planning', 'JIRA-4 unfiled']
+
+        command_list(CommandList(start='all', filter='-category:none,dev'))
+        assert self.listed(capsys) == ['planning']
+
+        command_list(CommandList(start='all', filter='"JIRA-" -category:dev'))
+        assert self.listed(capsys) == ['JIRA-4 unfiled']
+
+        command_list(CommandList(start='all', filter='category:none running:no'))
+        assert self.listed(capsys) == ['JIRA-4 unfiled']
+
+    def test_metrics(self, entries, capsys):
+        command_metrics(CommandMetrics(start=None, end=None, filter='since:2000-01-01 weekday:sat,sun,mon'))
+
+        assert capsys.readouterr().out.splitlines() == [
+            'Total rows: 2',
+            'Total time: 3:30:00',
+            'Total rows with category: 2',
+            'dev: 3:30:00',
+        ]
+
+    def test_compiled_once(self):
+        entry_filter = compile_filter('category:dev duration>=1h30m')
+        assert compile_filter('category:dev duration>=1h30m') is entry_filter
+        assert entry_filter.where.startswith('category IN (?)')
+
+    @pytest.mark.parametrize('expression, error', [
+        ('duration>1x', 'Invalid duration'),
+        ('weekday:someday', 'Invalid weekday'),
+        ('colour:red', 'Unknown filter'),
+        ('since>2000-01-01', 'Use since:VALUE'),
+        ('"unterminated', 'Invalid filter'),
+    ])
+    def test_invalid(self, expression, error):
+        with pytest.raises(CommandError, match=error):
+            compile_filter(expression)
+
+
+class TestCommandTimesheet:
+    # Entries crossing midnight or the range bounds are split per day
+    def test_pivot(self, database, capsys):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('1999-12-31T23:00:00Z', '2000-01-03T01:00:00Z', 'long', 'dev'),
+            ('2000-01-03T22:00:00Z', '2000-01-04T02:00:00Z', 'night', 'dev'),
+            ('2000-01-04T09:00:00Z', '2000-01-04T10:30:00Z', 'standup', 'meeting'),
+            ('2000-01-09T23:00:00Z', '2000-01-10T01:00:00Z', 'unfiled', None),
+        ])
+        connection.close()
+
+        command_timesheet(CommandTimesheet(start='2000-01-03', end='2000-01-10', format='csv'))
+
+        assert capsys.readouterr().out.splitlines() == [
+            'day,dev,meeting,(none),total,week_total,cumulative',
+            '2000-01-03,3.0,0.0,0.0,3.0,7.5,3.0',
+            '2000-01-04,2.0,1.5,0.0,3.5,7.5,6.5',
+            '2000-01-05,0.0,0.0,0.0,0.0,7.5,6.5',
+            '2000-01-06,0.0,0.0,0.0,0.0,7.5,6.5',
+            '2000-01-07,0.0,0.0,0.0,0.0,7.5,6.5',
+            '2000-01-08,0.0,0.0,0.0,0.0,7.5,6.5',
+            '2000-01-09,0.0,0.0,1.0,1.0,7.5,7.5',
+            '2000-01-10,0.0,0.0,1.0,1.0,1.0,8.5',
+        ]
+
+    def test_table_week_totals(self, database, capsys):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('2000-01-04T09:00:00Z', '2000-01-04T10:30:00Z', 'standup', 'meeting'),
+        ])
+        connection.close()
+
+        command_timesheet(CommandTimesheet(start='2000-01-03'))
+
+        out = capsys.readouterr().out.splitlines()
+        assert len(out) == 9
+        assert out[-1].split() == ['2000-W01', '01:30', '01:30']
+
+    # A monday to sunday week across the new year is one week
+    def test_week_across_new_year(self, database, capsys):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('2024-12-30T09:00:00Z', '2024-12-30T10:00:00Z', 'old year', None),
+            ('2025-01-02T09:00:00Z', '2025-01-02T10:00:00Z', 'new year', None),
+        ])
+        connection.close()
+
+        command_timesheet(CommandTimesheet(start='2024-12-30', end='2025-01-05', format='json'))
+
+        days = json.loads(capsys.readouterr().out)
+        assert {(day['week'], day['week_total']) for day in days} == {('2025-W01', 2.0)}
+
+    # Archived weeks are billed as before, with their ISO 8601 week
+    @pytest.mark.parametrize('compress', [False, True])
+    def test_archived_entries(self, database, capsys, compress):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('2018-12-31T22:00:00Z', '2019-04-29T01:00:00Z', 'very long', 'dev'),
+            ('2019-04-29T09:00:00Z', '2019-04-29T14:00:00Z', 'billed', 'dev'),
+            ('2019-05-06T09:00:00Z', '2019-05-06T10:00:00Z', 'next week', 'dev'),
+        ])
+        connection.close()
+        command_archive(CommandArchive(before='2020-01-01', compress=compress))
+        capsys.readouterr()
+
+        command_timesheet(CommandTimesheet(start='2019-04-29', end='2019-05-05', format='json'))
+
+        days = json.loads(capsys.readouterr().out)
+        assert {(day['week'], day['week_total']) for day in days} == {('2019-W18', 6.0)}
+        assert days[0]['categories'] == {'dev': 6.0}
+
+
+class TestCommandSync:
+    @pytest.fixture
+    def other(self, database, tmp_path, mocker):
+        path = tmp_path / 'other.db'
+        command_setup(CommandSetup(database_path=path))
+        return path
+
+    def fill(self, mocker, path, entries):
+        mocker.patch('cli.DB_PATH', path)
+        connection = sqlite3.connect(path)
+        insert_entries(connection, entries)
+        connection.close()
+
+    def rows(self, path):
+        connection = sqlite3.connect(path)
+        rows = connection.execute(
+            'SELECT start, message, end, category FROM timetrack_entries ORDER BY start').fetchall()
+        connection.close()
+        return rows
+
+    def test_merges_differing_days(self, database, other, mocker, capsys):
+        shared = [
+            ('2000-01-01T09:00:00Z', '2000-01-01T10:00:00Z', 'standup', 'meeting'),
+            ('2000-02-01T09:00:00Z', '2000-02-01T10:00:00Z', 'review', 'dev'),
+        ]
+        self.fill(mocker, other, shared + [
+            ('2000-02-02T09:00:00Z', '2000-02-02T10:00:00Z', 'deploy', 'ops'),
+            ('2000-02-03T09:00:00Z', None, 'running', None),
+        ])
+        self.fill(mocker, database, shared + [
+            ('2000-02-03T09:00:00Z', None, 'running', None),
+            ('2000-02-04T09:00:00Z', '2000-02-04T10:00:00Z', 'local', 'dev'),
+        ])
+        # The other side ended the running entry after the local side last touched it
+        connection = sqlite3.connect(other)
+        connection.execute("UPDATE timetrack SET end = '2000-02-03T11:00:00Z' WHERE message = 'running'")
+        connection.execute("UPDATE timetrack_changes SET changed_at = '2099-01-01T00:00:00Z' WHERE op = 'update'")
+        connection.commit()
+        connection.close()
+        expected = self.rows(other) + [('2000-02-04T09:00:00Z', 'local', '2000-02-04T10:00:00Z', 'dev')]
+
+        command_sync(CommandSync(path=str(other), dry_run=True))
+        assert capsys.readouterr().out.splitlines() == [
+            '1 months and 3 days differ',
+            'Would insert 1, update 1, 1 only here',
+        ]
+        assert len(self.rows(database)) == 4
+
+        command_sync(CommandSync(path=str(other)))
+        assert capsys.readouterr().out.splitlines() == [
+            '1 months and 3 days differ',
+            'Inserted 1, updated 1, 1 only here',
+        ]
+        assert self.rows(database) == expected
+
+        command_sync(CommandSync(path=str(other)))
+        assert capsys.readouterr().out.splitlines()[0] == '1 months and 1 days differ'
+
+    def test_older_remote_change_loses(self, database, other, mocker, capsys):
+        entry = [('2000-01-01T09:00:00Z', None, 'running', None)]
+        self.fill(mocker, other, entry)
+        self.fill(mocker, database, entry)
+        connection = sqlite3.connect(other)
+        connection.execute("UPDATE timetrack SET end = '2000-01-01T10:00:00Z'")
+        connection.execute("UPDATE timetrack_changes SET changed_at = '1999-01-01T00:00:00Z'")
+        connection.commit()
+        connection.close()
+
+        command_sync(CommandSync(path=str(other)))
+
+        assert capsys.readouterr().out.splitlines()[1] == 'Inserted 0, updated 0, 0 only here'
+        assert self.rows(database)[0][2] is None
+
+    # Entries archived on either side are not brought back to the hot table
+    @pytest.mark.parametrize('compress', [False, True])
+    def test_skips_archived_entries(self, database, other, mocker, capsys, compress):
+        archived = [('2019-06-01T09:00:00Z', '2019-06-01T10:00:00Z', 'old', None)]
+        self.fill(mocker, other, archived + [('2020-02-01T09:00:00Z', None, 'new', None)])
+        self.fill(mocker, database, archived)
+        command_archive(CommandArchive(before='2020-01-01', compress=compress))
+        capsys.readouterr()
+
+        command_sync(CommandSync(path=str(other)))
+
+        assert capsys.readouterr().out.splitlines()[1] == 'Inserted 1, updated 0, 0 only here'
+        assert self.rows(database) == [('2020-02-01T09:00:00Z', 'new', None, None)]
+
+    def test_rejects_missing_database(self, database, tmp_path):
+        with pytest.raises(CommandError):
+            command_sync(CommandSync(path=str(tmp_path / 'missing.db')))
+
+
+class TestEncodingRepair:
+    def mojibake(self, message):
+        return message.encode('utf-8').decode('latin-1')
+
+    def test_repairs_once_in_batches(self, database):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('2000-01-01T09:00:00Z', None, self.mojibake('réunion'), None),
+            ('2000-01-02T09:00:00Z', None, 'café', None),
+            ('2000-01-03T09:00:00Z', None, self.mojibake('€ budget'), None),
+            ('2000-01-04T09:00:00Z', None, 'plain', None),
+            ('2000-01-05T09:00:00Z', None, self.mojibake('déjà vu'), None),
+            ('2000-01-05T09:00:00Z', None, 'déjà vu', None),
+        ])
+        # Resumes after the rows an interrupted repair already went through
+        connection.execute("INSERT INTO meta (key, value) VALUES ('encoding_repaired_rowid', '2')")
+        connection.execute("DELETE FROM meta WHERE key = 'encoding'")
+        connection.commit()
+
+        assert repair_encoding(connection, batch_size=2) == 2
+
+        assert [row[0] for row in connection.execute('SELECT message FROM timetrack ORDER BY rowid')] == [
+            self.mojibake('réunion'), 'café', '€ budget', 'plain', 'déjà vu',
+        ]
+        assert connection.execute('SELECT key, value FROM meta').fetchall() == [('encoding', 'utf-8')]
+        assert connection.execute(
+            "SELECT rowid FROM timetrack_fts WHERE timetrack_fts MATCH 'budget'").fetchall() == [(3,)]
+        assert repair_encoding(connection) == 0
+        connection.close()
+
+    # A correctly encoded entry with other data does not replace the mis-encoded one
+    def test_keeps_different_entry(self, database, capsys):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('2000-01-05T09:00:00Z', '2000-01-05T11:00:00Z', self.mojibake('déjà vu'), 'dev'),
+            ('2000-01-05T09:00:00Z', '2000-01-05T11:30:00Z', 'déjà vu', 'ops'),
+        ])
+        connection.execute("INSERT INTO meta (key, value) VALUES ('encoding_repaired_rowid', '0')")
+        connection.execute("DELETE FROM meta WHERE key = 'encoding'")
+        connection.commit()
+
+        assert repair_encoding(connection) == 0
+
+        assert capsys.readouterr().out == 'Entry 1 left mis-encoded, entry 2 has the same start and message\n'
+        assert connection.execute('SELECT message, end FROM timetrack ORDER BY rowid').fetchall() == [
+            (self.mojibake('déjà vu'), '2000-01-05T11:00:00Z'), ('déjà vu', '2000-01-05T11:30:00Z'),
+        ]
+        connection.close()
+
+
+class TestWorkingSet:
+    def stored(self, database):
+        connection = sqlite3.connect(database)
+        rows = connection.execute('SELECT rowid, message, end FROM timetrack ORDER BY rowid').fetchall()
+        connection.close()
+        return rows
+
+    def test_reads_from_memory_and_flushes_in_order(self, database):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('2000-01-01T09:00:00Z', '2000-01-01T10:00:00Z', 'old', None),
+            ('2000-01-02T09:00:00Z', None, 'forgotten', None),
+        ])
+        connection.close()
+        now = datetime.now()
+        start = (now - timedelta(hours=1)).strftime(DB_DATE_FORMAT)
+
+        working_set = WorkingSet(flush_interval=60)
+        try:
+            # Running entries are loaded whatever their age
+            assert [e.message for e in working_set.entries()] == []
+            assert [e.message for e in working_set.running()] == ['forgotten']
+
+            entry = working_set.insert('build', start, None, 'ci')
+            assert entry.rowid == 3
+            with pytest.raises(CommandError):
+                working_set.insert('build', start, None, 'ci')
+            working_set.end(3, now.strftime(DB_DATE_FORMAT))
+            assert [(e.message, e.end is not None) for e in working_set.entries()] == [('build', True)]
+            assert len(self.stored(database)) == 2
+
+            working_set.flush()
+            assert self.stored(database)[-1] == (3, 'build', now.strftime(DB_DATE_FORMAT))
+            assert working_set.journal_path.stat().st_size == 0
+        finally:
+            working_set.close()
+
+    def test_recovers_journal_after_crash(self, database):
+        start = datetime.now().strftime(DB_DATE_FORMAT)
+        working_set = WorkingSet(flush_interval=60, flush_on_close=False)
+        working_set.insert('first', start, None, None)
+        working_set.flush()
+        working_set.insert('second', start, None, 'ci')
+        working_set.end(1, start)
+        working_set.close()
+        assert self.stored(database) == [(1, 'first', None)]
+
+        working_set = WorkingSet(flush_interval=60)
+        try:
+            assert self.stored(database) == [(1, 'first', start), (2, 'second', None)]
+            assert [e.message for e in working_set.running()] == ['second']
+            assert not working_set.journal_path.exists() or working_set.journal_path.stat().st_size == 0
+        finally:
+            working_set.close()
+
+    # Other writers would take the rowids handed out in memory
+    def test_only_writer(self, database):
+        working_set = WorkingSet(flush_interval=60)
+        try:
+            with pytest.raises(CommandError, match='only writer'):
+                WorkingSet(flush_interval=60)
+            other = subprocess.run(
+                [sys.executable, '-c',
+                 'import sys, cli; cli.DB_PATH = cli.Path(sys.argv[1]); '
+                 'cli.command_start(cli.CommandStart(message="cli", category=None, start=None, end=None))',
+                 str(database)],
+                cwd=Path(cli.__file__).parent, capture_output=True, text=True)
+            assert other.returncode != 0 and 'write-behind server' in other.stderr
+            assert working_set.insert('kept', datetime.now().strftime(DB_DATE_FORMAT), None, None).rowid == 1
+        finally:
+            working_set.close()
+        assert self.stored(database) == [(1, 'kept', None)]
+
+    # Entries older than the window are checked against the database, not acknowledged and lost
+    def test_inserts_old_entries_through(self, database):
+        working_set = WorkingSet(flush_interval=60)
+        try:
+            working_set.insert('recent', datetime.now().strftime(DB_DATE_FORMAT), None, None)
+            entry = working_set.insert('old', '2019-05-01T10:00:00Z', '2019-05-01T11:00:00Z', 'dev')
+            assert entry.rowid == 2
+            assert self.stored(database) == [(1, 'recent', None), (2, 'old', '2019-05-01T11:00:00Z')]
+            with pytest.raises(sqlite3.IntegrityError):
+                working_set.insert('old', '2019-05-01T10:00:00Z', None, None)
+            assert working_set.insert('newer', datetime.now().strftime(DB_DATE_FORMAT), None, None).rowid == 4
+        finally:
+            working_set.close()
+        assert [row[0] for row in self.stored(database)] == [1, 2, 4]
+
+    # A failing flush keeps the thread and the queued writes, and is reported
+    def test_flush_errors_are_kept(self, database, mocker, capsys):
+        failing = threading.Event()
+        failing.set()
+        write = cli.run_write
+
+        def run_write(func):
+            if failing.is_set():
+                raise sqlite3.OperationalError('disk I/O error')
+            return write(func)
+
+        working_set = WorkingSet(flush_interval=0.01)
+        mocker.patch('cli.run_write', side_effect=run_write)
+        try:
+            working_set.insert('kept', datetime.now().strftime(DB_DATE_FORMAT), None, None)
+            deadline = time.monotonic() + 5
+            while working_set.status()['flush_error'] is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert working_set.status() == {'pending': 1, 'flush_error': 'disk I/O error', 'refused': []}
+            failing.clear()
+            while working_set.status()['pending'] and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert working_set.thread.is_alive()
+            assert self.stored(database) == [(1, 'kept', None)]
+        finally:
+            working_set.close()
+        assert 'Flush failed, 1 writes stay queued: disk I/O error' in capsys.readouterr().out
+
+    def test_serve_http_write_behind(self, database):
+        server = ApiServer(('127.0.0.1', 0), 2, working_set=WorkingSet(flush_interval=60))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            connection = http.client.HTTPConnection(*server.server_address[:2])
+            connection.request('POST', '/start', json.dumps({'message': 'build'}))
+            response = connection.getresponse()
+            assert response.status == 201 and json.loads(response.read())['id'] == 1
+            connection.request('GET', '/running')
+            assert [e['message'] for e in json.loads(connection.getresponse().read())] == ['build']
+            assert self.stored(database) == []
+            # Reads outside the window see the queued writes too
+            connection.request('GET', '/entries?start=all')
+            assert [e['message'] for e in json.loads(connection.getresponse().read())] == ['build']
+            assert self.stored(database) == [(1, 'build', None)]
+            connection.request('GET', '/writes')
+            assert json.loads(connection.getresponse().read()) == {
+                'pending': 0, 'flush_error': None, 'refused': []}
+            connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+
+class TestCommandAnalyze:
+    @pytest.fixture
+    def entries(self, database):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('1999-06-07T09:00:00Z', '1999-06-07T10:00:00Z', 'standup', 'meeting'),
+            ('2000-01-03T09:00:00Z', '2000-01-03T11:00:00Z', 'review', 'dev'),
+            ('2000-01-04T09:00:00Z', '2000-01-04T13:00:00Z', 'build', 'dev'),
+            ('2000-02-01T14:00:00Z', '2000-02-01T14:30:00Z', 'standup', 'meeting'),
+        ])
+        connection.close()
+
+    def run(self, capsys, analysis, **kwargs):
+        command_analyze(CommandAnalyze(analysis=analysis, engine='sqlite', format='json', **kwargs))
+        return json.loads(capsys.readouterr().out)
+
+    def test_trend(self, entries, capsys):
+        assert self.run(capsys, 'trend') == [
+            {'year': 1999, 'category': 'meeting', 'hours': 1.0, 'entries': 1, 'change': None},
+            {'year': 2000, 'category': 'dev', 'hours': 6.0, 'entries': 2, 'change': None},
+            {'year': 2000, 'category': 'meeting', 'hours': 0.5, 'entries': 1, 'change': -0.5},
+        ]
+
+    def test_quantiles_and_range(self, entries, capsys):
+        assert self.run(capsys, 'quantiles', start='2000-01-01') == [
+            {'category': 'dev', 'entries': 2, 'p50': 2.0, 'p90': 4.0, 'p99': 4.0, 'max': 4.0},
+            {'category': 'meeting', 'entries': 1, 'p50': 0.5, 'p90': 0.5, 'p99': 0.5, 'max': 0.5},
+        ]
+        assert self.run(capsys, 'heatmap', end='2000-01-04') == [
+            {'day': 'Mon', 'hour': 9, 'hours': 3.0, 'entries': 2},
+        ]
+
+    def test_duckdb_missing(self, entries, mocker):
+        mocker.patch('cli.duckdb', None)
+        with pytest.raises(CommandError):
+            command_analyze(CommandAnalyze(analysis='monthly', engine='duckdb'))
+
+    # Without the sqlite extension, offline for instance, auto runs on SQLite
+    def test_duckdb_without_extension(self, entries, mocker):
+        duckdb = mocker.patch('cli.duckdb')
+        duckdb.Error = RuntimeError
+        duckdb.connect.return_value.install_extension.side_effect = RuntimeError('Failed to download extension')
+        duckdb.connect.return_value.load_extension.side_effect = RuntimeError('Extension not found')
+
+        assert analyze_engine('auto') == 'sqlite'
+        with pytest.raises(CommandError, match='sqlite extension'):
+            analyze_engine('duckdb')
+
+    @pytest.mark.parametrize('analysis', ['trend', 'quantiles', 'heatmap', 'monthly'])
+    def test_duckdb_matches_sqlite(self, entries, capsys, analysis):
+        if analyze_engine('auto') != 'duckdb':
+            pytest.skip('DuckDB or its sqlite extension is not available')
+        expected = self.run(capsys, analysis)
+        command_analyze(CommandAnalyze(analysis=analysis, engine='duckdb', format='json'))
+        assert json.loads(capsys.readouterr().out) == expected
+
+
+class TestRules:
+    def totals(self, database):
+        connection = sqlite3.connect(database)
+        rows = connection.execute('SELECT day, rule_id, seconds FROM rule_totals ORDER BY day, rule_id').fetchall()
+        connection.close()
+        return rows
+
+    def test_daily_totals_follow_writes(self, database, capsys):
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ('2000-01-03T09:00:00Z', '2000-01-03T11:00:00Z', 'review', 'dev'),
+            ('2000-01-03T11:00:00Z', '2000-01-03T12:00:00Z', 'standup', 'meeting'),
+        ])
+        connection.close()
+        command_add_rule(CommandAddRule(name='dev-budget', kind='daily', threshold='3h', category='dev'))
+        command_add_rule(CommandAddRule(name='day', kind='daily', threshold='8h'))
+        assert self.totals(database) == [('2000-01-03', 1, 7200), ('2000-01-03', 2, 10800)]
+        capsys.readouterr()
+
+        command_start(CommandStart(message='build', category='dev',
+                                   start='2000-01-03 13:00', end='2000-01-03 14:30'))
+        assert capsys.readouterr().out.splitlines()[-1] == \
+            'Alert dev-budget: 03:30 of dev on 2000-01-03, over 03:00'
+
+        # Moving the entry to another category moves its time
+        command_edit(CommandEdit(id=3, message=UNSET, category='ops', start=UNSET, end=UNSET))
+        assert capsys.readouterr().out.splitlines()[-1].startswith('3: ')
+        assert self.totals(database) == [('2000-01-03', 1, 7200), ('2000-01-03', 2, 16200)]
+
+        command_drop(CommandDrop(id=1, all=False))
+        command_drop_rule(CommandDropRule(name='dev-budget'))
+        assert self.totals(database) == [('2000-01-03', 2, 9000)]
+
+    def test_check_running_entries(self, database, capsys):
+        now = datetime.now()
+        connection = sqlite3.connect(database)
+        insert_entries(connection, [
+            ((now - timedelta(hours=5)).strftime(DB_DATE_FORMAT), None, 'forgotten', 'dev'),
+            ((now - timedelta(minutes=10)).strftime(DB_DATE_FORMAT), None, 'fresh', None),
+        ])
+        connection.close()
+        command_check_rules(CommandCheckRules())
+        assert capsys.readouterr().out == 'No rule is over its threshold\n'
+
+        command_add_rule(CommandAddRule(name='long', kind='running', threshold='4h'))
+        with pytest.raises(CommandError):
+            command_add_rule(CommandAddRule(name='long', kind='running', threshold='1h'))
+        capsys.readouterr()
+        command_check_rules(CommandCheckRules())
+        assert capsys.readouterr().out.splitlines() == ['Alert long: entry 1 "forgotten" running for 05:00, over 04:00']